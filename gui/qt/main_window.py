@@ -190,12 +190,12 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         if self.network:
             self.network_signal.connect(self.on_network_qt)
             interests = ['updated', 'new_transaction', 'status',
-                         'banner', 'verified', 'fee']
+                         'banner', 'verified', 'fee', 'sync_progress']
             # To avoid leaking references to "self" that prevent the
             # window from being GC-ed when closed, callbacks should be
             # methods of this class only, and specifically not be
             # partials, lambdas or methods of subobjects.  Hence...
-            self.network.register_callback(self.on_network, interests)
+            self.network.register_callback(self.on_network, interests, wallet)
             # set initial message
             self.console.showMessage(self.network.banner)
             self.network.register_callback(self.on_quotes, ['on_quotes'])
@@ -305,7 +305,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         elif event == 'new_transaction':
             self.tx_notifications.append(args[0])
             self.notify_transactions_signal.emit()
-        elif event in ['status', 'banner', 'verified', 'fee']:
+        elif event in ['status', 'banner', 'verified', 'fee', 'sync_progress']:
             # Handle in GUI thread
             self.network_signal.emit(event, args)
         else:
@@ -313,7 +313,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
 
     def on_network_qt(self, event, args=None):
         # Handle a network message in the GUI thread
-        if event == 'status':
+        if event in ['status', 'sync_progress']:
             self.update_status()
         elif event == 'banner':
             self.console.showMessage(args[0])
@@ -745,8 +745,11 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
             # Server height can be 0 after switching to a new server
             # until we get a headers subscription request response.
             # Display the synchronizing message in that case.
-            if not self.wallet.up_to_date or server_height == 0:
+            if not self.wallet.is_balance_ready() or server_height == 0:
                 text = _("Synchronizing...")
+                progress = self.wallet.get_sync_progress()
+                if progress:
+                    text += " " + _("{} of {} addresses, {} transactions left").format(*progress)
                 icon = QIcon(":icons/status_waiting.png")
             elif server_lag > 1:
                 text = _("Server is lagging ({} blocks)").format(server_lag)
@@ -758,6 +761,8 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
                     text +=  " [%s unconfirmed]"%(self.format_amount(u, True).strip())
                 if x:
                     text +=  " [%s unmatured]"%(self.format_amount(x, True).strip())
+                if not self.wallet.up_to_date:
+                    text += " [%s]" % _("synchronizing")
 
                 # append fiat balance and price
                 if self.fx.is_enabled():
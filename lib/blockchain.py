@@ -21,7 +21,13 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import re
+import json
+import mmap
 import threading
+import time
+
+from Cryptodome.Hash import keccak
 
 from . import util
 from . import bitcoin
@@ -31,6 +37,20 @@ from .bitcoin import *
 #MAX_TARGET = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
 MAX_TARGET = 0x00000FFFFF000000000000000000000000000000000000000000000000000000
 
+HEADER_SIZE = 80
+NULL_HEADER = bytes(HEADER_SIZE)
+HASH_SIZE = 32
+NULL_HASH = bytes(HASH_SIZE)
+# decoded headers and hashes kept in memory per headers file
+HEADER_CACHE_SIZE = 4096
+# appended headers are fsynced in batches of this many, or this often
+HEADERS_FLUSH_BATCH = 500
+HEADERS_FLUSH_INTERVAL = 5
+# chunk index and target, in the .targets sidecar of a headers file
+TARGET_RECORD_SIZE = 4 + 32
+# headers this far below the highest tip are looked up by hash
+HASH_INDEX_DEPTH = 4032
+
 def serialize_header(res):
     s = int_to_hex(res.get('version'), 4) \
         + rev_hex(res.get('prev_block_hash')) \
@@ -64,35 +84,549 @@ def hash_header(header):
     return hash_encode(Hash_Keccak(bfh(serialize_header(header))))
 
 
+def hash_raw_header(raw):
+    """hash of a serialized header given as any bytes-like object"""
+    return keccak.new(digest_bits=256, data=raw).digest()
+
+def hash_raw_headers(data):
+    """Concatenated hashes of serialized headers; empty (null) header
+    slots get a null hash"""
+    data = memoryview(data)
+    out = bytearray()
+    for i in range(len(data) // HEADER_SIZE):
+        raw = data[i * HEADER_SIZE:(i + 1) * HEADER_SIZE]
+        out += NULL_HASH if raw == NULL_HEADER else hash_raw_header(raw)
+    return bytes(out)
+
+
+class HeaderStore(util.PrintError):
+    """
+    Memory-mapped view of a file of serialized headers and of its
+    sidecar index of header hashes, with LRU caches of decoded headers
+    and hex hashes, keyed by position in the file.
+
+    Headers appended at the end of the file are buffered and written
+    out in batches, with one fsync per batch.
+
+    A store is a segment of headers starting at height base, shared by
+    the chains that have it in their ranges (see Blockchain.ranges).
+    It also memoizes the difficulty targets computed from the chunks it
+    holds, persisted in a second sidecar file.
+    """
+
+    def __init__(self, path, base=0, name=None):
+        self.path = path
+        self.base = base
+        self.name = name
+        self.lock = threading.RLock()
+        self._file, self._mmap, self._size = None, None, 0
+        self._index_file, self._index_mmap, self._index_size = None, None, 0
+        # appended headers not written yet, and their hashes
+        self._buffer = bytearray()
+        self._buffer_hashes = bytearray()
+        self._buffer_time = 0
+        self.headers = util.LRUCache(HEADER_CACHE_SIZE)
+        self.hashes = util.LRUCache(HEADER_CACHE_SIZE)
+        # chunk index -> target, and the indices saved to disk
+        self.targets = {}
+        self._targets_saved = set()
+        # (start, end, chain) for the chains holding our headers
+        self.owners = []
+        self.open()
+
+    def diagnostic_name(self):
+        return os.path.basename(self.path)
+
+    def index_path(self):
+        return self.path + '.hashes'
+
+    def targets_path(self):
+        return self.path + '.targets'
+
+    @staticmethod
+    def _map(path):
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size == 0:
+            # empty files cannot be mapped
+            return None, None, 0
+        f = open(path, 'rb')
+        return f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), size
+
+    @staticmethod
+    def _unmap(f, m):
+        if m is not None:
+            m.close()
+        if f is not None:
+            f.close()
+
+    def open(self):
+        """(re)map the files, e.g. after they were written or renamed"""
+        with self.lock:
+            self.close()
+            size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+            if size % HEADER_SIZE:
+                # a write was interrupted
+                self.print_error("truncating incomplete header at", size - size % HEADER_SIZE)
+                with open(self.path, 'rb+') as f:
+                    f.truncate(size - size % HEADER_SIZE)
+            self._file, self._mmap, self._size = self._map(self.path)
+            self._index_file, self._index_mmap, self._index_size = self._map(self.index_path())
+            if self._index_size != self._size // HEADER_SIZE * HASH_SIZE:
+                self.repair_index()
+            self.load_targets()
+
+    def close(self):
+        with self.lock:
+            self._unmap(self._file, self._mmap)
+            self._unmap(self._index_file, self._index_mmap)
+            self._file, self._mmap = None, None
+            self._index_file, self._index_mmap = None, None
+
+    def repair_index(self):
+        """bring the hash index in line with the headers file, hashing
+        the headers that are missing from it"""
+        with self.lock:
+            self._unmap(self._index_file, self._index_mmap)
+            self._index_file, self._index_mmap = None, None
+            count = self._size // HEADER_SIZE
+            n = min(self._index_size // HASH_SIZE, count)
+            if count - n > 1:
+                self.print_error("rebuilding hash index from", n)
+            with open(self.index_path(), 'ab+') as f:
+                f.truncate(n * HASH_SIZE)
+                step = 2016
+                for i in range(n, count, step):
+                    f.write(hash_raw_headers(self._mmap[i * HEADER_SIZE:(i + step) * HEADER_SIZE]))
+                f.flush()
+                os.fsync(f.fileno())
+            self._index_file, self._index_mmap, self._index_size = self._map(self.index_path())
+
+    def is_mapped(self):
+        return self._mmap is not None or len(self._buffer) > 0
+
+    def size(self):
+        return self._size + len(self._buffer)
+
+    def count(self):
+        return self.size() // HEADER_SIZE
+
+    def end(self):
+        """height after the last header of the segment"""
+        return self.base + self.count()
+
+    def remove(self):
+        with self.lock:
+            self._buffer, self._buffer_hashes = bytearray(), bytearray()
+            self.clear_cache()
+            self.close()
+            for path in [self.path, self.index_path(), self.targets_path()]:
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    def clear_cache(self, index=0):
+        """forget cached headers from position index on"""
+        with self.lock:
+            for cache in [self.headers, self.hashes]:
+                for i in cache.keys():
+                    if i >= index:
+                        cache.pop(i)
+
+    def read(self, index):
+        """raw header at position index, or None if the file is too short"""
+        with self.lock:
+            offset = index * HEADER_SIZE
+            if offset + HEADER_SIZE <= self._size:
+                return self._mmap[offset:offset + HEADER_SIZE]
+            offset -= self._size
+            if 0 <= offset and offset + HEADER_SIZE <= len(self._buffer):
+                return bytes(self._buffer[offset:offset + HEADER_SIZE])
+            return None
+
+    def read_header(self, index, height):
+        with self.lock:
+            h = self.headers.get(index)
+            if h is not None and h['block_height'] == height:
+                return dict(h)
+            raw = self.read(index)
+            if raw is None:
+                raise Exception('Expected to read a full header at position {}'.format(index))
+            if raw == NULL_HEADER:
+                return None
+            h = deserialize_header(raw, height)
+            self.headers[index] = h
+            return dict(h)
+
+    def get_raw_hash(self, index):
+        """hash of the header at position index as stored in the index,
+        NULL_HASH for an empty slot, or None if there is no header"""
+        with self.lock:
+            offset = index * HASH_SIZE
+            if offset + HASH_SIZE <= self._index_size:
+                raw_hash = self._index_mmap[offset:offset + HASH_SIZE]
+                if raw_hash != NULL_HASH:
+                    return raw_hash
+            elif index >= self._size // HEADER_SIZE:
+                offset = (index - self._size // HEADER_SIZE) * HASH_SIZE
+                if offset + HASH_SIZE <= len(self._buffer_hashes):
+                    return bytes(self._buffer_hashes[offset:offset + HASH_SIZE])
+            # not indexed, or an entry that was being rewritten
+            raw = self.read(index)
+            if raw is None:
+                return None
+            return NULL_HASH if raw == NULL_HEADER else hash_raw_header(raw)
+
+    def get_hash(self, index):
+        with self.lock:
+            _hash = self.hashes.get(index)
+            if _hash is not None:
+                return _hash
+            raw_hash = self.get_raw_hash(index)
+            if raw_hash is None:
+                return None
+            _hash = hash_encode(raw_hash)
+            self.hashes[index] = _hash
+            return _hash
+
+    def target_position(self, index):
+        """position of the last header of chunk index, which the
+        target computed from the chunk depends on"""
+        return index * 2016 + 2015 - self.base
+
+    def load_targets(self):
+        with self.lock:
+            self.targets, self._targets_saved = {}, set()
+            path = self.targets_path()
+            if not os.path.exists(path):
+                return
+            with open(path, 'rb') as f:
+                data = f.read()
+            count = self._size // HEADER_SIZE
+            n = len(data) // TARGET_RECORD_SIZE
+            for i in range(n):
+                record = data[i * TARGET_RECORD_SIZE:(i + 1) * TARGET_RECORD_SIZE]
+                index = int.from_bytes(record[:4], 'little')
+                if self.target_position(index) < count:
+                    self.targets[index] = int.from_bytes(record[4:], 'big')
+                    self._targets_saved.add(index)
+            if len(self.targets) != n or len(data) % TARGET_RECORD_SIZE:
+                self.save_targets(count, True)
+
+    def save_targets(self, count, rewrite=False):
+        """Save the targets of the chunks within the first count headers
+        of the file, which must be on disk already"""
+        with self.lock:
+            if not rewrite and len(self._targets_saved) == len(self.targets):
+                return
+            items = sorted(i for i in self.targets.items()
+                           if (rewrite or i[0] not in self._targets_saved) and self.target_position(i[0]) < count)
+            if not items and not rewrite:
+                return
+            with open(self.targets_path(), 'wb' if rewrite else 'ab') as f:
+                f.write(b''.join(index.to_bytes(4, 'little') + target.to_bytes(32, 'big') for index, target in items))
+                f.flush()
+                os.fsync(f.fileno())
+            if rewrite:
+                self._targets_saved = set()
+            self._targets_saved.update(index for index, target in items)
+
+    def get_target(self, index):
+        return self.targets.get(index)
+
+    def set_target(self, index, target):
+        with self.lock:
+            self.targets[index] = target
+
+    def drop_targets(self, position):
+        """forget the targets that depend on headers from position on"""
+        with self.lock:
+            stale = [i for i in self.targets if self.target_position(i) >= position]
+            if not stale:
+                return
+            for i in stale:
+                self.targets.pop(i)
+            if any(i in self._targets_saved for i in stale):
+                self.save_targets(position, True)
+
+    def write(self, data, offset, truncate=True, hashes=None):
+        """write serialized headers at byte offset; hashes may carry
+        their already computed hashes"""
+        with self.lock:
+            if offset == self.size():
+                # appending: buffer it
+                if not self._buffer:
+                    self._buffer_time = time.time()
+                self._buffer += data
+                self._buffer_hashes += hashes if hashes is not None else hash_raw_headers(data)
+                self.flush()
+                return
+            self.flush(True)
+            self._write(data, offset, truncate, hashes)
+
+    def flush(self, force=False):
+        """Write out buffered headers once there are enough of them or
+        they have waited long enough, or right away if force is set"""
+        with self.lock:
+            if not self._buffer:
+                self.save_targets(self._size // HEADER_SIZE)
+                return
+            if not force and len(self._buffer) < HEADERS_FLUSH_BATCH * HEADER_SIZE \
+               and time.time() - self._buffer_time < HEADERS_FLUSH_INTERVAL:
+                return
+            data, hashes = bytes(self._buffer), bytes(self._buffer_hashes)
+            self._buffer, self._buffer_hashes = bytearray(), bytearray()
+            self._write(data, self._size, False, hashes)
+
+    def _write(self, data, offset, truncate, hashes):
+        if truncate or offset < self._size:
+            self.drop_targets(offset // HEADER_SIZE)
+        # unmap first: truncating a mapped file is not allowed everywhere
+        self.close()
+        index_offset = offset // HEADER_SIZE * HASH_SIZE
+        index_mode = 'rb+' if os.path.exists(self.index_path()) else 'wb+'
+        with open(self.index_path(), index_mode) as index:
+            if index_offset < self._index_size:
+                # drop the entries we are about to overwrite, so that
+                # a crash cannot leave stale hashes behind
+                if truncate:
+                    index.truncate(index_offset)
+                else:
+                    index.seek(index_offset)
+                    index.write(NULL_HASH * min(len(data) // HEADER_SIZE, (self._index_size - index_offset) // HASH_SIZE))
+                index.flush()
+                os.fsync(index.fileno())
+            with open(self.path, 'rb+') as f:
+                if truncate and offset != self._size:
+                    f.seek(offset)
+                    f.truncate()
+                f.seek(offset)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            index.seek(index_offset)
+            index.write(hashes if hashes is not None else hash_raw_headers(data))
+            index.flush()
+            os.fsync(index.fileno())
+        end = offset + len(data)
+        self.save_targets((end if truncate else max(end, self._size)) // HEADER_SIZE)
+        self.clear_cache(offset // HEADER_SIZE)
+        self.open()
+
+
+class HashIndex(object):
+    """
+    Headers of all chains from floor height on, by hash.  Headers near
+    the tips, e.g. from notifications, are found without asking every
+    chain, and a header that is not in the index at a height it covers
+    is in no chain.
+    """
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.clear()
+
+    def clear(self):
+        self.floor = 0
+        self.top = -1
+        self.by_hash = {}
+        self.by_height = {}
+
+    def covers(self, height):
+        # the genesis and checkpoint hashes are not read from the stores
+        return height > 0 and height >= max(self.floor, len(constants.net.CHECKPOINTS) * 2016)
+
+    def add(self, store, height, raw_hash):
+        if height < self.floor or raw_hash == NULL_HASH:
+            return
+        self.by_hash[raw_hash] = (store, height)
+        self.by_height.setdefault(height, []).append(raw_hash)
+        if height > self.top:
+            self.top = height
+            self.advance(height - self.depth)
+
+    def advance(self, floor):
+        if floor - self.floor > len(self.by_height):
+            heights = [h for h in self.by_height if h < floor]
+        else:
+            heights = range(self.floor, floor)
+        for height in heights:
+            for raw_hash in self.by_height.pop(height, []):
+                self.by_hash.pop(raw_hash, None)
+        self.floor = max(self.floor, floor)
+
+    def remove(self, store, start, end=None):
+        """forget the headers of store from height start to end"""
+        end = self.top + 1 if end is None else min(end, self.top + 1)
+        for height in range(max(start, self.floor), end):
+            hashes = self.by_height.get(height, [])
+            for raw_hash in list(hashes):
+                if self.by_hash.get(raw_hash, (None,))[0] is store:
+                    self.by_hash.pop(raw_hash)
+                    hashes.remove(raw_hash)
+
+    def get_chain(self, raw_hash, height):
+        store, h = self.by_hash.get(raw_hash, (None, None))
+        if h != height:
+            return None
+        for start, end, b in store.owners:
+            if start <= height and (end is None or height < end):
+                return b
+
+
 blockchains = {}
+# segment stores by file name relative to the headers dir
+segments = {}
+header_index = HashIndex(HASH_INDEX_DEPTH)
+# chains by the checkpoint of their parent
+children = {}
+
+def get_segment(config, name, base):
+    store = segments.get(name)
+    if store is None:
+        path = os.path.join(util.get_headers_dir(config), name)
+        store = HeaderStore(path, base, name)
+        segments[name] = store
+    return store
+
+def new_segment(config, base):
+    """create an empty segment file for headers from height base on"""
+    d = util.get_headers_dir(config)
+    n = 0
+    while True:
+        name = os.path.join('forks', 'segment_%d_%d' % (base, n))
+        if name not in segments and not os.path.exists(os.path.join(d, name)):
+            break
+        n += 1
+    open(os.path.join(d, name), 'wb').close()
+    return get_segment(config, name, base)
+
+def release_segment(store):
+    """delete a segment file once no chain refers to it"""
+    if store.name == 'blockchain_headers':
+        return
+    for b in blockchains.values():
+        if any(r[0] is store for r in b.ranges):
+            return
+    util.print_error("removing", store.name)
+    store.remove()
+    segments.pop(store.name, None)
+
+def metadata_path(config):
+    return os.path.join(util.get_headers_dir(config), 'forks', 'chains.json')
+
+def read_metadata(config):
+    path = metadata_path(config)
+    if os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.loads(f.read())
+        except BaseException as e:
+            util.print_error("cannot read", path, e)
+    # layout of older versions: one file per chain
+    meta = {
+        'segments': {'blockchain_headers': 0},
+        'chains': [{'checkpoint': 0, 'parent': None, 'ranges': [['blockchain_headers', 0, None]]}],
+    }
+    fdir = os.path.join(util.get_headers_dir(config), 'forks')
+    for filename in filter(lambda x: re.match(r'^fork_\d+_\d+$', x), os.listdir(fdir)):
+        parent_id, checkpoint = map(int, filename.split('_')[1:])
+        name = os.path.join('forks', filename)
+        meta['segments'][name] = checkpoint
+        meta['chains'].append({'checkpoint': checkpoint, 'parent': parent_id, 'ranges': [[name, checkpoint, None]]})
+    return meta
+
+def save_blockchains(config):
+    """Persist which segments make up each chain.  Fork switches only
+    change this metadata, so it is replaced atomically, once the
+    headers it points at are on disk."""
+    meta = {'segments': {}, 'chains': []}
+    stores = set()
+    for b in sorted(blockchains.values(), key=lambda b: b.checkpoint):
+        for store, start, end in b.ranges:
+            meta['segments'][store.name] = store.base
+            stores.add(store)
+        meta['chains'].append({
+            'checkpoint': b.checkpoint,
+            'parent': b.parent_id,
+            'ranges': [[store.name, start, end] for store, start, end in b.ranges],
+        })
+    for store in stores:
+        store.flush(True)
+    path = metadata_path(config)
+    temp_path = "%s.tmp.%s" % (path, os.getpid())
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(meta, indent=4, sort_keys=True))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    update_lineage()
+
+def update_lineage():
+    """rebuild the owners of the segments and the children of the
+    chains, after forks were created, swapped or dropped"""
+    for store in segments.values():
+        store.owners = []
+    children.clear()
+    for b in blockchains.values():
+        for store, start, end in b.ranges:
+            store.owners.append((start, end, b))
+        if b.parent_id is not None:
+            children.setdefault(b.parent_id, []).append(b)
+
+def index_headers():
+    header_index.clear()
+    if not blockchains:
+        return
+    tip = max(b.height() for b in blockchains.values())
+    header_index.advance(tip - header_index.depth)
+    for b in blockchains.values():
+        b.index_headers(max(header_index.floor, b.checkpoint))
 
 def read_blockchains(config):
-    blockchains[0] = Blockchain(config, 0, None)
+    for store in segments.values():
+        store.close()
+    segments.clear()
+    blockchains.clear()
     fdir = os.path.join(util.get_headers_dir(config), 'forks')
     if not os.path.exists(fdir):
         os.mkdir(fdir)
-    l = filter(lambda x: x.startswith('fork_'), os.listdir(fdir))
-    l = sorted(l, key = lambda x: int(x.split('_')[1]))
-    for filename in l:
-        checkpoint = int(filename.split('_')[2])
-        parent_id = int(filename.split('_')[1])
-        b = Blockchain(config, checkpoint, parent_id)
-        h = b.read_header(b.checkpoint)
-        if b.parent().can_connect(h, check_height=False):
+    meta = read_metadata(config)
+    bases = meta['segments']
+    # parents always have a lower checkpoint than their children
+    for c in sorted(meta['chains'], key=lambda c: c['checkpoint']):
+        ranges = [(get_segment(config, name, bases[name]), start, end) for name, start, end in c['ranges']]
+        b = Blockchain(config, c['checkpoint'], c['parent'], ranges)
+        if b.parent_id is None:
             blockchains[b.checkpoint] = b
-        else:
-            util.print_error("cannot connect", filename)
+            continue
+        if b.parent_id in blockchains:
+            try:
+                h = b.read_header(b.checkpoint)
+            except BaseException as e:
+                h = None
+            if b.parent().can_connect(h, check_height=False):
+                blockchains[b.checkpoint] = b
+                continue
+        util.print_error("cannot connect", b.checkpoint, b.parent_id)
+    save_blockchains(config)
+    index_headers()
     return blockchains
 
 def check_header(header):
     if type(header) is not dict:
         return False
+    height = header.get('block_height')
+    if header_index.covers(height):
+        return header_index.get_chain(hash_decode(hash_header(header)), height) or False
     for b in blockchains.values():
         if b.check_header(header):
             return b
     return False
 
 def can_connect(header):
+    height = header.get('block_height')
+    if header_index.covers(height - 1) and header.get('prev_block_hash'):
+        b = header_index.get_chain(hash_decode(header.get('prev_block_hash')), height - 1)
+        return b if b and b.can_connect(header) else False
     for b in blockchains.values():
         if b.can_connect(header):
             return b
@@ -104,13 +638,19 @@ class Blockchain(util.PrintError):
     Manages blockchain headers and their verification
     """
 
-    def __init__(self, config, checkpoint, parent_id):
+    def __init__(self, config, checkpoint, parent_id, ranges=None):
         self.config = config
         self.catch_up = None # interface catching up
         self.checkpoint = checkpoint
         self.checkpoints = constants.net.CHECKPOINTS
         self.parent_id = parent_id
-        self.lock = threading.Lock()
+        self.lock = threading.RLock()
+        # (store, start, end) segments holding our headers from the
+        # checkpoint on, in order.  Only the last one may be open-ended
+        # (end is None): that chain owns the tail of the segment file.
+        if ranges is None:
+            ranges = [(get_segment(config, 'blockchain_headers', 0), 0, None)]
+        self.ranges = list(ranges)
         with self.lock:
             self.update_size()
 
@@ -118,8 +658,8 @@ class Blockchain(util.PrintError):
         return blockchains[self.parent_id]
 
     def get_max_child(self):
-        children = list(filter(lambda y: y.parent_id==self.checkpoint, blockchains.values()))
-        return max([x.checkpoint for x in children]) if children else None
+        l = children.get(self.checkpoint)
+        return max([x.checkpoint for x in l]) if l else None
 
     def get_checkpoint(self):
         mc = self.get_max_child()
@@ -138,8 +678,8 @@ class Blockchain(util.PrintError):
 
     def fork(parent, header):
         checkpoint = header.get('block_height')
-        self = Blockchain(parent.config, checkpoint, parent.checkpoint)
-        open(self.path(), 'w+').close()
+        self = Blockchain(parent.config, checkpoint, parent.checkpoint, [])
+        blockchains[checkpoint] = self
         self.save_header(header)
         return self
 
@@ -148,11 +688,25 @@ class Blockchain(util.PrintError):
 
     def size(self):
         with self.lock:
-            return self._size
+            return sum(self.range_end(r) - r[1] for r in self.ranges)
+
+    @staticmethod
+    def range_end(r):
+        store, start, end = r
+        return store.end() if end is None else end
+
+    def find_range(self, height):
+        for r in self.ranges:
+            if r[1] <= height < self.range_end(r):
+                return r
+
+    def stores(self):
+        return [r[0] for r in self.ranges]
 
     def update_size(self):
-        p = self.path()
-        self._size = os.path.getsize(p)//80 if os.path.exists(p) else 0
+        """(re)open our segment files"""
+        for store in self.stores():
+            store.open()
 
     def verify_header(self, header, prev_hash, target):
         _hash = hash_header(header)
@@ -167,86 +721,210 @@ class Blockchain(util.PrintError):
         #    if int('0x' + _hash, 16) > target:
         #        raise Exception("insufficient proof of work: %s vs target %s" % (int('0x' + _hash, 16), target))
 
+    def verify_raw_header(self, raw_header, prev_hash, target):
+        """verify_header for a serialized header, without decoding it.
+        prev_hash is in internal byte order; returns the header hash"""
+        if raw_header[4:36] != prev_hash:
+            raise Exception("prev hash mismatch: %s vs %s" % (hash_encode(prev_hash), hash_encode(bytes(raw_header[4:36]))))
+        return hash_raw_header(raw_header)
+
     def verify_chunk(self, index, data):
+        """Verify a chunk of serialized headers in place.  Returns the
+        concatenated hashes of its headers."""
         num = len(data) // 80
-        prev_hash = self.get_hash(index * 2016 - 1)
+        data = memoryview(data)
+        prev_hash = hash_decode(self.get_hash(index * 2016 - 1))
         target = self.get_target(index-1)
+        hashes = bytearray()
         for i in range(num):
-            raw_header = data[i*80:(i+1) * 80]
-            header = deserialize_header(raw_header, index*2016 + i)
-            self.verify_header(header, prev_hash, target)
-            prev_hash = hash_header(header)
+            prev_hash = self.verify_raw_header(data[i*80:(i+1) * 80], prev_hash, target)
+            hashes += prev_hash
+        return bytes(hashes)
 
     def path(self):
-        d = util.get_headers_dir(self.config)
-        filename = 'blockchain_headers' if self.parent_id is None else os.path.join('forks', 'fork_%d_%d'%(self.parent_id, self.checkpoint))
-        return os.path.join(d, filename)
+        """path of the file holding our first headers"""
+        return self.ranges[0][0].path if self.ranges else None
 
-    def save_chunk(self, index, chunk):
-        filename = self.path()
+    def save_chunk(self, index, chunk, hashes=None):
         d = (index * 2016 - self.checkpoint) * 80
         if d < 0:
             chunk = chunk[-d:]
+            if hashes is not None:
+                hashes = hashes[-d // 80 * HASH_SIZE:]
             d = 0
         truncate = index >= len(self.checkpoints)
-        self.write(chunk, d, truncate)
+        self.write(chunk, d, truncate, hashes)
         self.swap_with_parent()
 
     def swap_with_parent(self):
+        """Promote this fork over its parent once it is longer.  Only
+        the ranges and lineage of the two chains change: the fork takes
+        over the parent's segments below our checkpoint, and the parent
+        keeps its branch from there on as a fork of us."""
         if self.parent_id is None:
             return
         parent_branch_size = self.parent().height() - self.checkpoint + 1
         if parent_branch_size >= self.size():
             return
         self.print_error("swap", self.checkpoint, self.parent_id)
-        parent_id = self.parent_id
-        checkpoint = self.checkpoint
         parent = self.parent()
-        with open(self.path(), 'rb') as f:
-            my_data = f.read()
-        with open(parent.path(), 'rb') as f:
-            f.seek((checkpoint - parent.checkpoint)*80)
-            parent_data = f.read(parent_branch_size*80)
-        self.write(parent_data, 0)
-        parent.write(my_data, (checkpoint - parent.checkpoint)*80)
-        # store file path
-        for b in blockchains.values():
-            b.old_path = b.path()
-        # swap parameters
-        self.parent_id = parent.parent_id; parent.parent_id = parent_id
-        self.checkpoint = parent.checkpoint; parent.checkpoint = checkpoint
-        self._size = parent._size; parent._size = parent_branch_size
-        # move files
-        for b in blockchains.values():
-            if b in [self, parent]: continue
-            if b.old_path != b.path():
-                self.print_error("renaming", b.old_path, b.path())
-                os.rename(b.old_path, b.path())
-        # update pointers
+        checkpoint, parent_checkpoint = self.checkpoint, parent.checkpoint
+        with self.lock, parent.lock:
+            # forks of the parent branch above us now hang off it, and
+            # our own forks hang off the promoted chain
+            moved = [b for b in blockchains.values()
+                     if b.parent_id == parent_checkpoint and b.checkpoint > checkpoint]
+            ours = [b for b in blockchains.values() if b.parent_id == checkpoint]
+            for b in moved:
+                b.parent_id = checkpoint
+            for b in ours:
+                b.parent_id = parent_checkpoint
+            self.ranges = self.merge_ranges(parent.slice_ranges(None, checkpoint) + self.ranges)
+            parent.ranges = parent.slice_ranges(checkpoint, None)
+            self.parent_id, parent.parent_id = parent.parent_id, parent_checkpoint
+            self.checkpoint, parent.checkpoint = parent_checkpoint, checkpoint
         blockchains[self.checkpoint] = self
         blockchains[parent.checkpoint] = parent
+        save_blockchains(self.config)
 
-    def write(self, data, offset, truncate=True):
-        filename = self.path()
+    def slice_ranges(self, lo, hi):
+        """our ranges clipped to heights [lo, hi); None is unbounded"""
+        out = []
+        for store, start, end in self.ranges:
+            if lo is not None:
+                start = max(start, lo)
+            if hi is not None:
+                end = hi if end is None else min(end, hi)
+            if end is not None and end <= start:
+                continue
+            out.append((store, start, end))
+        return out
+
+    @staticmethod
+    def merge_ranges(ranges):
+        out = []
+        for r in ranges:
+            if out and out[-1][0] is r[0] and out[-1][2] == r[1]:
+                out[-1] = (r[0], out[-1][1], r[2])
+            else:
+                out.append(r)
+        return out
+
+    def write(self, data, offset, truncate=True, hashes=None):
+        height = self.checkpoint + offset // 80
         with self.lock:
-            with open(filename, 'rb+') as f:
-                if truncate and offset != self._size*80:
-                    f.seek(offset)
-                    f.truncate()
-                f.seek(offset)
-                f.write(data)
-                f.flush()
-                os.fsync(f.fileno())
-            self.update_size()
+            ranges = list(self.ranges)
+            if truncate:
+                self.truncate(height)
+            else:
+                # overwrite what we have in place
+                n = max(0, min(len(data) // 80, self.height() + 1 - height))
+                h = height
+                while h < height + n:
+                    r = self.find_range(h)
+                    store = r[0]
+                    k = min(self.range_end(r), height + n) - h
+                    i = h - height
+                    header_index.remove(store, h, h + k)
+                    store.write(data[i*80:(i+k)*80], (h - store.base) * 80, False,
+                                hashes[i*HASH_SIZE:(i+k)*HASH_SIZE] if hashes is not None else None)
+                    self.index_headers(h, h + k)
+                    h += k
+                data = data[n*80:]
+                if hashes is not None:
+                    hashes = hashes[n*HASH_SIZE:]
+                height += n
+            if data:
+                self.append(data, height, hashes)
+            changed = ranges != self.ranges
+        if changed:
+            for store, start, end in ranges:
+                if all(r[0] is not store for r in self.ranges):
+                    release_segment(store)
+            save_blockchains(self.config)
+
+    def truncate(self, height):
+        """forget our headers from height on"""
+        ranges = []
+        for store, start, end in self.ranges:
+            if end is None or end > height:
+                header_index.remove(store, max(height, start), end)
+            if end is None:
+                # our own tail of the segment: cut the file itself
+                cut = max(height, start)
+                if cut < store.end():
+                    store.write(b'', (cut - store.base) * 80, True)
+                if start <= height:
+                    ranges.append((store, start, None))
+            elif start < height:
+                ranges.append((store, start, min(end, height)))
+        self.ranges = ranges
+
+    def append(self, data, height, hashes=None):
+        assert height == self.height() + 1
+        last = self.ranges[-1] if self.ranges else None
+        if last is None or last[2] is not None or last[0].end() != height:
+            # the segment we end in is shared: start a new one
+            self.ranges.append((new_segment(self.config, height), height, None))
+        store = self.ranges[-1][0]
+        store.write(data, (height - store.base) * 80, True, hashes)
+        self.index_headers(height)
+
+    def index_headers(self, start, end=None):
+        """add our headers from height start to end to the hash index"""
+        end = self.height() + 1 if end is None else end
+        # anything deeper would fall below the floor right away
+        start = max(start, self.checkpoint, header_index.floor, end - 1 - header_index.depth)
+        for height in range(start, end):
+            store = self.find_range(height)[0]
+            header_index.add(store, height, store.get_raw_hash(height - store.base))
+
+    def flush(self, force=False):
+        """write out buffered headers, see HeaderStore.flush"""
+        for store in self.stores():
+            store.flush(force)
 
     def save_header(self, header):
-        delta = header.get('block_height') - self.checkpoint
-        data = bfh(serialize_header(header))
+        self.save_headers([header])
+
+    def save_headers(self, headers):
+        """append consecutive headers to the chain with a single write"""
+        delta = headers[0].get('block_height') - self.checkpoint
+        data = b''.join(bfh(serialize_header(header)) for header in headers)
         assert delta == self.size()
-        assert len(data) == 80
+        assert len(data) == 80 * len(headers)
         self.write(data, delta*80)
         self.swap_with_parent()
 
+    def connect_headers(self, headers):
+        """Save the longest run of the given consecutive headers that
+        connects to our tip.  Returns the number of headers saved."""
+        run = []
+        n = 0
+        for header in headers:
+            height = header.get('block_height')
+            if run and height % 2016 == 0:
+                # the next target depends on the headers of this run
+                self.save_headers(run)
+                n += len(run)
+                run = []
+            if not run:
+                if not self.can_connect(header):
+                    break
+            else:
+                prev_hash = hash_header(run[-1])
+                if height != run[-1].get('block_height') + 1:
+                    break
+                try:
+                    self.verify_header(header, prev_hash, self.get_target(height // 2016 - 1))
+                except BaseException as e:
+                    break
+            run.append(header)
+        if run:
+            self.save_headers(run)
+            n += len(run)
+        return n
+
     def read_header(self, height):
         assert self.parent_id != self.checkpoint
         if height < 0:
@@ -255,21 +933,13 @@ class Blockchain(util.PrintError):
             return self.parent().read_header(height)
         if height > self.height():
             return
-        delta = height - self.checkpoint
-        name = self.path()
-        if os.path.exists(name):
-            with open(name, 'rb') as f:
-                f.seek(delta * 80)
-                h = f.read(80)
-                if len(h) < 80:
-                    raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
-        elif not os.path.exists(util.get_headers_dir(self.config)):
-            raise Exception('Electrum datadir does not exist. Was it deleted while running?')
-        else:
+        store = self.find_range(height)[0]
+        if not store.is_mapped():
+            name = store.path
+            if not os.path.exists(util.get_headers_dir(self.config)):
+                raise Exception('Electrum datadir does not exist. Was it deleted while running?')
             raise Exception('Cannot find headers file but datadir is there. Should be at {}'.format(name))
-        if h == bytes([0])*80:
-            return None
-        return deserialize_header(h, height)
+        return store.read_header(height - store.base, height)
 
     def get_hash(self, height):
         if height == -1:
@@ -281,8 +951,13 @@ class Blockchain(util.PrintError):
             index = height // 2016
             h, t = self.checkpoints[index]
             return h
+        elif height < self.checkpoint:
+            return self.parent().get_hash(height)
+        elif height > self.height():
+            return hash_header(None)
         else:
-            return hash_header(self.read_header(height))
+            store = self.find_range(height)[0]
+            return store.get_hash(height - store.base)
 
     def get_timestamp(self, height):
         if height < len(self.checkpoints) * 2016 and (height + 1) % 2016 == 0:
@@ -300,7 +975,21 @@ class Blockchain(util.PrintError):
         if index < len(self.checkpoints):
             h, t = self.checkpoints[index]
             return t
-        # new target
+        first, last = index * 2016, index * 2016 + 2015
+        if last < self.checkpoint:
+            return self.parent().get_target(index)
+        r = self.find_range(first)
+        if r is None or last >= self.range_end(r):
+            # the chunk spans our checkpoint or two segments
+            return self.compute_target(index)
+        store = r[0]
+        target = store.get_target(index)
+        if target is None:
+            target = self.compute_target(index)
+            store.set_target(index, target)
+        return target
+
+    def compute_target(self, index):
         first = self.read_header(index * 2016)
         last = self.read_header(index * 2016 + 2015)
         bits = last.get('bits')
@@ -356,9 +1045,9 @@ class Blockchain(util.PrintError):
     def connect_chunk(self, idx, hexdata):
         try:
             data = bfh(hexdata)
-            self.verify_chunk(idx, data)
+            hashes = self.verify_chunk(idx, data)
             #self.print_error("validated chunk %d" % idx)
-            self.save_chunk(idx, data)
+            self.save_chunk(idx, data, hashes)
             return True
         except BaseException as e:
             self.print_error('verify_chunk %d failed'%idx, str(e))
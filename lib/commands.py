@@ -342,6 +342,12 @@ class Commands:
         uses this to verify transactions (Simple Payment Verification)."""
         return self.network.synchronous_get(('blockchain.transaction.get_merkle', [txid, int(height)]))
 
+    @command('n')
+    def getnetworkstats(self):
+        """Return network statistics: requests, responses, errors and
+        latency per method, bytes, queue depths and cache hit rates."""
+        return self.network.get_network_stats()
+
     @command('n')
     def getservers(self):
         """Return the list of available servers"""
@@ -527,7 +533,12 @@ class Commands:
         if self.wallet and txid in self.wallet.transactions:
             tx = self.wallet.transactions[txid]
         else:
-            raw = self.network.synchronous_get(('blockchain.transaction.get', [txid]))
+            tx_cache = self.network.tx_cache
+            raw = tx_cache.get(txid) if tx_cache else None
+            if not raw:
+                raw = self.network.synchronous_get(('blockchain.transaction.get', [txid]))
+                if raw and tx_cache:
+                    tx_cache.put(txid, raw)
             if raw:
                 tx = Transaction(raw)
             else:
@@ -750,7 +761,8 @@ class Commands:
                 util.print_error('Got Response for %s' % address)
             except BaseException as e:
                 util.print_error(str(e))
-        h = self.network.addr_to_scripthash(address)
+        # the callback knows its address: nothing to remember for it
+        h = bitcoin.address_to_scripthash(address)
         self.network.send([('blockchain.scripthash.subscribe', [h])], callback)
         return True
 
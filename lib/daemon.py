@@ -203,6 +203,8 @@ class Daemon(DaemonThread):
                     'current_wallet': current_wallet_path,
                     'fee_per_kb': self.config.fee_per_kb(),
                 }
+                stats = self.network.get_network_stats()
+                response['network_stats'] = {k: v for k, v in stats.items() if not isinstance(v, dict)}
             else:
                 response = "Daemon offline"
         elif sub == 'stop':
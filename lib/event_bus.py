@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+#
+# Electrum - Lightweight SmartCash Client
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import queue
+import sys
+import threading
+import time
+import traceback
+from collections import defaultdict
+
+from .util import PrintError
+
+# events that only tell that something changed: a burst of them is
+# delivered once per interval, with the arguments of the last one
+COALESCED_EVENTS = {'updated', 'status', 'interfaces', 'servers', 'fee', 'on_quotes', 'on_history',
+                    'sync_progress'}
+COALESCE_INTERVAL = 0.5
+# events waiting for delivery; more are dropped
+MAX_QUEUED_EVENTS = 10000
+
+STOP = object()
+
+
+class EventBus(PrintError):
+    """Delivers network events to the callbacks registered for them.
+
+    Events are queued by trigger and delivered in order by a thread of
+    their own, so that slow callbacks do not hold up the network.
+    Callbacks registered with a wallet only get the events of that
+    wallet, and those that are not about a particular wallet."""
+
+    def __init__(self, interval=COALESCE_INTERVAL, max_queued=MAX_QUEUED_EVENTS):
+        self.interval = interval
+        self.lock = threading.Lock()
+        # event -> list of (callback, wallet)
+        self.callbacks = defaultdict(list)
+        self.queue = queue.Queue(max_queued)
+        # (event, wallet) -> args of a coalesced event waiting for its
+        # turn, and when it was last delivered
+        self.pending = {}
+        self.last_sent = {}
+        self.thread = None
+        self.closed = False
+        self.triggered = 0
+        self.delivered = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def diagnostic_name(self):
+        return 'EventBus'
+
+    def register(self, callback, events, wallet=None):
+        with self.lock:
+            for event in events:
+                self.callbacks[event].append((callback, wallet))
+
+    def unregister(self, callback):
+        with self.lock:
+            for callbacks in self.callbacks.values():
+                callbacks[:] = [c for c in callbacks if c[0] != callback]
+
+    def trigger(self, event, *args, wallet=None):
+        with self.lock:
+            self.triggered += 1
+            if self.closed:
+                self.dropped += 1
+                return
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='EventBus', daemon=True)
+                self.thread.start()
+            key = event, wallet
+            if event in COALESCED_EVENTS:
+                if key in self.pending:
+                    self.pending[key] = args
+                    self.coalesced += 1
+                    return
+                if time.time() - self.last_sent.get(key, 0) < self.interval:
+                    # delivered by flush; None wakes up the thread to
+                    # wait for this deadline
+                    self.pending[key] = args
+                    item = None
+                else:
+                    self.last_sent[key] = time.time()
+                    item = event, args, wallet
+            else:
+                item = event, args, wallet
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                if event in COALESCED_EVENTS:
+                    self.pending[key] = args
+                else:
+                    self.dropped += 1
+
+    def close(self):
+        '''Stop once the queued events are delivered'''
+        with self.lock:
+            self.closed = True
+            thread = self.thread
+        if thread:
+            self.queue.put(STOP)
+
+    def run(self):
+        while True:
+            with self.lock:
+                due = [self.last_sent.get(key, 0) + self.interval for key in self.pending]
+            timeout = max(0, min(due) - time.time()) if due else None
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is STOP:
+                self.flush(True)
+                return
+            if item is not None:
+                self.deliver(*item)
+            self.flush()
+
+    def flush(self, force=False):
+        '''Deliver the coalesced events whose interval is over'''
+        now = time.time()
+        with self.lock:
+            keys = [key for key in self.pending
+                    if force or now - self.last_sent.get(key, 0) >= self.interval]
+            items = []
+            for key in keys:
+                self.last_sent[key] = now
+                items.append((key[0], self.pending.pop(key), key[1]))
+        for item in items:
+            self.deliver(*item)
+
+    def deliver(self, event, args, wallet):
+        with self.lock:
+            callbacks = [callback for callback, w in self.callbacks[event]
+                         if w is None or wallet is None or w is wallet]
+            self.delivered += 1
+        for callback in callbacks:
+            try:
+                callback(event, *args)
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'triggered': self.triggered,
+                'delivered': self.delivered,
+                'coalesced': self.coalesced,
+                'dropped': self.dropped,
+                'queued': self.queue.qsize(),
+            }
@@ -41,6 +41,32 @@ from . import util
 from . import x509
 from . import pem
 
+# bounds and initial size of the window of unanswered requests; the
+# bounds can be set with the 'request_window_min' and
+# 'request_window_max' config options
+REQUEST_WINDOW_MIN = 10
+REQUEST_WINDOW_MAX = 1000
+REQUEST_WINDOW_INITIAL = 100
+# the window shrinks when responses take this much longer than the
+# fastest one seen of the same method, though not below its initial
+# size, and down to its min when this share of them are errors or when
+# requests time out
+RTT_INFLATION_LIMIT = 4
+ERROR_RATE_LIMIT = 0.1
+# requests per JSON-RPC batch, and the id of the batch sent to find out
+# whether the server accepts batches
+MAX_BATCH_SIZE = 100
+BATCH_PROBE_ID = 'batch'
+# requests whose round trip times score the server: pings and headers,
+# that every server gets and that take it about the same time, unlike
+# the wallet requests that only the main server answers
+SCORED_METHODS = {'server.version', 'blockchain.block.get_header'}
+# an interface is dropped when it has sent nothing for this many
+# seconds while requests are outstanding, or when this many of its
+# requests timed out in a row
+INTERFACE_TIMEOUT = 30
+MAX_TIMEOUTS = 3
+
 
 def Connection(server, queue, config_path):
     """Makes asynchronous connections to a remote electrum server.
@@ -247,7 +273,7 @@ class Interface(util.PrintError):
     - Member variable server.
     """
 
-    def __init__(self, server, socket):
+    def __init__(self, server, socket, window_min=REQUEST_WINDOW_MIN, window_max=REQUEST_WINDOW_MAX):
         self.server = server
         self.host, _, _ = server.rsplit(':', 2)
         self.socket = socket
@@ -258,10 +284,39 @@ class Interface(util.PrintError):
         self.debug = False
         self.unsent_requests = []
         self.unanswered_requests = {}
+        # window of unanswered requests, adapted to the round trip time
+        # and error rate of the responses
+        self.window_min = max(1, window_min)
+        self.window_max = max(self.window_min, window_max)
+        self.window = min(max(REQUEST_WINDOW_INITIAL, self.window_min), self.window_max)
+        self.send_time = {}
+        self.rtt = None
+        # method -> smoothed and fastest round trip time: a ping is
+        # answered much faster than a history
+        self.method_rtt = {}
+        self.min_rtt = {}
+        # round trip times not yet collected by the network
+        self.rtt_samples = []
+        self.error_rate = 0.
+        self.last_decrease = 0
+        # whether requests are sent in batches: None until the server
+        # has answered the probe, False to never send one
+        self.batch = None
+        self.batch_probe_sent = False
+        # NetworkMetrics of the network, if any
+        self.metrics = None
+        # requests that timed out and were sent again, maybe elsewhere,
+        # and how many did in a row
+        self.cancelled = set()
+        self.timeouts = 0
         # Set last ping to zero to ensure immediate ping
         self.last_request = time.time()
         self.last_ping = 0
         self.closed_remotely = False
+        # set by the network loop, which waits on it for work
+        self.fd = None
+        self.event = None
+        self.task = None
 
     def diagnostic_name(self):
         return self.host
@@ -282,31 +337,96 @@ class Interface(util.PrintError):
         '''Queue a request, later to be send with send_requests when the
         socket is available for writing.
         '''
-        self.request_time = time.time()
         self.unsent_requests.append(args)
+        if self.event is not None:
+            self.event.set()
 
     def num_requests(self):
-        '''Keep unanswered requests below 100'''
-        n = 100 - len(self.unanswered_requests)
-        return min(n, len(self.unsent_requests))
+        '''Keep unanswered requests within the window'''
+        n = int(self.window) - len(self.unanswered_requests)
+        return max(0, min(n, len(self.unsent_requests)))
+
+    def update_window(self, method, rtt, error):
+        '''Adapt the window to a response to method that took rtt
+        seconds.  It grows by one per response while requests wait for
+        room and responses come back about as fast as the fastest one
+        of their method, and shrinks by a quarter, at most once per
+        round trip, when they slow down or too many are errors.'''
+        smooth = lambda old: rtt if old is None else 0.875 * old + 0.125 * rtt
+        self.rtt = smooth(self.rtt)
+        method_rtt = self.method_rtt[method] = smooth(self.method_rtt.get(method))
+        min_rtt = self.min_rtt[method] = min(self.min_rtt.get(method, rtt), rtt)
+        self.error_rate = 0.9 * self.error_rate + 0.1 * bool(error)
+        if self.error_rate > ERROR_RATE_LIMIT:
+            self.shrink_window(self.window_min)
+        elif method_rtt > RTT_INFLATION_LIMIT * min_rtt:
+            # slow responses alone do not take it below its initial size
+            self.shrink_window(min(REQUEST_WINDOW_INITIAL, self.window_max))
+        elif self.unsent_requests:
+            # only grow a window that holds requests back
+            self.window = min(self.window_max, self.window + 1)
+
+    def shrink_window(self, floor):
+        now = time.time()
+        if self.window > floor and now - self.last_decrease > (self.rtt or 0):
+            self.window = max(self.window_min, floor, self.window * 0.75)
+            self.last_decrease = now
+
+    def add_timeout(self):
+        '''A request timed out and was sent again'''
+        self.timeouts += 1
+        self.shrink_window(self.window_min)
+
+    def window_status(self):
+        '''Window size and smoothed round trip time, for display'''
+        if self.rtt is None:
+            return '%d' % self.window
+        return '%d (%d ms)' % (self.window, self.rtt * 1000)
 
     def send_requests(self):
         '''Sends queued requests.  Returns False on failure.'''
+        try:
+            self.pipe.flush_send()
+        except BaseException as e:
+            self.print_error("pipe send error:", e)
+            return False
+        if self.pipe.send_buffer:
+            # the socket is full: queue no more until it takes the rest
+            return True
         make_dict = lambda m, p, i: {'method': m, 'params': p, 'id': i}
         n = self.num_requests()
         wire_requests = self.unsent_requests[0:n]
+        lines = [make_dict(*r) for r in wire_requests]
+        if self.batch and n > 1:
+            lines = [lines[i:i + MAX_BATCH_SIZE] for i in range(0, n, MAX_BATCH_SIZE)]
+        elif self.batch is None and not self.batch_probe_sent:
+            lines.append([make_dict('server.donation_address', [], BATCH_PROBE_ID)])
+            self.batch_probe_sent = True
         try:
-            self.pipe.send_all([make_dict(*r) for r in wire_requests])
+            self.pipe.send_all(lines)
         except BaseException as e:
             self.print_error("pipe send error:", e)
             return False
         self.unsent_requests = self.unsent_requests[n:]
+        now = time.time()
         for request in wire_requests:
             if self.debug:
                 self.print_error("-->", request)
             self.unanswered_requests[request[2]] = request
+            self.send_time[request[2]] = now
+            if self.metrics:
+                self.metrics.record_sent(request[0])
         return True
 
+    def cancel_request(self, wire_id):
+        '''Forget a request that timed out: it is not sent if it is
+        still queued, and its response, if it ever comes, is dropped'''
+        if self.unanswered_requests.pop(wire_id, None):
+            self.send_time.pop(wire_id, None)
+            self.cancelled.add(wire_id)
+        else:
+            self.unsent_requests = [r for r in self.unsent_requests if r[2] != wire_id]
+
     def ping_required(self):
         '''Maintains time since last ping.  Returns True if a ping should
         be sent.
@@ -318,12 +438,15 @@ class Interface(util.PrintError):
         return False
 
     def has_timed_out(self):
-        '''Returns True if the interface has timed out.'''
-        if (self.unanswered_requests and time.time() - self.request_time > 10
-            and self.pipe.idle_time() > 10):
+        '''Returns True if the interface has stopped answering: it has
+        been silent with requests outstanding, or several requests timed
+        out in a row.  Single slow requests are retried by the network.'''
+        if self.unanswered_requests and self.pipe.idle_time() > INTERFACE_TIMEOUT:
             self.print_error("timeout", len(self.unanswered_requests))
             return True
-
+        if self.timeouts >= MAX_TIMEOUTS:
+            self.print_error("%d requests timed out" % self.timeouts)
+            return True
         return False
 
     def get_responses(self):
@@ -341,28 +464,57 @@ class Interface(util.PrintError):
                 response = self.pipe.get()
             except util.timeout:
                 break
-            if not type(response) is dict:
-                responses.append((None, None))
-                if response is None:
-                    self.closed_remotely = True
-                    self.print_error("connection closed remotely")
-                break
-            if self.debug:
-                self.print_error("<--", response)
-            wire_id = response.get('id', None)
-            if wire_id is None:  # Notification
-                responses.append((None, response))
-            else:
-                request = self.unanswered_requests.pop(wire_id, None)
-                if request:
-                    responses.append((request, response))
-                else:
-                    self.print_error("unknown wire ID", wire_id)
-                    responses.append((None, None)) # Signal
+            if type(response) is list and response:
+                # a batch reply: its responses come in any order
+                if not all(self.add_response(r, responses) for r in response):
                     break
+            elif not self.add_response(response, responses):
+                break
 
         return responses
 
+    def add_response(self, response, responses):
+        '''Append the (request, response) pair of a response to
+        responses.  Returns False if no more should be read.'''
+        if not type(response) is dict:
+            responses.append((None, None))
+            if response is None:
+                self.closed_remotely = True
+                self.print_error("connection closed remotely")
+            return False
+        if self.debug:
+            self.print_error("<--", response)
+        wire_id = response.get('id', None)
+        if wire_id in self.cancelled:
+            # answered too late, and already sent again
+            self.cancelled.discard(wire_id)
+        elif wire_id == BATCH_PROBE_ID:
+            # even an error means that the batch was understood
+            self.batch = True
+            self.print_error("batch requests enabled")
+        elif wire_id is None and 'error' in response and self.batch is None and self.batch_probe_sent:
+            # the server does not understand batches
+            self.batch = False
+            self.print_error("batch requests not supported")
+        elif wire_id is None:  # Notification
+            responses.append((None, response))
+        else:
+            request = self.unanswered_requests.pop(wire_id, None)
+            if request:
+                self.timeouts = 0
+                rtt = time.time() - self.send_time.pop(wire_id)
+                self.update_window(request[0], rtt, response.get('error'))
+                if request[0] in SCORED_METHODS:
+                    self.rtt_samples.append(rtt)
+                if self.metrics:
+                    self.metrics.record_response(request[0], rtt, response.get('error'))
+                responses.append((request, response))
+            else:
+                self.print_error("unknown wire ID", wire_id)
+                responses.append((None, None)) # Signal
+                return False
+        return True
+
 
 def check_cert(host, cert):
     try:
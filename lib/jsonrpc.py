@@ -24,10 +24,14 @@
 # SOFTWARE.
 
 from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer, SimpleJSONRPCRequestHandler
+import jsonrpclib.config
 from base64 import b64decode
+from datetime import datetime
+from decimal import Decimal
 import time
 
 from . import util
+from .transaction import Transaction
 
 
 class RPCAuthCredentialsInvalid(Exception):
@@ -45,6 +49,16 @@ class RPCAuthUnsupportedType(Exception):
         return 'Authentication failed (only basic auth is supported)'
 
 
+def json_config():
+    """jsonrpclib configuration that encodes our objects like the rest
+    of Electrum, rather than as __jsonclass__ hints.  jsonrpclib picks
+    the fastest JSON backend it can import by itself."""
+    config = jsonrpclib.config.DEFAULT.copy()
+    for cls in (util.Satoshis, util.Fiat, Decimal, datetime, Transaction):
+        config.serialize_handlers[cls] = lambda obj, *args: util.json_default(obj)
+    return config
+
+
 # based on http://acooke.org/cute/BasicHTTPA0.html by andrew cooke
 class VerifyingJSONRPCServer(SimpleJSONRPCServer):
 
@@ -70,6 +84,7 @@ class VerifyingJSONRPCServer(SimpleJSONRPCServer):
                         myself.send_error(500, str(e))
                 return False
 
+        kargs.setdefault('config', json_config())
         SimpleJSONRPCServer.__init__(
             self, requestHandler=VerifyingRequestHandler, *args, **kargs)
 
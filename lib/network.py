@@ -24,27 +24,90 @@ import time
 import queue
 import os
 import stat
-import errno
 import random
 import re
-import select
+import asyncio
+import concurrent.futures
 from collections import defaultdict
 import threading
 import socket
 import json
+import sys
+import traceback
 
 import socks
 from . import util
 from . import bitcoin
 from .bitcoin import *
 from . import constants
-from .interface import Connection, Interface
+from .interface import Connection, Interface, REQUEST_WINDOW_MIN, REQUEST_WINDOW_MAX
 from . import blockchain
+from .event_bus import EventBus
+from .tx_cache import TxCache, TX_CACHE_SIZE
+from .verifier import MerkleCache
 from .version import ELECTRUM_VERSION, PROTOCOL_VERSION
 from .i18n import _
 
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
+# header chunks requested at once during catch-up, and per interface
+MAX_CHUNKS_IN_FLIGHT = 8
+MAX_CHUNKS_PER_INTERFACE = 2
+CHUNK_REQUEST_TIMEOUT = 30
+# seconds a sent client request or header request has to be answered;
+# it doubles with each of the retries
+REQUEST_TIMEOUT = 10
+# seconds to wait for a call run in the network thread
+NETWORK_CALL_TIMEOUT = 30
+MAX_REQUEST_RETRIES = 3
+# requests of the synchronizer and verifier, which would not ask again:
+# they are sent until answered, as on a reconnection
+RESENT_METHODS = {
+    'blockchain.scripthash.subscribe',
+    'blockchain.scripthash.get_history',
+    'blockchain.transaction.get',
+    'blockchain.transaction.get_merkle',
+}
+# client requests that only read, and that are sent again when a server
+# does not answer them in time.  Others, like a broadcast that the server
+# may have relayed already, wait for their answer until the caller gives
+# up.
+RETRIED_METHODS = RESENT_METHODS | {
+    'blockchain.block.get_header',
+    'blockchain.estimatefee',
+    'blockchain.relayfee',
+    'blockchain.scripthash.get_balance',
+    'blockchain.scripthash.listunspent',
+    'mempool.get_fee_histogram',
+    'server.banner',
+    'server.donation_address',
+}
+# headers requested at once when close to the tip, and heights probed
+# at once while searching for a fork point
+MAX_HEADERS_BATCH = 50
+SEARCH_PROBES = 4
+# the network loop wakes up on socket events and client requests, and
+# at least this often for timeouts, pings and thread jobs
+MAINTENANCE_INTERVAL = 0.5
+# client requests that any server on our chain can answer, and how many
+# of them may be waiting on a server other than the main one.  Address
+# histories are not: they must match the status announced by the main
+# server, which other servers may not have caught up with.
+ROUTED_METHODS = {
+    'blockchain.transaction.get',
+    'blockchain.transaction.get_merkle',
+}
+MAX_ROUTED_PER_INTERFACE = 20
+# server selection: round trip times kept per server, share of the
+# auxiliary connections made to servers picked at random rather than by
+# score, how often the main server is compared to the others, at the
+# earliest that long after it became the main one, and how many round
+# trip times both must have had measured since the start
+RTT_SAMPLES = 100
+EXPLORE_PROBABILITY = 0.25
+SERVER_SWITCH_INTERVAL = 600
+SERVER_SWITCH_SAMPLES = 10
+SERVER_STATS_SAVE_INTERVAL = 60
 
 
 def parse_servers(result):
@@ -149,12 +212,205 @@ def serialize_server(host, port, protocol):
     return str(':'.join([host, port, protocol]))
 
 
+class EventQueue(queue.Queue):
+    """A queue that wakes up the network loop when an item is put"""
+
+    def __init__(self, wakeup):
+        queue.Queue.__init__(self)
+        self.wakeup = wakeup
+
+    def put(self, item, block=True, timeout=None):
+        queue.Queue.put(self, item, block, timeout)
+        self.wakeup()
+
+
+class NetworkMetrics(object):
+    """Counters of what goes over the network, per method: requests
+    queued and sent, responses, errors and a histogram of their latency,
+    plus notifications, bytes and cache hits.  Read by getnetworkstats."""
+
+    # upper bounds, in seconds, of the latency histogram buckets
+    LATENCY_BUCKETS = (0.01, 0.03, 0.1, 0.3, 1, 3, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.methods = {}
+        self.notifications = defaultdict(int)
+        # of the interfaces that were closed
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        # cache name -> [hits, misses]
+        self.caches = defaultdict(lambda: [0, 0])
+
+    def method(self, method):
+        m = self.methods.get(method)
+        if m is None:
+            m = self.methods[method] = {
+                'queued': 0, 'sent': 0, 'responses': 0, 'errors': 0,
+                'latency_total': 0., 'latency_max': 0.,
+                'latency_histogram': [0] * (len(self.LATENCY_BUCKETS) + 1),
+            }
+        return m
+
+    def record_queued(self, method):
+        with self.lock:
+            self.method(method)['queued'] += 1
+
+    def record_sent(self, method):
+        with self.lock:
+            self.method(method)['sent'] += 1
+
+    def record_response(self, method, latency, error):
+        with self.lock:
+            m = self.method(method)
+            m['responses'] += 1
+            if error:
+                m['errors'] += 1
+            m['latency_total'] += latency
+            m['latency_max'] = max(m['latency_max'], latency)
+            i = 0
+            while i < len(self.LATENCY_BUCKETS) and latency > self.LATENCY_BUCKETS[i]:
+                i += 1
+            m['latency_histogram'][i] += 1
+
+    def record_notification(self, method):
+        with self.lock:
+            self.notifications[method] += 1
+
+    def record_cache(self, name, hit):
+        with self.lock:
+            self.caches[name][0 if hit else 1] += 1
+
+    def record_closed(self, interface):
+        with self.lock:
+            self.bytes_sent += interface.pipe.bytes_sent
+            self.bytes_received += interface.pipe.bytes_received
+
+    def get_methods(self):
+        labels = ['<=%gs' % b for b in self.LATENCY_BUCKETS] + ['>%gs' % self.LATENCY_BUCKETS[-1]]
+        out = {}
+        with self.lock:
+            for method, m in self.methods.items():
+                out[method] = {
+                    'queued': m['queued'],
+                    'sent': m['sent'],
+                    'responses': m['responses'],
+                    'errors': m['errors'],
+                    'latency_mean_ms': round(m['latency_total'] / m['responses'] * 1000, 3) if m['responses'] else None,
+                    'latency_max_ms': round(m['latency_max'] * 1000, 3),
+                    'latency_histogram': dict(zip(labels, m['latency_histogram'])),
+                }
+        return out
+
+
+class ServerStats(util.PrintError):
+    """What we measured of each server: connect time, round trip times,
+    timeouts and failed connections, and how many blocks its tip was
+    behind the best one.  Kept in the config dir across restarts, and
+    turned into a score, in seconds, to choose servers with."""
+
+    # seconds added to the score per failure or timeout, and per block
+    # of lag
+    FAILURE_PENALTY = 5
+    LAG_PENALTY = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.stats = self.read()
+        self.dirty = False
+        # server -> round trip times recorded since the start
+        self.fresh = defaultdict(int)
+
+    def read(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                stats = json.loads(f.read())
+            assert isinstance(stats, dict)
+            return stats
+        except:
+            return {}
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+        temp_path = "%s.tmp.%s" % (self.path, os.getpid())
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(self.stats, indent=4, sort_keys=True))
+            os.replace(temp_path, self.path)
+            self.dirty = False
+        except OSError as e:
+            self.print_error("cannot save server stats", e)
+
+    def get(self, server):
+        self.dirty = True
+        return self.stats.setdefault(server, {
+            'connect': None, 'rtts': [], 'failures': 0, 'lag': 0,
+        })
+
+    def record_connect(self, server, seconds):
+        s = self.get(server)
+        s['connect'] = seconds if s['connect'] is None else 0.75 * s['connect'] + 0.25 * seconds
+        # failures are forgiven over time
+        s['failures'] /= 2
+        s['seen'] = int(time.time())
+
+    def record_failure(self, server):
+        '''a failed connection attempt, or a timeout'''
+        self.get(server)['failures'] += 1
+
+    def record_rtts(self, server, rtts):
+        s = self.get(server)
+        s['rtts'] = (s['rtts'] + [round(x, 4) for x in rtts])[-RTT_SAMPLES:]
+        self.fresh[server] += len(rtts)
+
+    def record_lag(self, server, lag):
+        self.get(server)['lag'] = lag
+
+    def percentile(self, server, p):
+        rtts = sorted(self.stats.get(server, {}).get('rtts', []))
+        return rtts[min(len(rtts) - 1, len(rtts) * p // 100)] if rtts else None
+
+    def score(self, server):
+        '''Lower is better; None for servers we know nothing of'''
+        s = self.stats.get(server)
+        if not s or (s['connect'] is None and not s['rtts']):
+            return None if not s or not s['failures'] else s['failures'] * self.FAILURE_PENALTY
+        score = (s['connect'] or 0) / 4
+        if s['rtts']:
+            score += (self.percentile(server, 50) + self.percentile(server, 90)) / 2
+        score += s['failures'] * self.FAILURE_PENALTY
+        score += s['lag'] * self.LAG_PENALTY
+        return score
+
+    def pick(self, servers, explore=0, choices=3):
+        '''Pick one of servers: one at random with probability explore,
+        or if we know none of them, otherwise one of the best scored
+        choices.'''
+        servers = list(servers)
+        if not servers:
+            return None
+        scored = [(self.score(s), s) for s in servers]
+        scored = sorted((x for x in scored if x[0] is not None))
+        if not scored or random.random() < explore:
+            return random.choice(servers)
+        return random.choice(scored[:choices])[1]
+
+
 class Network(util.DaemonThread):
     """The Network class manages a set of connections to remote electrum
     servers, each connected socket is handled by an Interface() object.
     Connections are initiated by a Connection() thread which stops once
     the connection succeeds or fails.
 
+    The network thread runs an asyncio event loop, with one task per
+    interface that sends its queued requests and reads its responses
+    as the socket becomes ready.  Everything that touches the
+    interfaces and the blockchains runs in that thread.
+
     Our external API:
 
     - Member functions get_header(), get_interfaces(), get_local_height(),
@@ -168,6 +424,12 @@ class Network(util.DaemonThread):
         util.DaemonThread.__init__(self)
         self.config = SimpleConfig(config) if isinstance(config, dict) else config
         self.num_server = 10 if not self.config.get('oneserver') else 0
+        if self.config.get('json_codec'):
+            try:
+                util.set_json_codec(self.config.get('json_codec'))
+            except ValueError as e:
+                self.print_error(e)
+        self.print_error("json codec", util.json_codec.name)
         self.blockchains = blockchain.read_blockchains(self.config)
         self.print_error("blockchains", self.blockchains.keys())
         self.blockchain_index = config.get('blockchain_index', 0)
@@ -182,8 +444,17 @@ class Network(util.DaemonThread):
             except:
                 self.print_error('Warning: failed to parse server-string; falling back to random.')
                 self.default_server = None
+        self.server_stats = ServerStats(os.path.join(self.config.path, 'server_stats') if self.config.path else None)
+        self.server_stats_save_time = time.time()
+        self.metrics = NetworkMetrics()
+        # raw transactions, shared by the wallets
+        self.tx_cache = TxCache(os.path.join(self.config.path, 'tx_cache'),
+                                self.config.get('tx_cache_size', TX_CACHE_SIZE)) if self.config.path else None
+        # verified merkle branches, shared by the wallets
+        self.merkle_cache = MerkleCache(os.path.join(self.config.path, 'merkle_cache')) if self.config.path else None
+        self.server_switch_time = time.time()
         if not self.default_server:
-            self.default_server = pick_random_server()
+            self.default_server = self.server_stats.pick(filter_protocol(constants.net.DEFAULT_SERVERS, 's'))
         self.lock = threading.Lock()
         self.pending_sends = []
         self.message_id = 0
@@ -198,7 +469,7 @@ class Network(util.DaemonThread):
         self.subscriptions = defaultdict(list)
         self.sub_cache = {}
         # callbacks set by the GUI
-        self.callbacks = defaultdict(list)
+        self.events = EventBus()
 
         dir_path = os.path.join( self.config.path, 'certs')
         if not os.path.exists(dir_path):
@@ -207,9 +478,20 @@ class Network(util.DaemonThread):
 
         # subscriptions and requests
         self.subscribed_addresses = set()
+        # wallet, or None -> scripthash in bytes -> address
         self.h2addr = {}
         # Requests from client we've not seen a response to
         self.unanswered_requests = {}
+        # message id -> server, of those sent to another server than
+        # the main one
+        self.routed_requests = {}
+        # message id -> (server, attempt), for the deadlines of client
+        # requests
+        self.request_attempts = {}
+        self.request_check_time = 0
+        # chunk index -> retries
+        self.chunk_attempts = {}
+        self.max_routed = self.config.get('routed_requests_per_server', MAX_ROUTED_PER_INTERFACE)
         # retry times
         self.server_retry_time = time.time()
         self.nodes_retry_time = time.time()
@@ -220,26 +502,30 @@ class Network(util.DaemonThread):
         self.interfaces = {}
         self.auto_connect = self.config.get('auto_connect', True)
         self.connecting = set()
-        self.requested_chunks = set()
-        self.socket_queue = queue.Queue()
+        # server -> time its connection was started
+        self.connect_time = {}
+        # chunk index -> (catching up interface, server asked, request time)
+        self.requested_chunks = {}
+        # servers that do not take JSON-RPC batches
+        self.no_batch_servers = set()
+        self.max_chunks_in_flight = self.config.get('chunks_in_flight', MAX_CHUNKS_IN_FLIGHT)
+        # set up by run()
+        self.loop = None
+        self.wakeup_event = None
+        self.socket_queue = EventQueue(self.wakeup)
         self.start_network(deserialize_server(self.default_server)[2],
                            deserialize_proxy(self.config.get('proxy')))
 
-    def register_callback(self, callback, events):
-        with self.lock:
-            for event in events:
-                self.callbacks[event].append(callback)
+    def register_callback(self, callback, events, wallet=None):
+        '''Have callback(event, *args) called from the event thread.
+        With a wallet, the events about other wallets are left out.'''
+        self.events.register(callback, events, wallet)
 
     def unregister_callback(self, callback):
-        with self.lock:
-            for callbacks in self.callbacks.values():
-                if callback in callbacks:
-                    callbacks.remove(callback)
+        self.events.unregister(callback)
 
-    def trigger_callback(self, event, *args):
-        with self.lock:
-            callbacks = self.callbacks[event][:]
-        [callback(event, *args) for callback in callbacks]
+    def trigger_callback(self, event, *args, wallet=None):
+        self.events.trigger(event, *args, wallet=wallet)
 
     def read_recent_servers(self):
         if not self.config.path:
@@ -299,6 +585,7 @@ class Network(util.DaemonThread):
         self.message_id += 1
         if self.debug:
             self.print_error(interface.host, "-->", method, params, message_id)
+        self.metrics.record_queued(method)
         interface.queue_request(method, params, message_id)
         return message_id
 
@@ -308,12 +595,18 @@ class Network(util.DaemonThread):
         # Resend unanswered requests
         requests = self.unanswered_requests.values()
         self.unanswered_requests = {}
+        self.routed_requests = {}
+        self.request_attempts = {}
+        for interface in self.interfaces.values():
+            interface.routed = 0
         if self.interface.ping_required():
             params = [ELECTRUM_VERSION, PROTOCOL_VERSION]
             self.queue_request('server.version', params, self.interface)
         for request in requests:
             message_id = self.queue_request(request[0], request[1])
             self.unanswered_requests[message_id] = request
+            if request[0] in RETRIED_METHODS:
+                self.request_attempts[message_id] = self.interface.server, 0
         self.queue_request('server.banner', [])
         self.queue_request('server.donation_address', [])
         self.queue_request('server.peers.subscribe', [])
@@ -384,11 +677,15 @@ class Network(util.DaemonThread):
                 self.print_error("connecting to %s as new interface" % server)
                 self.set_status('connecting')
             self.connecting.add(server)
+            self.connect_time[server] = time.time()
             c = Connection(server, self.socket_queue, self.config.path)
 
     def start_random_interface(self):
-        exclude_set = self.disconnected_servers.union(set(self.interfaces))
-        server = pick_random_server(self.get_servers(), self.protocol, exclude_set)
+        '''Connect to another server, chosen by score, or sometimes at
+        random so that we learn about the others'''
+        exclude_set = self.disconnected_servers.union(set(self.interfaces), self.connecting)
+        servers = set(filter_protocol(self.get_servers(), self.protocol)) - exclude_set
+        server = self.server_stats.pick(servers, EXPLORE_PROBABILITY)
         if server:
             self.start_interface(server)
 
@@ -437,10 +734,14 @@ class Network(util.DaemonThread):
         assert self.interface is None
         assert not self.interfaces
         self.connecting = set()
+        self.connect_time = {}
         # Get a new queue - no old pending connections thanks!
-        self.socket_queue = queue.Queue()
+        self.socket_queue = EventQueue(self.wakeup)
 
     def set_parameters(self, host, port, protocol, proxy, auto_connect):
+        self.run_in_network_thread(self._set_parameters, host, port, protocol, proxy, auto_connect)
+
+    def _set_parameters(self, host, port, protocol, proxy, auto_connect):
         proxy_str = serialize_proxy(proxy)
         server = serialize_server(host, port, protocol)
         # sanitize parameters
@@ -470,12 +771,51 @@ class Network(util.DaemonThread):
             self.notify('updated')
 
     def switch_to_random_interface(self):
-        '''Switch to a random connected server other than the current one'''
+        '''Switch to one of the best connected servers other than the
+        current one'''
         servers = self.get_interfaces()    # Those in connected state
         if self.default_server in servers:
             servers.remove(self.default_server)
         if servers:
-            self.switch_to_interface(random.choice(servers))
+            self.switch_to_interface(self.server_stats.pick(servers, choices=1))
+
+    def switch_to_faster_interface(self):
+        '''If auto_connect, switch to a connected server that scores
+        less than half of the current one.  Only servers measured enough
+        since the start are compared.'''
+        if not self.auto_connect or not self.interface:
+            return
+        fresh = self.server_stats.fresh
+        if fresh[self.default_server] < SERVER_SWITCH_SAMPLES:
+            return
+        current = self.server_stats.score(self.default_server)
+        chain = self.interface.blockchain
+        candidates = [(self.server_stats.score(server), server)
+                      for server, i in self.interfaces.items()
+                      if i is not self.interface and i.blockchain is chain and i.mode == 'default'
+                      and fresh[server] >= SERVER_SWITCH_SAMPLES]
+        candidates = sorted(x for x in candidates if x[0] is not None)
+        if current is not None and candidates and candidates[0][0] < current / 2:
+            self.print_error("switching to faster server", candidates[0][1], "%.3f vs %.3f" % (candidates[0][0], current))
+            self.switch_to_interface(candidates[0][1])
+
+    def update_server_stats(self):
+        '''Collect the round trip times and lags of the interfaces'''
+        now = time.time()
+        tips = [i.tip for i in self.interfaces.values()]
+        best_tip = max(tips) if tips else 0
+        for server, interface in self.interfaces.items():
+            if interface.rtt_samples:
+                self.server_stats.record_rtts(server, interface.rtt_samples)
+                interface.rtt_samples = []
+            if interface.tip:
+                self.server_stats.record_lag(server, best_tip - interface.tip)
+        if now - self.server_switch_time > SERVER_SWITCH_INTERVAL:
+            self.server_switch_time = now
+            self.switch_to_faster_interface()
+        if now - self.server_stats_save_time > SERVER_STATS_SAVE_INTERVAL:
+            self.server_stats_save_time = now
+            self.server_stats.save()
 
     def switch_lagging_interface(self):
         '''If auto_connect and lagging, switch interface'''
@@ -484,7 +824,7 @@ class Network(util.DaemonThread):
             header = self.blockchain().read_header(self.get_local_height())
             filtered = list(map(lambda x:x[0], filter(lambda x: x[1].tip_header==header, self.interfaces.items())))
             if filtered:
-                choice = random.choice(filtered)
+                choice = self.server_stats.pick(filtered, choices=1)
                 self.switch_to_interface(choice)
 
     def switch_to_interface(self, server):
@@ -504,6 +844,7 @@ class Network(util.DaemonThread):
             # fixme: we don't want to close headers sub
             #self.close_interface(self.interface)
             self.interface = i
+            self.server_switch_time = time.time()
             self.send_subscriptions()
             self.set_status('connected')
             self.notify('updated')
@@ -514,6 +855,13 @@ class Network(util.DaemonThread):
                 self.interfaces.pop(interface.server)
             if interface.server == self.default_server:
                 self.interface = None
+            self.metrics.record_closed(interface)
+            if interface.task:
+                # stop watching the socket before it is closed
+                self.loop.remove_reader(interface.fd)
+                self.loop.remove_writer(interface.fd)
+                interface.task.cancel()
+                interface.task = None
             interface.close()
 
     def add_recent_server(self, server):
@@ -588,7 +936,11 @@ class Network(util.DaemonThread):
                 # and are placed in the unanswered_requests dictionary
                 client_req = self.unanswered_requests.pop(message_id, None)
                 if client_req:
-                    assert interface == self.interface
+                    self.request_attempts.pop(message_id, None)
+                    if self.routed_requests.pop(message_id, None):
+                        interface.routed -= 1
+                    else:
+                        assert interface == self.interface
                     callbacks = [client_req[2]]
                 else:
                     # fixme: will only work for subscriptions
@@ -609,6 +961,7 @@ class Network(util.DaemonThread):
                 # Rewrite response shape to match subscription request response
                 method = response.get('method')
                 params = response.get('params')
+                self.metrics.record_notification(method)
                 k = self.get_index(method, params)
                 if method == 'blockchain.headers.subscribe':
                     response['result'] = params[0]
@@ -624,28 +977,52 @@ class Network(util.DaemonThread):
             # Response is now in canonical form
             self.process_response(interface, response, callbacks)
 
-    def addr_to_scripthash(self, addr):
-        h = bitcoin.address_to_scripthash(addr)
-        if h not in self.h2addr:
-            self.h2addr[h] = addr
+    def addr_to_scripthash(self, addr, wallet=None, owner=None):
+        '''The scripthash of addr, remembered for the responses about
+        it.  A wallet gives the scripthashes of its addresses.  They are
+        kept for their owner, the wallet by default, and
+        forget_addresses frees them when it is done with them.'''
+        h = wallet.get_scripthash(addr) if wallet else bitcoin.address_to_scripthash(addr)
+        if owner is None:
+            owner = wallet
+        self.h2addr.setdefault(owner, {})[bytes.fromhex(h)] = addr
         return h
 
+    def get_address(self, h):
+        '''The address of scripthash h, if it is known'''
+        key = bytes.fromhex(h)
+        for h2addr in list(self.h2addr.values()):
+            addr = h2addr.get(key)
+            if addr is not None:
+                return addr
+
+    def forget_addresses(self, owner, addresses=None):
+        '''Free the scripthashes remembered for owner, or only those of
+        addresses'''
+        if addresses is None:
+            self.h2addr.pop(owner, None)
+            return
+        h2addr = self.h2addr.get(owner, {})
+        for h, addr in list(h2addr.items()):
+            if addr in addresses:
+                h2addr.pop(h, None)
+
     def overload_cb(self, callback):
         def cb2(x):
             x2 = x.copy()
             p = x2.pop('params')
-            addr = self.h2addr[p[0]]
+            addr = self.get_address(p[0])
             x2['params'] = [addr]
             callback(x2)
         return cb2
 
-    def subscribe_to_addresses(self, addresses, callback):
-        hashes = [self.addr_to_scripthash(addr) for addr in addresses]
+    def subscribe_to_addresses(self, addresses, callback, wallet=None):
+        hashes = [self.addr_to_scripthash(addr, wallet) for addr in addresses]
         msgs = [('blockchain.scripthash.subscribe', [x]) for x in hashes]
         self.send(msgs, self.overload_cb(callback))
 
-    def request_address_history(self, address, callback):
-        h = self.addr_to_scripthash(address)
+    def request_address_history(self, address, callback, wallet=None):
+        h = self.addr_to_scripthash(address, wallet)
         self.send([('blockchain.scripthash.get_history', [h])], self.overload_cb(callback))
 
     def send(self, messages, callback):
@@ -653,6 +1030,20 @@ class Network(util.DaemonThread):
         messages = list(messages)
         with self.lock:
             self.pending_sends.append((messages, callback))
+        self.wakeup()
+
+    async def request(self, method, params):
+        '''Send a client request like send() does, and wait for its
+        result.  To be awaited in the network loop.'''
+        future = self.loop.create_future()
+        def on_response(r):
+            if not future.done():
+                future.set_result(r)
+        self.send([(method, params)], on_response)
+        r = await future
+        if r.get('error'):
+            raise Exception(r.get('error'))
+        return r.get('result')
 
     def process_pending_sends(self):
         # Requests needs connectivity.  If we don't have an interface,
@@ -680,12 +1071,57 @@ class Network(util.DaemonThread):
                         r = None
                     else:
                         r = self.sub_cache.get(k)
+                        self.metrics.record_cache('sub_cache', r is not None)
                 if r is not None:
                     self.print_error("cache hit", k)
                     callback(r)
                 else:
-                    message_id = self.queue_request(method, params)
-                    self.unanswered_requests[message_id] = method, params, callback
+                    self.send_client_request(method, params, callback)
+
+    def send_client_request(self, method, params, callback, attempt=0, exclude=None):
+        interface = self.route_request(method, exclude)
+        message_id = self.queue_request(method, params, interface)
+        self.unanswered_requests[message_id] = method, params, callback
+        if method in RETRIED_METHODS:
+            self.request_attempts[message_id] = interface.server, attempt
+        if interface != self.interface:
+            self.routed_requests[message_id] = interface.server
+            interface.routed += 1
+
+    def route_request(self, method, exclude=None):
+        '''The interface to send a client request to: requests that do
+        not depend on the server go to the least busy server that
+        follows our chain, and the others to the main one.  A retry
+        avoids the server given as exclude when it can.'''
+        if method not in ROUTED_METHODS:
+            return self.interface
+        chain = self.interface.blockchain
+        load = lambda i: len(i.unsent_requests) + len(i.unanswered_requests)
+        best = None if self.interface.server == exclude else self.interface
+        for interface in self.interfaces.values():
+            if (interface is self.interface or interface.server == exclude
+                    or interface.mode != 'default'
+                    or chain is None or interface.blockchain is not chain
+                    or interface.tip < self.interface.tip
+                    or interface.routed >= self.max_routed):
+                continue
+            if best is None or load(interface) < load(best):
+                best = interface
+        return best or self.interface
+
+    def reroute_requests(self, server):
+        '''Send again the client requests that server did not answer'''
+        for message_id, s in list(self.routed_requests.items()):
+            if s != server:
+                continue
+            self.routed_requests.pop(message_id)
+            self.request_attempts.pop(message_id, None)
+            request = self.unanswered_requests.pop(message_id, None)
+            if request:
+                method, params, callback = request
+                with self.lock:
+                    self.pending_sends.append(([(method, params)], callback))
+                self.wakeup()
 
     def unsubscribe(self, callback):
         '''Unsubscribe a callback to free object references to enable GC.'''
@@ -704,22 +1140,47 @@ class Network(util.DaemonThread):
         if server == self.default_server:
             self.set_status('disconnected')
         if server in self.interfaces:
-            self.close_interface(self.interfaces[server])
+            interface = self.interfaces[server]
+            if interface.batch is None and interface.batch_probe_sent:
+                # do not probe again a server that went down before
+                # answering the batch probe
+                self.no_batch_servers.add(server)
+            interface.chunk_buffer = None
+            self.close_interface(interface)
+            self.reroute_requests(server)
             self.notify('interfaces')
         for b in self.blockchains.values():
             if b.catch_up == server:
                 b.catch_up = None
+        # fetch chunks this server still owed us from another one
+        for index, (origin, s, t) in list(self.requested_chunks.items()):
+            if s == server or origin.server == server:
+                self.requested_chunks.pop(index)
+                if origin.server != server and origin.chunk_buffer is not None:
+                    self.retry_chunk(origin, index)
 
     def new_interface(self, server, socket):
         # todo: get tip first, then decide which checkpoint to use.
         self.add_recent_server(server)
-        interface = Interface(server, socket)
+        interface = Interface(server, socket,
+                              self.config.get('request_window_min', REQUEST_WINDOW_MIN),
+                              self.config.get('request_window_max', REQUEST_WINDOW_MAX))
+        if not self.config.get('batch_requests', True) or server in self.no_batch_servers:
+            interface.batch = False
         interface.blockchain = None
         interface.tip_header = None
         interface.tip = 0
         interface.mode = 'default'
         interface.request = None
+        interface.metrics = self.metrics
+        # client requests routed to it, see route_request
+        interface.routed = 0
+        # reorder buffer of a pipelined chunk download, see request_chunks
+        interface.chunk_buffer = None
         self.interfaces[server] = interface
+        interface.fd = interface.fileno()
+        interface.event = asyncio.Event()
+        interface.task = self.loop.create_task(self.run_interface(interface))
         self.queue_request('blockchain.headers.subscribe', [], interface)
         if server == self.default_server:
             self.switch_to_interface(server)
@@ -732,15 +1193,20 @@ class Network(util.DaemonThread):
             server, socket = self.socket_queue.get()
             if server in self.connecting:
                 self.connecting.remove(server)
+            t = self.connect_time.pop(server, None)
             if socket:
+                if t is not None:
+                    self.server_stats.record_connect(server, time.time() - t)
                 self.new_interface(server, socket)
             else:
+                self.server_stats.record_failure(server)
                 self.connection_down(server)
 
         # Send pings and shut down stale interfaces
         # must use copy of values
         for interface in list(self.interfaces.values()):
             if interface.has_timed_out():
+                self.server_stats.record_failure(interface.server)
                 self.connection_down(interface.server)
             elif interface.ping_required():
                 params = [ELECTRUM_VERSION, PROTOCOL_VERSION]
@@ -771,48 +1237,168 @@ class Network(util.DaemonThread):
             #if self.config.is_fee_estimates_update_required():
                 #self.request_fee_estimates()
 
-    def request_chunk(self, interface, index):
+    def request_chunk(self, interface, index, origin=None):
         if index in self.requested_chunks:
             return
         interface.print_error("requesting chunk %d" % index)
-        self.requested_chunks.add(index)
+        self.requested_chunks[index] = (origin or interface, interface.server, time.time())
         self.queue_request('blockchain.block.get_chunk', [index], interface)
 
+    def request_chunks(self, interface, index):
+        '''Catch up interface.blockchain from chunk index on.  Up to
+        max_chunks_in_flight chunks are requested at once, spread over
+        the connected interfaces, and connected in order as they come in.'''
+        interface.chunk_buffer = {}
+        interface.chunk_next = index     # next chunk to request
+        interface.chunk_connect = index  # next chunk to connect
+        self.fill_chunk_requests(interface)
+
+    def chunk_servers(self, origin, index):
+        '''Interfaces able to serve chunk index for origin, least busy
+        first.  They must follow the chain being caught up, and only the
+        last chunk may be partial, so it must come from a server at
+        least as high as origin.'''
+        min_tip = min((index + 1) * 2016 - 1, origin.tip)
+        load = defaultdict(int)
+        for o, server, t in self.requested_chunks.values():
+            load[server] += 1
+        eligible = [i for i in self.interfaces.values()
+                    if i.blockchain is origin.blockchain and i.tip >= min_tip
+                    and load[i.server] < MAX_CHUNKS_PER_INTERFACE]
+        return sorted(eligible, key=lambda i: (load[i.server], i != origin))
+
+    def fill_chunk_requests(self, origin):
+        last = origin.tip // 2016
+        while origin.chunk_next <= last:
+            in_flight = len([1 for o, s, t in self.requested_chunks.values() if o == origin])
+            if in_flight + len(origin.chunk_buffer) >= self.max_chunks_in_flight:
+                break
+            request = self.requested_chunks.get(origin.chunk_next)
+            if request:
+                # already on its way, e.g. for the verifier
+                self.requested_chunks[origin.chunk_next] = (origin,) + request[1:]
+                origin.chunk_next += 1
+                continue
+            servers = self.chunk_servers(origin, origin.chunk_next)
+            if not servers:
+                break
+            self.request_chunk(servers[0], origin.chunk_next, origin)
+            origin.chunk_next += 1
+
+    def retry_chunk(self, origin, index, exclude=None):
+        servers = [i for i in self.chunk_servers(origin, index) if i.server != exclude]
+        if servers:
+            self.request_chunk(servers[0], index, origin)
+        elif origin.server in self.interfaces:
+            self.request_chunk(origin, index, origin)
+
     def on_get_chunk(self, interface, response):
         '''Handle receiving a chunk of block headers'''
         error = response.get('error')
         result = response.get('result')
         params = response.get('params')
-        blockchain = interface.blockchain
-        if result is None or params is None or error is not None:
+        if params is None:
             interface.print_error(error or 'bad response')
             return
         index = params[0]
+        request = self.requested_chunks.get(index)
         # Ignore unsolicited chunks
-        if index not in self.requested_chunks:
+        if request is None or request[1] != interface.server:
             interface.print_error("received chunk %d (unsolicited)" % index)
             return
-        else:
-            interface.print_error("received chunk %d" % index)
-        self.requested_chunks.remove(index)
+        self.requested_chunks.pop(index)
+        self.chunk_attempts.pop(index, None)
+        origin = request[0]
+        if result is None or error is not None:
+            interface.print_error(error or 'bad response')
+            self.connection_down(interface.server)
+            if origin.chunk_buffer is not None and origin.server in self.interfaces:
+                self.retry_chunk(origin, index)
+            return
+        interface.print_error("received chunk %d" % index)
+        if origin.chunk_buffer is not None and origin.chunk_connect <= index < origin.chunk_next:
+            origin.chunk_buffer[index] = (interface.server, result)
+            self.connect_chunks(origin)
+            return
+        # a single chunk, e.g. requested by the verifier
+        blockchain = interface.blockchain
         connect = blockchain.connect_chunk(index, result)
         if not connect:
             self.connection_down(interface.server)
             return
-        # If not finished, get the next chunk
-        if index >= len(blockchain.checkpoints) and blockchain.height() < interface.tip:
-            self.request_chunk(interface, index+1)
-        else:
-            interface.mode = 'default'
-            interface.print_error('catch up done', blockchain.height())
-            blockchain.catch_up = None
+        interface.mode = 'default'
+        interface.print_error('catch up done', blockchain.height())
+        blockchain.catch_up = None
         self.notify('updated')
 
+    def connect_chunks(self, origin):
+        '''Connect buffered chunks of a pipelined download in order'''
+        blockchain = origin.blockchain
+        while origin.chunk_connect in origin.chunk_buffer:
+            index = origin.chunk_connect
+            server, result = origin.chunk_buffer.pop(index)
+            if not blockchain.connect_chunk(index, result):
+                self.connection_down(server)
+                if origin.chunk_buffer is None or origin.server not in self.interfaces:
+                    return
+                self.retry_chunk(origin, index)
+                break
+            origin.chunk_connect += 1
+            self.notify('updated')
+        pending = [i for i, (o, s, t) in self.requested_chunks.items() if o == origin]
+        if blockchain.height() >= origin.tip and not pending and not origin.chunk_buffer:
+            origin.chunk_buffer = None
+            origin.mode = 'default'
+            origin.print_error('catch up done', blockchain.height())
+            blockchain.catch_up = None
+            self.notify('updated')
+            return
+        self.fill_chunk_requests(origin)
+        if not origin.chunk_buffer and not any(o == origin for o, s, t in self.requested_chunks.values()):
+            # nothing left to wait for, e.g. the tip moved within the
+            # last, partial chunk: get the rest header by header
+            origin.print_error('catching up with headers from', blockchain.height() + 1)
+            origin.chunk_buffer = None
+            self.request_headers(origin, self.catch_up_heights(origin, blockchain.height() + 1))
+
     def request_header(self, interface, height):
-        #interface.print_error("requesting header %d" % height)
-        self.queue_request('blockchain.block.get_header', [height], interface)
-        interface.request = height
+        self.request_headers(interface, [height])
+
+    def request_headers(self, interface, heights):
+        '''Request several headers at once.  They are handled together
+        by on_headers once all of them have arrived.'''
+        #interface.print_error("requesting headers", heights)
+        interface.request = {}
+        interface.request_ids = []
+        for height in heights:
+            message_id = self.queue_request('blockchain.block.get_header', [height], interface)
+            interface.request_ids.append(message_id)
+            interface.request[height] = None
         interface.req_time = time.time()
+        interface.req_attempt = 0
+
+    def catch_up_heights(self, interface, height):
+        return list(range(height, min(interface.tip, height + MAX_HEADERS_BATCH - 1) + 1))
+
+    def backward_heights(self, interface):
+        '''Heights probed next while looking back for a known header,
+        doubling the distance from the tip each time'''
+        heights = []
+        height = interface.bad
+        while len(heights) < SEARCH_PROBES and height > self.max_checkpoint():
+            delta = interface.tip - height
+            height = max(self.max_checkpoint(), min(height - 1, interface.tip - 2 * delta))
+            heights.append(height)
+        return heights
+
+    def binary_heights(self, interface):
+        '''Heights probed next to split the interval between the last
+        good and the first bad header'''
+        good, bad = interface.good, interface.bad
+        n = min(SEARCH_PROBES, bad - good - 1)
+        heights = sorted(set(good + (bad - good) * (i + 1) // (n + 1) for i in range(n)))
+        assert heights[0] >= self.max_checkpoint(), (interface.bad, interface.good)
+        return heights
 
     def on_get_header(self, interface, response):
         '''Handle receiving a single block header'''
@@ -822,70 +1408,85 @@ class Network(util.DaemonThread):
             self.connection_down(interface.server)
             return
         height = header.get('block_height')
-        if interface.request != height:
-            interface.print_error("unsolicited header",interface.request, height)
+        if not interface.request or interface.request.get(height, True) is not None:
+            interface.print_error("unsolicited header", interface.request, height)
             self.connection_down(interface.server)
             return
-        chain = blockchain.check_header(header)
+        interface.request[height] = header
+        if None in interface.request.values():
+            # wait for the rest of the batch
+            return
+        headers = [interface.request[h] for h in sorted(interface.request)]
+        self.on_headers(interface, headers)
+
+    def on_headers(self, interface, headers):
+        '''Handle a complete batch of requested headers, sorted by height'''
+        next_heights = []
         if interface.mode == 'backward':
-            can_connect = blockchain.can_connect(header)
-            if can_connect and can_connect.catch_up is None:
-                interface.mode = 'catch_up'
-                interface.blockchain = can_connect
-                interface.blockchain.save_header(header)
-                next_height = height + 1
-                interface.blockchain.catch_up = interface.server
-            elif chain:
-                interface.print_error("binary search")
-                interface.mode = 'binary'
-                interface.blockchain = chain
-                interface.good = height
-                next_height = (interface.bad + interface.good) // 2
-                assert next_height >= self.max_checkpoint(), (interface.bad, interface.good)
-            else:
-                if height == 0:
+            # probes are handled from the highest to the lowest
+            for header in reversed(headers):
+                height = header.get('block_height')
+                chain = blockchain.check_header(header)
+                can_connect = blockchain.can_connect(header)
+                if can_connect and can_connect.catch_up is None:
+                    interface.mode = 'catch_up'
+                    interface.blockchain = can_connect
+                    interface.blockchain.save_header(header)
+                    next_heights = self.catch_up_heights(interface, height + 1)
+                    interface.blockchain.catch_up = interface.server
+                    break
+                elif chain:
+                    interface.print_error("binary search")
+                    interface.mode = 'binary'
+                    interface.blockchain = chain
+                    interface.good = height
+                    next_heights = self.binary_heights(interface)
+                    break
+                elif height == 0:
                     self.connection_down(interface.server)
-                    next_height = None
+                    break
                 else:
                     interface.bad = height
                     interface.bad_header = header
-                    delta = interface.tip - height
-                    next_height = max(self.max_checkpoint(), interface.tip - 2 * delta)
+            else:
+                next_heights = self.backward_heights(interface)
+                if not next_heights:
+                    # nothing in common above the checkpoints
+                    self.connection_down(interface.server)
 
         elif interface.mode == 'binary':
-            if chain:
-                interface.good = height
-                interface.blockchain = chain
-            else:
-                interface.bad = height
-                interface.bad_header = header
+            for header in headers:
+                height = header.get('block_height')
+                chain = blockchain.check_header(header)
+                if chain:
+                    interface.good = height
+                    interface.blockchain = chain
+                else:
+                    interface.bad = height
+                    interface.bad_header = header
+                    break
             if interface.bad != interface.good + 1:
-                next_height = (interface.bad + interface.good) // 2
-                assert next_height >= self.max_checkpoint()
+                next_heights = self.binary_heights(interface)
             elif not interface.blockchain.can_connect(interface.bad_header, check_height=False):
                 self.connection_down(interface.server)
-                next_height = None
             else:
                 branch = self.blockchains.get(interface.bad)
                 if branch is not None:
                     if branch.check_header(interface.bad_header):
                         interface.print_error('joining chain', interface.bad)
-                        next_height = None
                     elif branch.parent().check_header(header):
                         interface.print_error('reorg', interface.bad, interface.tip)
                         interface.blockchain = branch.parent()
-                        next_height = None
                     else:
                         interface.print_error('checkpoint conflicts with existing fork', branch.path())
-                        branch.write('', 0)
+                        branch.write(b'', 0)
                         branch.save_header(interface.bad_header)
                         interface.mode = 'catch_up'
                         interface.blockchain = branch
-                        next_height = interface.bad + 1
+                        next_heights = self.catch_up_heights(interface, interface.bad + 1)
                         interface.blockchain.catch_up = interface.server
                 else:
                     bh = interface.blockchain.height()
-                    next_height = None
                     if bh > interface.good:
                         if not interface.blockchain.check_header(interface.bad_header):
                             b = interface.blockchain.fork(interface.bad_header)
@@ -893,32 +1494,34 @@ class Network(util.DaemonThread):
                             interface.blockchain = b
                             interface.print_error("new chain", b.checkpoint)
                             interface.mode = 'catch_up'
-                            next_height = interface.bad + 1
+                            next_heights = self.catch_up_heights(interface, interface.bad + 1)
                             interface.blockchain.catch_up = interface.server
                     else:
                         assert bh == interface.good
                         if interface.blockchain.catch_up is None and bh < interface.tip:
                             interface.print_error("catching up from %d"% (bh + 1))
                             interface.mode = 'catch_up'
-                            next_height = bh + 1
+                            next_heights = self.catch_up_heights(interface, bh + 1)
                             interface.blockchain.catch_up = interface.server
 
                 self.notify('updated')
 
         elif interface.mode == 'catch_up':
-            can_connect = interface.blockchain.can_connect(header)
-            if can_connect:
-                interface.blockchain.save_header(header)
-                next_height = height + 1 if height < interface.tip else None
-            else:
+            n = interface.blockchain.connect_headers(headers)
+            if n < len(headers):
                 # go back
+                header = headers[n]
+                height = header.get('block_height')
                 interface.print_error("cannot connect", height)
                 interface.mode = 'backward'
                 interface.bad = height
                 interface.bad_header = header
-                next_height = height - 1
+                next_heights = [height - 1]
+            else:
+                height = headers[-1].get('block_height')
+                next_heights = self.catch_up_heights(interface, height + 1) if height < interface.tip else []
 
-            if next_height is None:
+            if not next_heights:
                 # exit catch_up state
                 interface.print_error('catch up done', interface.blockchain.height())
                 interface.blockchain.catch_up = None
@@ -927,12 +1530,13 @@ class Network(util.DaemonThread):
 
         else:
             raise Exception(interface.mode)
-        # If not finished, get the next header
-        if next_height:
-            if interface.mode == 'catch_up' and interface.tip > next_height + 50:
-                self.request_chunk(interface, next_height // 2016)
+        # If not finished, get the next headers
+        if next_heights:
+            if interface.mode == 'catch_up' and interface.tip > next_heights[0] + 50:
+                interface.request = None
+                self.request_chunks(interface, next_heights[0] // 2016)
             else:
-                self.request_header(interface, next_height)
+                self.request_headers(interface, next_heights)
         else:
             interface.mode = 'default'
             interface.request = None
@@ -941,56 +1545,268 @@ class Network(util.DaemonThread):
         self.notify('interfaces')
 
     def maintain_requests(self):
+        '''Retry the requests that were not answered in time, with
+        growing deadlines.  A server is only dropped when a request
+        keeps timing out or when the interface looks dead, see
+        Interface.has_timed_out.'''
+        now = time.time()
         for interface in list(self.interfaces.values()):
-            if interface.request and time.time() - interface.request_time > 20:
-                interface.print_error("blockchain request timed out")
-                self.connection_down(interface.server)
-                continue
-
-    def wait_on_sockets(self):
-        # Python docs say Windows doesn't like empty selects.
-        # Sleep to prevent busy looping
-        if not self.interfaces:
-            time.sleep(0.1)
+            if (interface.request and None in interface.request.values()
+                    and now - interface.req_time > REQUEST_TIMEOUT * 2 ** interface.req_attempt):
+                if interface.req_attempt >= MAX_REQUEST_RETRIES:
+                    interface.print_error("blockchain request timed out")
+                    self.server_stats.record_failure(interface.server)
+                    self.connection_down(interface.server)
+                    continue
+                interface.print_error("retrying blockchain request")
+                for message_id in interface.request_ids:
+                    interface.cancel_request(message_id)
+                interface.add_timeout()
+                interface.req_attempt += 1
+                interface.req_time = now
+                for height, header in interface.request.items():
+                    if header is None:
+                        message_id = self.queue_request('blockchain.block.get_header', [height], interface)
+                        interface.request_ids.append(message_id)
+        # chunks that are late are asked to another server
+        for index, (origin, server, t) in list(self.requested_chunks.items()):
+            attempt = self.chunk_attempts.get(index, 0)
+            if now - t > CHUNK_REQUEST_TIMEOUT * 2 ** attempt and server in self.interfaces:
+                self.print_error("chunk %d request timed out" % index, server)
+                self.server_stats.record_failure(server)
+                if attempt >= MAX_REQUEST_RETRIES:
+                    self.connection_down(server)
+                    continue
+                self.interfaces[server].add_timeout()
+                self.requested_chunks.pop(index)
+                self.chunk_attempts[index] = attempt + 1
+                self.retry_chunk(origin, index, exclude=server)
+        # client requests are checked once a second, as there may be
+        # many of them
+        if now - self.request_check_time > 1:
+            self.request_check_time = now
+            self.retry_client_requests(now)
+
+    def retry_client_requests(self, now):
+        if not self.interface:
+            # they are sent again with the subscriptions
             return
-        rin = [i for i in self.interfaces.values()]
-        win = [i for i in self.interfaces.values() if i.num_requests()]
+        timed_out = set()
+        for message_id, (server, attempt) in list(self.request_attempts.items()):
+            interface = self.interfaces.get(server)
+            sent = interface.send_time.get(message_id) if interface else None
+            if sent is None or now - sent < REQUEST_TIMEOUT * 2 ** attempt:
+                # not sent yet, or answered meanwhile
+                continue
+            self.request_attempts.pop(message_id)
+            method, params, callback = self.unanswered_requests.pop(message_id)
+            interface.cancel_request(message_id)
+            timed_out.add(interface)
+            if self.routed_requests.pop(message_id, None):
+                interface.routed -= 1
+            if attempt >= MAX_REQUEST_RETRIES and method not in RESENT_METHODS:
+                interface.print_error("request timed out", method, params)
+                callback({'method': method, 'params': params, 'error': 'request timed out'})
+                continue
+            interface.print_error("retrying", method, params)
+            attempt = min(attempt + 1, MAX_REQUEST_RETRIES)
+            self.send_client_request(method, params, callback, attempt, exclude=server)
+        # requests sent together time out together: count them once
+        for interface in timed_out:
+            interface.add_timeout()
+
+    async def run_interface(self, interface):
+        '''Send the requests queued for interface and process its
+        responses, whenever its socket is ready'''
+        def on_readable():
+            interface.readable = True
+            interface.event.set()
+        interface.readable = False
+        self.loop.add_reader(interface.fd, on_readable)
+        while self.interfaces.get(interface.server) is interface:
+            while interface.num_requests() or interface.pipe.send_buffer:
+                await self.wait_writable(interface.fd)
+                if not interface.send_requests():
+                    self.connection_down(interface.server)
+                    return
+            await interface.event.wait()
+            interface.event.clear()
+            if interface.readable:
+                interface.readable = False
+                try:
+                    self.process_responses(interface)
+                except Exception:
+                    traceback.print_exc(file=sys.stderr)
+                    self.connection_down(interface.server)
+                    return
+                # callbacks may have queued client requests
+                self.wakeup()
+
+    async def wait_writable(self, fd):
+        future = self.loop.create_future()
+        def on_writable():
+            if not future.done():
+                future.set_result(None)
+        self.loop.add_writer(fd, on_writable)
         try:
-            rout, wout, xout = select.select(rin, win, [], 0.1)
-        except socket.error as e:
-            # TODO: py3, get code from e
-            code = None
-            if code == errno.EINTR:
+            await future
+        finally:
+            self.loop.remove_writer(fd)
+
+    def wakeup(self):
+        '''Wake up the network loop; may be called from any thread'''
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self.wakeup_event.set)
+            except RuntimeError:
+                # closed meanwhile
+                pass
+
+    def run_in_network_thread(self, f, *args):
+        '''Call f in the network thread, which owns the interfaces, and
+        return its result'''
+        loop = self.loop
+        if loop is None or not loop.is_running() or threading.current_thread() is self:
+            return f(*args)
+        future = concurrent.futures.Future()
+        def call():
+            if not future.set_running_or_notify_cancel():
                 return
-            raise
-        assert not xout
-        for interface in wout:
-            interface.send_requests()
-        for interface in rout:
-            self.process_responses(interface)
+            try:
+                future.set_result(f(*args))
+            except BaseException as e:
+                future.set_exception(e)
+        try:
+            loop.call_soon_threadsafe(call)
+        except RuntimeError:
+            # closed meanwhile
+            return f(*args)
+        deadline = time.time() + NETWORK_CALL_TIMEOUT
+        while True:
+            try:
+                return future.result(0.1)
+            except concurrent.futures.TimeoutError:
+                pass
+            if not loop.is_running() and future.cancel():
+                # the loop stopped before getting to it
+                return f(*args)
+            if time.time() > deadline:
+                future.cancel()
+                raise util.TimeoutException(_('Network thread did not answer'))
+
+    def stop(self):
+        util.DaemonThread.stop(self)
+        self.wakeup()
+
+    def get_network_stats(self):
+        '''Request counts and latencies per method, bytes, queue depths
+        and cache hit rates'''
+        return self.run_in_network_thread(self._get_network_stats)
+
+    def _get_network_stats(self):
+        m = self.metrics
+        interfaces = {}
+        for server, i in self.interfaces.items():
+            interfaces[server] = {
+                'unsent': len(i.unsent_requests),
+                'in_flight': len(i.unanswered_requests),
+                'window': int(i.window),
+                'rtt_ms': round(i.rtt * 1000, 3) if i.rtt is not None else None,
+                'bytes_sent': i.pipe.bytes_sent,
+                'bytes_received': i.pipe.bytes_received,
+            }
+        caches = {}
+        with m.lock:
+            for name, (hits, misses) in m.caches.items():
+                caches[name] = {'hits': hits, 'misses': misses}
+        caches.setdefault('sub_cache', {'hits': 0, 'misses': 0})['size'] = len(self.sub_cache)
+        for name, cache in [('tx_cache', self.tx_cache), ('merkle_cache', self.merkle_cache)]:
+            if cache:
+                caches[name] = {'hits': cache.hits, 'misses': cache.misses, 'size': len(cache.entries)}
+        for c in caches.values():
+            total = c['hits'] + c['misses']
+            c['hit_rate'] = round(c['hits'] / total, 4) if total else None
+        methods = m.get_methods()
+        return {
+            'uptime': round(time.time() - m.start_time),
+            'requests': sum(x['sent'] for x in methods.values()),
+            'responses': sum(x['responses'] for x in methods.values()),
+            'errors': sum(x['errors'] for x in methods.values()),
+            'notifications': sum(m.notifications.values()),
+            'bytes_sent': m.bytes_sent + sum(x['bytes_sent'] for x in interfaces.values()),
+            'bytes_received': m.bytes_received + sum(x['bytes_received'] for x in interfaces.values()),
+            'unsent': sum(x['unsent'] for x in interfaces.values()),
+            'in_flight': sum(x['in_flight'] for x in interfaces.values()),
+            'unanswered_client_requests': len(self.unanswered_requests),
+            'pending_sends': len(self.pending_sends),
+            'methods': methods,
+            'notifications_by_method': dict(m.notifications),
+            'interfaces': interfaces,
+            'caches': caches,
+            'events': self.events.get_stats(),
+        }
 
     def init_headers_file(self):
         b = self.blockchains[0]
         filename = b.path()
         length = 80 * len(constants.net.CHECKPOINTS) * 2016
         if not os.path.exists(filename) or os.path.getsize(filename) < length:
+            # the hash index and targets of the old file go with it
+            b.ranges[0][0].remove()
             with open(filename, 'wb') as f:
                 if length>0:
                     f.seek(length-1)
                     f.write(b'\x00')
+            with b.lock:
+                b.update_size()
+            blockchain.index_headers()
+            return
         with b.lock:
             b.update_size()
 
     def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.wakeup_event = asyncio.Event()
+        self.loop = loop
         self.init_headers_file()
+        try:
+            loop.run_until_complete(self.main_loop())
+            self.update_server_stats()
+            self.stop_network()
+            self.server_stats.save()
+            if self.merkle_cache:
+                self.merkle_cache.close()
+            self.flush_headers(True)
+            self.events.close()
+            # let the cancelled interface tasks finish
+            tasks = [t for t in asyncio.all_tasks(loop) if not t.done()] if hasattr(asyncio, 'all_tasks') \
+                else [t for t in asyncio.Task.all_tasks(loop) if not t.done()]
+            if tasks:
+                loop.run_until_complete(asyncio.wait(tasks))
+        finally:
+            self.loop = None
+            loop.close()
+        self.on_stop()
+
+    async def main_loop(self):
         while self.is_running():
             self.maintain_sockets()
-            self.wait_on_sockets()
             self.maintain_requests()
+            self.update_server_stats()
             self.run_jobs()    # Synchronizer and Verifier
             self.process_pending_sends()
-        self.stop_network()
-        self.on_stop()
+            self.flush_headers()
+            try:
+                await asyncio.wait_for(self.wakeup_event.wait(), MAINTENANCE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup_event.clear()
+
+    def flush_headers(self, force=False):
+        for b in list(self.blockchains.values()):
+            b.flush(force)
 
 
     def on_notify_header(self, interface, header):
@@ -1050,6 +1866,9 @@ class Network(util.DaemonThread):
         return out
 
     def follow_chain(self, index):
+        self.run_in_network_thread(self._follow_chain, index)
+
+    def _follow_chain(self, index):
         blockchain = self.blockchains.get(index)
         if blockchain:
             self.blockchain_index = index
@@ -1071,6 +1890,15 @@ class Network(util.DaemonThread):
         return self.blockchain().height()
 
     def synchronous_get(self, request, timeout=30):
+        loop = self.loop
+        if loop is not None and loop.is_running() and threading.current_thread() is not self:
+            future = asyncio.run_coroutine_threadsafe(self.request(*request), loop)
+            try:
+                return future.result(timeout)
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                raise util.TimeoutException(_('Server did not answer'))
+        # not started yet: sent once the loop runs
         q = queue.Queue()
         self.send([request], q.put)
         try:
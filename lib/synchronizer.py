@@ -24,11 +24,33 @@
 # SOFTWARE.
 from threading import Lock
 import hashlib
+import heapq
 
 # from .bitcoin import Hash, hash_encode
 from .transaction import Transaction
 from .util import ThreadJob, bh2u
 
+# addresses subscribed to, and transactions downloaded, at once
+MAX_ADDRESS_REQUESTS = 1000
+MAX_TX_REQUESTS = 100
+
+
+def tx_priority(tx_height):
+    '''Sort key of the transactions to download: unconfirmed ones
+    first, then the most recent'''
+    return (tx_height > 0, -tx_height)
+
+
+def history_status(h):
+    '''The status of an address history, as announced by servers: the
+    sha256 of its "tx_hash:height:" items, or None if it is empty'''
+    if not h:
+        return None
+    status = hashlib.sha256()
+    for tx_hash, height in h:
+        status.update(('%s:%d:' % (tx_hash, height)).encode('ascii'))
+    return bh2u(status.digest())
+
 
 class Synchronizer(ThreadJob):
     '''The synchronizer keeps the wallet up-to-date with its set of
@@ -38,6 +60,9 @@ class Synchronizer(ThreadJob):
     we don't have the full history of, and requests binary transaction
     data of any transactions the wallet doesn't have.
 
+    Addresses with a recent history and recent transactions are asked
+    for first, and only so many requests are in flight at once.
+
     External interface: __init__() and add() member functions.
     '''
 
@@ -45,11 +70,19 @@ class Synchronizer(ThreadJob):
         self.wallet = wallet
         self.network = network
         self.new_addresses = set()
-        # Entries are (tx_hash, tx_height) tuples
+        # Entries are (tx_hash, tx_height) tuples, of the transactions
+        # queued or in flight
         self.requested_tx = {}
         self.requested_histories = {}
         self.requested_addrs = set()
         self.lock = Lock()
+        # heaps of (priority, address) and (priority, tx_hash) waiting
+        # for a request
+        self.addr_queue = []
+        self.tx_queue = []
+        self.tx_in_flight = set()
+        self.addresses_done = 0
+        self.progress = None
 
         self.initialized = False
         self.initialize()
@@ -62,28 +95,54 @@ class Synchronizer(ThreadJob):
 
     def is_up_to_date(self):
         return (not self.requested_tx and not self.requested_histories
-                and not self.requested_addrs)
+                and not self.requested_addrs and not self.addr_queue)
+
+    def is_balance_ready(self):
+        '''Whether every address has a history and every confirmed
+        transaction is in: the confirmed balance is known even though
+        unconfirmed transactions may still be coming'''
+        return (not self.requested_histories and not self.requested_addrs
+                and not self.addr_queue
+                and all(height <= 0 for height in self.requested_tx.values()))
+
+    def get_progress(self):
+        '''(addresses done, addresses, transactions remaining)'''
+        total = self.addresses_done + len(self.requested_addrs) + len(self.addr_queue)
+        return self.addresses_done, total, len(self.requested_tx)
 
     def release(self):
         self.network.unsubscribe(self.on_address_status)
+        self.network.forget_addresses(self.wallet)
 
     def add(self, address):
         '''This can be called from the proxy or GUI threads.'''
         with self.lock:
             self.new_addresses.add(address)
 
+    def address_priority(self, addr):
+        '''Addresses with unconfirmed or recent transactions first, and
+        those without history last'''
+        history = self.wallet.history.get(addr)
+        if not history or history == ['*']:
+            return (True,)
+        return (False,) + min(tx_priority(height) for tx_hash, height in history)
+
     def subscribe_to_addresses(self, addresses):
+        for addr in addresses:
+            heapq.heappush(self.addr_queue, (self.address_priority(addr), addr))
+        self.send_address_requests()
+
+    def send_address_requests(self):
+        addresses = set()
+        while self.addr_queue and len(self.requested_addrs) + len(addresses) < MAX_ADDRESS_REQUESTS:
+            addresses.add(heapq.heappop(self.addr_queue)[1])
+        addresses -= self.requested_addrs
         if addresses:
             self.requested_addrs |= addresses
-            self.network.subscribe_to_addresses(addresses, self.on_address_status)
+            self.network.subscribe_to_addresses(addresses, self.on_address_status, self.wallet)
 
     def get_status(self, h):
-        if not h:
-            return None
-        status = ''
-        for tx_hash, height in h:
-            status += tx_hash + ':%d:' % height
-        return bh2u(hashlib.sha256(status.encode('ascii')).digest())
+        return history_status(h)
 
     def on_address_status(self, response):
         if self.wallet.synchronizer is None and self.initialized:
@@ -92,14 +151,14 @@ class Synchronizer(ThreadJob):
         if not params:
             return
         addr = params[0]
-        history = self.wallet.history.get(addr, [])
-        if self.get_status(history) != result:
+        if self.wallet.get_address_status(addr) != result:
             if self.requested_histories.get(addr) is None:
                 self.requested_histories[addr] = result
-                self.network.request_address_history(addr, self.on_address_history)
+                self.network.request_address_history(addr, self.on_address_history, self.wallet)
         # remove addr from list only after it is added to requested_histories
         if addr in self.requested_addrs:  # Notifications won't be in
             self.requested_addrs.remove(addr)
+            self.addresses_done += 1
 
     def on_address_history(self, response):
         if self.wallet.synchronizer is None and self.initialized:
@@ -138,6 +197,8 @@ class Synchronizer(ThreadJob):
     def tx_response(self, response):
         if self.wallet.synchronizer is None and self.initialized:
             return  # we have been killed, this was just an orphan callback
+        if response.get('params'):
+            self.tx_in_flight.discard(response['params'][0])
         params, result = self.parse_response(response)
         if not params:
             return
@@ -149,27 +210,47 @@ class Synchronizer(ThreadJob):
         except Exception:
             self.print_msg("cannot deserialize transaction, skipping", tx_hash)
             return
+        if self.network.tx_cache:
+            self.network.tx_cache.put(tx_hash, result)
         tx_height = self.requested_tx.pop(tx_hash)
         self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
         self.print_error("received tx %s height: %d bytes: %d" %
                          (tx_hash, tx_height, len(tx.raw)))
         # callbacks
-        self.network.trigger_callback('new_transaction', tx)
+        self.network.trigger_callback('new_transaction', tx, wallet=self.wallet)
         if not self.requested_tx:
             self.network.trigger_callback('updated')
 
 
     def request_missing_txs(self, hist):
+        self.queue_missing_txs(hist)
+        self.send_tx_requests()
+
+    def queue_missing_txs(self, hist):
         # "hist" is a list of [tx_hash, tx_height] lists
-        requests = []
+        tx_cache = self.network.tx_cache
         for tx_hash, tx_height in hist:
             if tx_hash in self.requested_tx:
                 continue
             if tx_hash in self.wallet.transactions:
                 continue
-            requests.append(('blockchain.transaction.get', [tx_hash]))
             self.requested_tx[tx_hash] = tx_height
-        self.network.send(requests, self.tx_response)
+            raw = tx_cache.get(tx_hash) if tx_cache else None
+            if raw:
+                self.tx_response({'params': [tx_hash], 'result': raw})
+                continue
+            heapq.heappush(self.tx_queue, (tx_priority(tx_height), tx_hash))
+
+    def send_tx_requests(self):
+        requests = []
+        while self.tx_queue and len(self.tx_in_flight) < MAX_TX_REQUESTS:
+            priority, tx_hash = heapq.heappop(self.tx_queue)
+            if tx_hash not in self.requested_tx or tx_hash in self.tx_in_flight:
+                continue
+            self.tx_in_flight.add(tx_hash)
+            requests.append(('blockchain.transaction.get', [tx_hash]))
+        if requests:
+            self.network.send(requests, self.tx_response)
 
 
     def initialize(self):
@@ -183,7 +264,8 @@ class Synchronizer(ThreadJob):
             # remain in old wallets.
             if history == ['*']:
                 continue
-            self.request_missing_txs(history)
+            self.queue_missing_txs(history)
+        self.send_tx_requests()
 
         if self.requested_tx:
             self.print_error("missing tx", self.requested_tx)
@@ -200,9 +282,14 @@ class Synchronizer(ThreadJob):
             addresses = self.new_addresses
             self.new_addresses = set()
         self.subscribe_to_addresses(addresses)
+        self.send_tx_requests()
 
         # 3. Detect if situation has changed
         up_to_date = self.is_up_to_date()
         if up_to_date != self.wallet.is_up_to_date():
             self.wallet.set_up_to_date(up_to_date)
             self.network.trigger_callback('updated')
+        progress = self.get_progress()
+        if progress != self.progress:
+            self.progress = progress
+            self.network.trigger_callback('sync_progress', *progress, wallet=self.wallet)
@@ -0,0 +1,357 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from lib import blockchain
+from lib import constants
+from lib.blockchain import Blockchain, serialize_header, hash_header
+from lib.simple_config import SimpleConfig
+from lib.util import bfh
+
+from . import TestCaseForTestnet
+
+
+def make_headers(first_height, prev_hash, count, nonce=0):
+    headers = []
+    for height in range(first_height, first_height + count):
+        header = {
+            'version': 2,
+            'prev_block_hash': prev_hash,
+            'merkle_root': '%064x' % (height + 1),
+            'timestamp': 1500000000 + 55 * height,
+            'bits': 0x1e0fffff,
+            'nonce': nonce,
+            'block_height': height,
+        }
+        prev_hash = hash_header(header)
+        headers.append(header)
+    return headers
+
+
+def to_chunk(headers):
+    return b''.join(bfh(serialize_header(h)) for h in headers)
+
+
+class TestBlockchain(TestCaseForTestnet):
+
+    def setUp(self):
+        super().setUp()
+        self.electrum_path = tempfile.mkdtemp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        blockchain.blockchains.clear()
+        open(os.path.join(self.config.path, 'blockchain_headers'), 'wb').close()
+        blockchain.read_blockchains(self.config)
+        self.chain = blockchain.blockchains[0]
+        self.headers = make_headers(0, '00' * 32, 30)
+        self.chain.save_chunk(0, to_chunk(self.headers))
+
+    def tearDown(self):
+        super().tearDown()
+        for store in blockchain.segments.values():
+            store.close()
+        blockchain.segments.clear()
+        blockchain.blockchains.clear()
+        shutil.rmtree(self.electrum_path)
+
+    def test_read_header(self):
+        self.assertEqual(29, self.chain.height())
+        for h in self.headers:
+            self.assertEqual(h, self.chain.read_header(h['block_height']))
+        self.assertIsNone(self.chain.read_header(30))
+        self.assertIsNone(self.chain.read_header(-1))
+
+    def test_read_header_returns_copy(self):
+        self.chain.read_header(5)['nonce'] = 42
+        self.assertEqual(self.headers[5], self.chain.read_header(5))
+
+    def test_get_hash(self):
+        for h in self.headers[1:]:
+            self.assertEqual(hash_header(h), self.chain.get_hash(h['block_height']))
+        self.assertEqual('0' * 64, self.chain.get_hash(30))
+
+    def test_write_invalidates_cache(self):
+        self.chain.read_header(20)
+        self.chain.get_hash(20)
+        other = make_headers(20, hash_header(self.headers[19]), 5, nonce=1)
+        self.chain.write(to_chunk(other), 20 * 80)
+        self.assertEqual(24, self.chain.height())
+        self.assertEqual(other[0], self.chain.read_header(20))
+        self.assertEqual(hash_header(other[0]), self.chain.get_hash(20))
+        self.assertIsNone(self.chain.read_header(25))
+
+    def test_fork_and_swap_with_parent(self):
+        fork_headers = make_headers(25, hash_header(self.headers[24]), 3, nonce=1)
+        fork = self.chain.fork(fork_headers[0])
+        blockchain.blockchains[fork.checkpoint] = fork
+        self.assertEqual(25, fork.height())
+        self.assertEqual(self.headers[24], fork.read_header(24))
+        for h in fork_headers[1:]:
+            self.assertTrue(fork.can_connect(h))
+            fork.save_header(h)
+        # still shorter than the parent branch (25..29)
+        self.assertIs(fork, blockchain.blockchains[25])
+        more = make_headers(28, hash_header(fork_headers[-1]), 3, nonce=1)
+        for h in more:
+            fork.save_header(h)
+        # the fork became the main chain
+        self.assertIs(fork, blockchain.blockchains[0])
+        self.assertEqual(30, fork.height())
+        for h in self.headers[:25] + fork_headers + more:
+            self.assertEqual(h, fork.read_header(h['block_height']))
+        old = blockchain.blockchains[25]
+        self.assertEqual(29, old.height())
+        for h in self.headers:
+            self.assertEqual(h, old.read_header(h['block_height']))
+
+    def test_hash_index(self):
+        store = self.chain.ranges[0][0]
+        store.flush(True)
+        self.assertEqual(30 * 32, os.path.getsize(store.index_path()))
+        for h in self.headers:
+            self.assertEqual(hash_header(h), blockchain.hash_encode(store.get_raw_hash(h['block_height'])))
+
+    def test_hash_index_rebuilt(self):
+        store = self.chain.ranges[0][0]
+        store.flush(True)
+        store.close()
+        with open(store.index_path(), 'rb+') as f:
+            f.truncate(10 * 32)
+        store.open()
+        self.assertEqual(30 * 32, os.path.getsize(store.index_path()))
+        store.close()
+        os.unlink(store.index_path())
+        store.open()
+        for h in self.headers[1:]:
+            self.assertEqual(hash_header(h), self.chain.get_hash(h['block_height']))
+
+    def make_fork(self, count=6):
+        fork_headers = make_headers(25, hash_header(self.headers[24]), count, nonce=1)
+        fork = self.chain.fork(fork_headers[0])
+        for h in fork_headers[1:]:
+            fork.save_header(h)
+        return fork, fork_headers
+
+    def test_swap_does_not_copy(self):
+        main_store = self.chain.ranges[0][0]
+        fork, fork_headers = self.make_fork()
+        fork_store = fork.ranges[-1][0]
+        self.assertIs(fork, blockchain.blockchains[0])
+        old = blockchain.blockchains[25]
+        self.assertEqual([(main_store, 0, 25), (fork_store, 25, None)], fork.ranges)
+        self.assertEqual([(main_store, 25, None)], old.ranges)
+        self.assertEqual(0, old.parent_id)
+        self.chain.flush(True)
+        fork.flush(True)
+        self.assertEqual(30 * 80, os.path.getsize(main_store.path))
+        self.assertEqual(6 * 80, os.path.getsize(fork_store.path))
+        for h in fork_headers:
+            self.assertEqual(hash_header(h), fork.get_hash(h['block_height']))
+        for h in self.headers[25:]:
+            self.assertEqual(hash_header(h), old.get_hash(h['block_height']))
+
+    def test_fork_of_promoted_fork(self):
+        fork, fork_headers = self.make_fork()
+        # a fork of the old branch moves along with it
+        other = make_headers(27, hash_header(self.headers[26]), 1, nonce=2)
+        old = blockchain.blockchains[25]
+        child = old.fork(other[0])
+        self.assertEqual(25, child.parent_id)
+        self.assertEqual(self.headers[26], child.read_header(26))
+        self.assertEqual(fork_headers[0], child.parent().parent().read_header(25))
+        # the old branch takes over again once it is longer
+        more = make_headers(30, hash_header(self.headers[29]), 2)
+        for h in more:
+            old.save_header(h)
+        self.assertIs(old, blockchain.blockchains[0])
+        self.assertIs(fork, blockchain.blockchains[25])
+        self.assertEqual(0, child.parent_id)
+        self.assertEqual(31, old.height())
+        for h in self.headers + more:
+            self.assertEqual(h, old.read_header(h['block_height']))
+        # adjacent ranges of a segment are merged back
+        self.assertEqual([(self.chain.ranges[0][0], 0, None)], old.ranges)
+
+    def test_chains_persisted(self):
+        fork, fork_headers = self.make_fork()
+        self.chain.flush(True)
+        fork.flush(True)
+        blockchain.read_blockchains(self.config)
+        self.assertEqual([0, 25], sorted(blockchain.blockchains.keys()))
+        main, old = blockchain.blockchains[0], blockchain.blockchains[25]
+        self.assertEqual(30, main.height())
+        self.assertEqual(29, old.height())
+        for h in self.headers[:25] + fork_headers:
+            self.assertEqual(h, main.read_header(h['block_height']))
+        for h in self.headers:
+            self.assertEqual(h, old.read_header(h['block_height']))
+
+    def test_swap_flushes_headers(self):
+        fork, fork_headers = self.make_fork()
+        # a crash after the swap loses the buffered headers only
+        for store in blockchain.segments.values():
+            store._buffer, store._buffer_hashes = bytearray(), bytearray()
+            store.close()
+        blockchain.segments.clear()
+        blockchain.read_blockchains(self.config)
+        main, old = blockchain.blockchains[0], blockchain.blockchains[25]
+        for h in self.headers[1:25] + fork_headers[:-1]:
+            self.assertEqual(h, main.read_header(h['block_height']))
+            self.assertEqual(hash_header(h), main.get_hash(h['block_height']))
+        for h in self.headers[25:]:
+            self.assertEqual(h, old.read_header(h['block_height']))
+
+    def test_legacy_fork_files(self):
+        fork_headers = make_headers(25, hash_header(self.headers[24]), 3, nonce=1)
+        self.chain.flush(True)
+        fdir = os.path.join(self.config.path, 'forks')
+        with open(os.path.join(fdir, 'fork_0_25'), 'wb') as f:
+            f.write(to_chunk(fork_headers))
+        open(os.path.join(fdir, 'fork_0_20.hashes'), 'wb').close()
+        os.unlink(blockchain.metadata_path(self.config))
+        blockchain.read_blockchains(self.config)
+        self.assertEqual([0, 25], sorted(blockchain.blockchains.keys()))
+        fork = blockchain.blockchains[25]
+        self.assertEqual(27, fork.height())
+        for h in fork_headers:
+            self.assertEqual(h, fork.read_header(h['block_height']))
+        self.assertTrue(os.path.exists(blockchain.metadata_path(self.config)))
+
+    def test_truncate_shared_segment(self):
+        fork, fork_headers = self.make_fork()
+        old = blockchain.blockchains[25]
+        # rewriting the promoted chain below the fork point must not
+        # touch the headers the old branch still uses
+        other = make_headers(20, hash_header(self.headers[19]), 3, nonce=3)
+        fork.write(to_chunk(other), 20 * 80)
+        self.assertEqual(22, fork.height())
+        for h in other:
+            self.assertEqual(h, fork.read_header(h['block_height']))
+        for h in self.headers[25:]:
+            self.assertEqual(h, old.read_header(h['block_height']))
+        # the fork's own segment is no longer used
+        self.assertFalse(os.path.exists(os.path.join(self.config.path, 'forks', 'segment_25_0')))
+
+    def test_verify_chunk(self):
+        headers = make_headers(30, hash_header(self.headers[29]), 10)
+        hashes = self.chain.verify_chunk(0, to_chunk(self.headers + headers))
+        self.assertEqual([hash_header(h) for h in self.headers + headers],
+                         [blockchain.hash_encode(hashes[i:i+32]) for i in range(0, len(hashes), 32)])
+        broken = make_headers(35, '11' * 32, 5)
+        with self.assertRaisesRegex(Exception, 'prev hash mismatch'):
+            self.chain.verify_chunk(0, to_chunk(self.headers + headers[:5] + broken))
+
+    def test_connect_chunk(self):
+        headers = make_headers(30, hash_header(self.headers[29]), 10)
+        self.assertTrue(self.chain.connect_chunk(0, to_chunk(self.headers + headers).hex()))
+        self.assertEqual(39, self.chain.height())
+        self.assertEqual(hash_header(headers[-1]), self.chain.get_hash(39))
+        broken = make_headers(40, '11' * 32, 5)
+        self.assertFalse(self.chain.connect_chunk(0, to_chunk(self.headers + headers + broken).hex()))
+        self.assertEqual(39, self.chain.height())
+
+    def test_connect_headers(self):
+        headers = make_headers(30, hash_header(self.headers[29]), 10)
+        self.assertEqual(10, self.chain.connect_headers(headers))
+        self.assertEqual(39, self.chain.height())
+        self.assertEqual(headers[-1], self.chain.read_header(39))
+        # only the run that connects is saved
+        headers = make_headers(40, hash_header(headers[-1]), 5)
+        broken = make_headers(45, '11' * 32, 3)
+        self.assertEqual(5, self.chain.connect_headers(headers + broken))
+        self.assertEqual(44, self.chain.height())
+        self.assertEqual(0, self.chain.connect_headers(broken))
+
+    def test_appended_headers_are_buffered(self):
+        path = self.chain.path()
+        self.assertEqual(0, os.path.getsize(path))
+        self.assertEqual(self.headers[10], self.chain.read_header(10))
+        self.assertEqual(hash_header(self.headers[10]), self.chain.get_hash(10))
+        self.chain.flush()
+        self.assertEqual(0, os.path.getsize(path))
+        self.chain.flush(True)
+        self.assertEqual(30 * 80, os.path.getsize(path))
+        self.assertEqual(self.headers[10], self.chain.read_header(10))
+
+    def test_flush_when_batch_is_full(self):
+        headers = make_headers(30, hash_header(self.headers[29]), blockchain.HEADERS_FLUSH_BATCH - 30)
+        for h in headers[:-1]:
+            self.chain.save_header(h)
+        self.assertEqual(0, os.path.getsize(self.chain.path()))
+        self.chain.save_header(headers[-1])
+        self.assertEqual(blockchain.HEADERS_FLUSH_BATCH * 80, os.path.getsize(self.chain.path()))
+
+    def test_incomplete_header_truncated(self):
+        self.chain.flush(True)
+        self.chain.ranges[0][0].close()
+        with open(self.chain.path(), 'ab') as f:
+            f.write(b'\x01' * 50)
+        self.chain.update_size()
+        self.assertEqual(30 * 80, os.path.getsize(self.chain.path()))
+        self.assertEqual(29, self.chain.height())
+
+    def test_target_memoized(self):
+        headers = make_headers(30, hash_header(self.headers[29]), 2016)
+        self.chain.save_headers(headers)
+        store = self.chain.ranges[0][0]
+        with mock.patch.object(constants.net, 'TESTNET', False):
+            self.chain.checkpoints = []
+            target = self.chain.compute_target(0)
+            self.assertEqual(target, self.chain.get_target(0))
+            self.assertEqual({0: target}, store.targets)
+            with mock.patch.object(self.chain, 'read_header', side_effect=AssertionError):
+                self.assertEqual(target, self.chain.get_target(0))
+            self.chain.flush(True)
+            self.assertEqual(blockchain.TARGET_RECORD_SIZE, os.path.getsize(store.targets_path()))
+            # persisted next to the headers
+            blockchain.read_blockchains(self.config)
+            chain = blockchain.blockchains[0]
+            self.assertEqual({0: target}, chain.ranges[0][0].targets)
+            # rewriting the chunk drops its target
+            other = make_headers(2000, hash_header(headers[1969]), 5, nonce=1)
+            chain.write(to_chunk(other), 2000 * 80)
+            self.assertEqual({}, chain.ranges[0][0].targets)
+            self.assertEqual(0, os.path.getsize(chain.ranges[0][0].targets_path()))
+
+    def test_check_header_by_hash(self):
+        fork, fork_headers = self.make_fork()
+        old = blockchain.blockchains[25]
+        with mock.patch.object(Blockchain, 'get_hash', side_effect=AssertionError):
+            self.assertIs(fork, blockchain.check_header(fork_headers[2]))
+            self.assertIs(fork, blockchain.check_header(self.headers[10]))
+            self.assertIs(old, blockchain.check_header(self.headers[27]))
+            self.assertFalse(blockchain.check_header(make_headers(27, '11' * 32, 1)[0]))
+        # headers below the index are looked up in the chains
+        blockchain.header_index.advance(20)
+        self.assertIs(fork, blockchain.check_header(self.headers[10]))
+        self.assertIs(old, blockchain.check_header(self.headers[27]))
+
+    def test_can_connect_by_hash(self):
+        fork, fork_headers = self.make_fork()
+        old = blockchain.blockchains[25]
+        header = make_headers(31, hash_header(fork_headers[-1]), 1)[0]
+        self.assertIs(fork, blockchain.can_connect(header))
+        header = make_headers(30, hash_header(self.headers[-1]), 1)[0]
+        self.assertIs(old, blockchain.can_connect(header))
+        header = make_headers(28, hash_header(self.headers[26]), 1, nonce=5)[0]
+        self.assertFalse(blockchain.can_connect(header))
+
+    def test_index_follows_truncation(self):
+        other = make_headers(20, hash_header(self.headers[19]), 3, nonce=3)
+        self.chain.write(to_chunk(other), 20 * 80)
+        self.assertFalse(blockchain.check_header(self.headers[25]))
+        self.assertFalse(blockchain.check_header(self.headers[21]))
+        self.assertIs(self.chain, blockchain.check_header(other[1]))
+
+    def test_children(self):
+        self.assertIsNone(self.chain.get_max_child())
+        fork, fork_headers = self.make_fork(count=2)
+        self.assertEqual(25, self.chain.get_max_child())
+        self.assertEqual([fork], blockchain.children[0])
+        self.assertEqual(25, self.chain.get_checkpoint())
+        # after a swap the old branch is the child
+        more = make_headers(27, hash_header(fork_headers[-1]), 4, nonce=1)
+        fork.save_headers(more)
+        self.assertIs(fork, blockchain.blockchains[0])
+        self.assertEqual([self.chain], blockchain.children[0])
+        self.assertEqual(25, fork.get_max_child())
@@ -0,0 +1,67 @@
+import threading
+import time
+import unittest
+
+from lib.event_bus import EventBus
+
+
+class TestEventBus(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = EventBus(interval=0.2)
+        self.received = []
+        self.done = threading.Event()
+
+    def tearDown(self):
+        self.bus.close()
+
+    def on_event(self, event, *args):
+        self.received.append((event,) + args)
+        if event == 'done':
+            self.done.set()
+
+    def wait(self):
+        self.bus.trigger('done')
+        self.assertTrue(self.done.wait(5))
+        self.done.clear()
+
+    def test_coalesce(self):
+        self.bus.register(self.on_event, ['updated', 'fee', 'new_transaction', 'done'])
+        for i in range(100):
+            self.bus.trigger('updated')
+            self.bus.trigger('fee', i)
+            self.bus.trigger('new_transaction', i)
+        time.sleep(0.5)
+        self.wait()
+        self.assertEqual(2, self.received.count(('updated',)))
+        self.assertEqual([('fee', 0), ('fee', 99)], [r for r in self.received if r[0] == 'fee'])
+        self.assertEqual(100, len([r for r in self.received if r[0] == 'new_transaction']))
+        stats = self.bus.get_stats()
+        self.assertEqual(2 * 98, stats['coalesced'])
+        self.assertEqual(0, stats['dropped'])
+
+    def test_wallet(self):
+        a, b = object(), object()
+        self.bus.register(self.on_event, ['verified', 'done'], a)
+        self.bus.trigger('verified', 'x', wallet=a)
+        self.bus.trigger('verified', 'y', wallet=b)
+        self.bus.trigger('verified', 'z')
+        self.wait()
+        self.assertEqual([('verified', 'x'), ('verified', 'z'), ('done',)], self.received)
+        self.bus.unregister(self.on_event)
+        self.bus.trigger('verified', 'x', wallet=a)
+        self.bus.trigger('done')
+        self.assertFalse(self.done.wait(0.2))
+
+    def test_slow_consumer(self):
+        bus = EventBus(max_queued=10)
+        release = threading.Event()
+        bus.register(lambda event, *args: release.wait(5), ['new_transaction'])
+        t0 = time.time()
+        for i in range(20):
+            bus.trigger('new_transaction', i)
+        # the trigger did not wait for the callback
+        self.assertLess(time.time() - t0, 1)
+        release.set()
+        bus.close()
+        self.assertGreater(bus.get_stats()['dropped'], 0)
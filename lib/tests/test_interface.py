@@ -1,6 +1,9 @@
+import json
+import socket
 import unittest
 
 from lib import interface
+from lib import util
 
 
 class TestInterface(unittest.TestCase):
@@ -24,3 +27,163 @@ class TestInterface(unittest.TestCase):
         self.assertTrue(i.check_host_name(
             peercert={'subject': [('commonName', 'foo.bar.com')]},
             name='foo.bar.com'))
+
+    def test_request_window(self):
+        a, b = socket.socketpair()
+        i = interface.Interface('localhost:1:t', a, window_min=50, window_max=102)
+        self.assertEqual(interface.REQUEST_WINDOW_INITIAL, i.window)
+        for n in range(150):
+            i.queue_request('server.version', [], n)
+        self.assertEqual(100, i.num_requests())
+        self.assertTrue(i.send_requests())
+        self.assertEqual(100, len(i.unanswered_requests))
+        # a full window grows, up to the max
+        for n in range(5):
+            i.unanswered_requests.pop(n)
+            i.update_window('server.version', 0.01, None)
+        self.assertEqual(102, i.window)
+        # a slower method is not compared to the pings
+        for n in range(5, 10):
+            i.unanswered_requests.pop(n)
+            i.update_window('blockchain.scripthash.get_history', 0.5, None)
+        self.assertEqual(102, i.window)
+        # slow responses shrink it, down to its initial size
+        for n in range(10, 30):
+            i.unanswered_requests.pop(n)
+            i.last_decrease = 0
+            i.update_window('server.version', 1, None)
+        self.assertEqual(interface.REQUEST_WINDOW_INITIAL, i.window)
+        # timeouts down to the min
+        for n in range(10):
+            i.last_decrease = 0
+            i.add_timeout()
+        self.assertEqual(50, i.window)
+        self.assertEqual(0, i.num_requests())
+        a.close()
+        b.close()
+
+    def test_request_window_errors(self):
+        a, b = socket.socketpair()
+        i = interface.Interface('localhost:1:t', a)
+        for n in range(3):
+            i.update_window('server.version', 0.01, {'code': -101, 'message': 'excessive resource usage'})
+        self.assertLess(i.window, interface.REQUEST_WINDOW_INITIAL)
+        self.assertIn('ms', i.window_status())
+        a.close()
+        b.close()
+
+    def read_lines(self, sock, pipe):
+        sock.settimeout(0.1)
+        lines = []
+        try:
+            while True:
+                lines.append(pipe.get())
+        except Exception:
+            return lines
+
+    def test_batch_requests(self):
+        a, b = socket.socketpair()
+        i = interface.Interface('localhost:1:t', a)
+        server = util.SocketPipe(b)
+        i.queue_request('server.version', [], 0)
+        self.assertTrue(i.send_requests())
+        version, probe = self.read_lines(b, server)
+        self.assertEqual('server.version', version['method'])
+        self.assertEqual([interface.BATCH_PROBE_ID], [r['id'] for r in probe])
+        server.send_all([{'id': 0, 'result': '1.2'}, [{'id': interface.BATCH_PROBE_ID, 'result': ''}]])
+        self.assertEqual([('server.version', [], 0)], [r for r, response in i.get_responses()])
+        self.assertTrue(i.batch)
+        for n in range(1, 4):
+            i.queue_request('blockchain.scripthash.subscribe', ['%064x' % n], n)
+        self.assertTrue(i.send_requests())
+        batch, = self.read_lines(b, server)
+        self.assertEqual([1, 2, 3], [r['id'] for r in batch])
+        server.send_all([[{'id': 3, 'result': None}, {'id': 1, 'result': None}],
+                         {'method': 'blockchain.headers.subscribe', 'params': [{}]},
+                         [{'id': 2, 'result': None}]])
+        responses = i.get_responses()
+        self.assertEqual([3, 1, None, 2], [r[2] if r else None for r, response in responses])
+        self.assertEqual({}, i.unanswered_requests)
+        a.close()
+        b.close()
+
+    def test_batch_not_supported(self):
+        a, b = socket.socketpair()
+        i = interface.Interface('localhost:1:t', a)
+        server = util.SocketPipe(b)
+        for n in range(3):
+            i.queue_request('server.version', [], n)
+        self.assertTrue(i.send_requests())
+        self.assertEqual(4, len(self.read_lines(b, server)))
+        server.send_all([{'id': None, 'error': {'code': -32600, 'message': 'invalid request'}}])
+        self.assertEqual([], i.get_responses())
+        self.assertIs(False, i.batch)
+        i.queue_request('server.version', [], 3)
+        i.queue_request('server.version', [], 4)
+        self.assertTrue(i.send_requests())
+        self.assertEqual([3, 4], [r['id'] for r in self.read_lines(b, server)])
+        a.close()
+        b.close()
+
+    def test_cancel_request(self):
+        a, b = socket.socketpair()
+        i = interface.Interface('localhost:1:t', a)
+        i.batch = False
+        server = util.SocketPipe(b)
+        i.queue_request('blockchain.transaction.get', ['%064x' % 0], 0)
+        self.assertTrue(i.send_requests())
+        i.queue_request('blockchain.transaction.get', ['%064x' % 1], 1)
+        i.cancel_request(0)
+        i.cancel_request(1)
+        self.assertEqual({}, i.unanswered_requests)
+        self.assertEqual([], i.unsent_requests)
+        # the late response is dropped
+        server.send_all([{'id': 0, 'result': 'ab'}])
+        self.assertEqual([], i.get_responses())
+        self.assertEqual(set(), i.cancelled)
+        # an interface is only dropped when timeouts add up
+        i.timeouts = interface.MAX_TIMEOUTS - 1
+        self.assertFalse(i.has_timed_out())
+        i.timeouts += 1
+        self.assertTrue(i.has_timed_out())
+        a.close()
+        b.close()
+
+    def test_send_buffer_full(self):
+        a, b = socket.socketpair()
+        i = interface.Interface('localhost:1:t', a)
+        i.batch = False
+        server = util.SocketPipe(b)
+        big = 'ab' * 200000
+        for n in range(5):
+            i.queue_request('blockchain.transaction.broadcast', [big], n)
+        # more than the socket buffers hold: the rest waits in the pipe
+        self.assertTrue(i.send_requests())
+        self.assertTrue(i.pipe.send_buffer)
+        i.queue_request('server.version', [], 5)
+        self.assertTrue(i.send_requests())
+        self.assertEqual([('server.version', [], 5)], i.unsent_requests)
+        ids = []
+        while len(ids) < 6:
+            ids.extend(r['id'] for r in self.read_lines(b, server))
+            self.assertTrue(i.send_requests())
+        self.assertEqual(list(range(6)), ids)
+        self.assertEqual(b'', i.pipe.send_buffer)
+        a.close()
+        b.close()
+
+    def test_scored_rtts(self):
+        a, b = socket.socketpair()
+        i = interface.Interface('localhost:1:t', a)
+        i.batch = False
+        server = util.SocketPipe(b)
+        i.queue_request('server.version', [], 0)
+        i.queue_request('blockchain.scripthash.get_history', ['%064x' % 0], 1)
+        self.assertTrue(i.send_requests())
+        self.assertEqual(2, len(self.read_lines(b, server)))
+        server.send_all([{'id': 0, 'result': '1.2'}, {'id': 1, 'result': []}])
+        self.assertEqual(2, len(i.get_responses()))
+        # only the ping scores the server
+        self.assertEqual(1, len(i.rtt_samples))
+        a.close()
+        b.close()
@@ -0,0 +1,533 @@
+import asyncio
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from lib import bitcoin, blockchain, network, util
+from lib.bitcoin import hash160_to_p2pkh
+from lib.network import Network, ServerStats
+from lib.simple_config import SimpleConfig
+
+from . import TestCaseForTestnet
+from .test_blockchain import make_headers, to_chunk
+
+
+class FakeServer(object):
+    """An electrum server on localhost that answers requests with
+    canned results"""
+
+    def __init__(self, results=None, ignore=None):
+        self.results = {
+            'blockchain.headers.subscribe': {'block_height': 0},
+            'server.peers.subscribe': [],
+            'server.banner': 'hello',
+        }
+        self.results.update(results or {})
+        # method -> how many of its requests are left unanswered, or
+        # None for all of them
+        self.ignore = ignore or {}
+        self.requests = []
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.server = '127.0.0.1:%d:t' % self.sock.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                c, addr = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(c,), daemon=True).start()
+
+    def handle(self, c):
+        for line in c.makefile('rb'):
+            request = json.loads(line.decode('utf8'))
+            requests = request if type(request) is list else [request]
+            self.requests.extend(requests)
+            answered = [r for r in requests if not self.ignored(r)]
+            if not answered:
+                continue
+            response = [self.respond(r) for r in answered] if type(request) is list else self.respond(request)
+            c.sendall((json.dumps(response) + '\n').encode('utf8'))
+
+    def ignored(self, request):
+        method = request['method']
+        if method not in self.ignore:
+            return False
+        if self.ignore[method] is None:
+            return True
+        self.ignore[method] -= 1
+        if not self.ignore[method]:
+            del self.ignore[method]
+        return True
+
+    def respond(self, request):
+        result = self.results.get(request['method'])
+        return {'id': request['id'], 'result': result(request['params']) if callable(result) else result}
+
+    def close(self):
+        self.sock.close()
+
+
+class FakeWallet(object):
+
+    def __init__(self):
+        self.scripthashes = {}
+
+    def get_scripthash(self, addr):
+        return self.scripthashes.setdefault(addr, bitcoin.address_to_scripthash(addr))
+
+
+class FakeInterface(object):
+    """An interface that keeps the requests queued on it"""
+
+    def __init__(self, server, tip, chain):
+        self.server = server
+        self.tip = tip
+        self.blockchain = chain
+        self.mode = 'default'
+        self.request = None
+        self.queue = []
+
+    def queue_request(self, method, params, message_id):
+        self.queue.append((method, params, message_id))
+
+    def print_error(self, *msg):
+        pass
+
+
+class TestCatchUp(TestCaseForTestnet):
+
+    def setUp(self):
+        super().setUp()
+        self.electrum_path = tempfile.mkdtemp()
+        open(os.path.join(self.electrum_path, 'blockchain_headers'), 'wb').close()
+        # never started: the interfaces are driven by hand
+        self.config = SimpleConfig({'electrum_path': self.electrum_path, 'server': '127.0.0.1:1:t',
+                                    'oneserver': True, 'auto_connect': False})
+        self.network = Network(self.config)
+        self.chain = self.network.blockchains[0]
+        self.headers = make_headers(0, '00' * 32, 2016 + 100)
+
+    def tearDown(self):
+        super().tearDown()
+        for store in blockchain.segments.values():
+            store.close()
+        blockchain.segments.clear()
+        blockchain.blockchains.clear()
+        shutil.rmtree(self.electrum_path)
+
+    def test_tip_moves_within_last_chunk(self):
+        i = FakeInterface('a:1:t', 2016 + 50, self.chain)
+        other = FakeInterface('b:1:t', 2016 + 99, None)
+        self.network.interfaces = {i.server: i, other.server: other}
+        i.mode = 'catch_up'
+        self.chain.catch_up = i.server
+        self.network.request_chunks(i, 0)
+        # a server on another branch gets no chunk
+        self.assertEqual({0: (i, i.server), 1: (i, i.server)},
+                         {k: v[:2] for k, v in self.network.requested_chunks.items()})
+        self.assertEqual([], other.queue)
+        self.network.on_get_chunk(i, {'params': [0], 'result': to_chunk(self.headers[:2016]).hex()})
+        # a block is found while the partial chunk is on its way
+        i.tip = 2016 + 51
+        self.network.on_get_chunk(i, {'params': [1], 'result': to_chunk(self.headers[2016:2067]).hex()})
+        self.assertEqual(2066, self.chain.height())
+        self.assertEqual({2067: None}, i.request)
+        self.network.on_get_header(i, {'result': self.headers[2067]})
+        self.assertEqual(2067, self.chain.height())
+        self.assertEqual('default', i.mode)
+        self.assertIsNone(self.chain.catch_up)
+
+
+    def test_init_headers_file(self):
+        self.chain.connect_chunk(0, to_chunk(self.headers[:30]).hex())
+        self.chain.flush(True)
+        store = self.chain.ranges[0][0]
+        self.assertEqual(30 * 32, os.path.getsize(store.index_path()))
+        # the headers file is lost, its sidecars are not
+        os.unlink(store.path)
+        self.network.init_headers_file()
+        self.assertEqual(-1, self.chain.height())
+        self.assertFalse(os.path.exists(store.index_path()))
+        self.assertFalse(os.path.exists(store.targets_path()))
+        self.assertFalse(blockchain.check_header(self.headers[10]))
+        # and it fills up again
+        self.chain.connect_chunk(0, to_chunk(self.headers[:30]).hex())
+        self.assertEqual(29, self.chain.height())
+        self.assertEqual(blockchain.hash_header(self.headers[29]), self.chain.get_hash(29))
+
+    def start_search(self, i, server_headers):
+        """Look back from the tip of i for a header in common, answering
+        its header requests from server_headers until it stops asking.
+        Returns the heights asked for, batch by batch."""
+        self.network.interfaces = {i.server: i}
+        i.mode = 'backward'
+        i.bad = i.tip
+        i.bad_header = server_headers[i.tip]
+        self.network.request_headers(i, self.network.backward_heights(i))
+        batches = []
+        while i.request and None in i.request.values():
+            heights = sorted(i.request)
+            batches.append(heights)
+            for height in heights:
+                self.network.on_get_header(i, {'result': server_headers[height]})
+        return batches
+
+    def test_new_fork(self):
+        self.chain.connect_chunk(0, to_chunk(self.headers[:200]).hex())
+        server = self.headers[:151] + make_headers(151, blockchain.hash_header(self.headers[150]), 40, nonce=1)
+        i = FakeInterface('a:1:t', 190, self.chain)
+        batches = self.start_search(i, server)
+        self.assertEqual([
+            # backward, doubling the distance from the tip
+            [182, 186, 188, 189],
+            # 126 is known: binary search between 126 and 158
+            [62, 126, 158, 174],
+            [132, 138, 145, 151],
+            [146, 147, 148, 149],
+            # the fork point is inside the last interval
+            [150],
+            # catch up on the new chain
+            list(range(152, 191)),
+        ], batches)
+        fork = self.network.blockchains[151]
+        self.assertIs(fork, i.blockchain)
+        self.assertIs(self.chain, self.network.blockchains[0])
+        self.assertEqual(190, fork.height())
+        self.assertEqual(blockchain.hash_header(server[190]), fork.get_hash(190))
+        self.assertEqual('default', i.mode)
+
+    def test_fork_point_in_one_batch(self):
+        self.chain.connect_chunk(0, to_chunk(self.headers[:200]).hex())
+        server = self.headers[:197] + make_headers(197, blockchain.hash_header(self.headers[196]), 14, nonce=1)
+        i = FakeInterface('a:1:t', 210, self.chain)
+        batches = self.start_search(i, server)
+        # 195 known and 197 not, then 196 known: forked at 197
+        self.assertEqual([[202, 206, 208, 209], [82, 146, 178, 194], [195, 197, 198, 200], [196],
+                          list(range(198, 211))], batches)
+        self.assertEqual(197, self.chain.checkpoint)
+        self.assertEqual(210, self.network.blockchains[0].height())
+
+    def test_no_fork_point(self):
+        self.chain.connect_chunk(0, to_chunk(self.headers[:200]).hex())
+        server = make_headers(0, '00' * 32, 210, nonce=2)
+        i = FakeInterface('a:1:t', 209, self.chain)
+        down = []
+        self.network.connection_down = down.append
+        batches = self.start_search(i, server)
+        # nothing in common down to the genesis
+        self.assertEqual(0, batches[-1][0])
+        self.assertEqual([i.server], down)
+        self.assertEqual(199, self.chain.height())
+        self.assertEqual([0], list(self.network.blockchains))
+
+    def test_reorg_to_existing_fork(self):
+        self.chain.connect_chunk(0, to_chunk(self.headers[:200]).hex())
+        server = self.headers[:151] + make_headers(151, blockchain.hash_header(self.headers[150]), 40, nonce=1)
+        fork = self.chain.fork(server[151])
+        for header in server[152:161]:
+            fork.save_header(header)
+        self.assertEqual(160, fork.height())
+        i = FakeInterface('a:1:t', 190, self.chain)
+        batches = self.start_search(i, server)
+        # 158 is on the fork: the search goes on along it, and the
+        # interface catches up on it rather than making a new one
+        self.assertEqual([[182, 186, 188, 189], [62, 126, 158, 174]], batches[:2])
+        self.assertEqual(list(range(161, 191)), batches[-1])
+        self.assertIs(fork, i.blockchain)
+        self.assertEqual(2, len(self.network.blockchains))
+        self.assertIs(fork, self.network.blockchains[151])
+        self.assertEqual(190, fork.height())
+        self.assertEqual(blockchain.hash_header(server[190]), fork.get_hash(190))
+        self.assertEqual('default', i.mode)
+
+class TestServerStats(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'server_stats')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def test_score(self):
+        stats = ServerStats(self.path)
+        self.assertIsNone(stats.score('a:1:s'))
+        stats.record_connect('a:1:s', 0.4)
+        stats.record_rtts('a:1:s', [0.1] * 9 + [1])
+        self.assertAlmostEqual(0.1 + (0.1 + 1) / 2, stats.score('a:1:s'))
+        stats.record_connect('b:1:s', 0.04)
+        stats.record_rtts('b:1:s', [0.01] * 10)
+        self.assertLess(stats.score('b:1:s'), stats.score('a:1:s'))
+        # lag and failures make it worse
+        stats.record_lag('b:1:s', 2)
+        stats.record_failure('b:1:s')
+        self.assertGreater(stats.score('b:1:s'), stats.score('a:1:s'))
+        # failures only: known to be bad
+        stats.record_failure('c:1:s')
+        self.assertEqual(ServerStats.FAILURE_PENALTY, stats.score('c:1:s'))
+
+    def test_pick(self):
+        stats = ServerStats(self.path)
+        servers = ['%d:1:s' % i for i in range(5)]
+        for i, server in enumerate(servers):
+            stats.record_rtts(server, [i + 1])
+        self.assertEqual('0:1:s', stats.pick(servers, choices=1))
+        for i in range(20):
+            self.assertIn(stats.pick(servers), servers[:3])
+        self.assertIn(stats.pick(['x:1:s', 'y:1:s']), ['x:1:s', 'y:1:s'])
+        self.assertIsNone(stats.pick([]))
+
+    def test_switch_to_faster(self):
+        n = Network.__new__(Network)
+        n.server_stats = ServerStats(self.path)
+        n.auto_connect = True
+        chain = object()
+        n.interfaces = {s: FakeInterface(s, 100, chain) for s in ['a:1:s', 'b:1:s']}
+        n.default_server = 'a:1:s'
+        n.interface = n.interfaces['a:1:s']
+        switched = []
+        n.switch_to_interface = switched.append
+        n.server_stats.record_rtts('a:1:s', [1] * network.SERVER_SWITCH_SAMPLES)
+        n.server_stats.record_rtts('b:1:s', [0.1] * (network.SERVER_SWITCH_SAMPLES - 1))
+        n.switch_to_faster_interface()
+        self.assertEqual([], switched)
+        n.server_stats.record_rtts('b:1:s', [0.1])
+        n.switch_to_faster_interface()
+        self.assertEqual(['b:1:s'], switched)
+        # the times of a previous run are not enough to switch on
+        n.server_stats.save()
+        n.server_stats = ServerStats(self.path)
+        n.switch_to_faster_interface()
+        self.assertEqual(['b:1:s'], switched)
+
+    def test_persisted(self):
+        stats = ServerStats(self.path)
+        stats.record_connect('a:1:s', 0.2)
+        stats.record_rtts('a:1:s', [0.05])
+        stats.save()
+        stats = ServerStats(self.path)
+        self.assertEqual([0.05], stats.stats['a:1:s']['rtts'])
+        self.assertAlmostEqual(0.05 + 0.05, stats.score('a:1:s'))
+        with open(self.path, 'w') as f:
+            f.write('garbage')
+        self.assertEqual({}, ServerStats(self.path).stats)
+
+
+class TestNetwork(TestCaseForTestnet):
+
+    def setUp(self):
+        super().setUp()
+        self.electrum_path = tempfile.mkdtemp()
+        open(os.path.join(self.electrum_path, 'blockchain_headers'), 'wb').close()
+        self.fake = FakeServer()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path, 'server': self.fake.server,
+                                    'oneserver': True, 'auto_connect': False})
+        self.network = Network(self.config)
+        self.network.start()
+        t0 = time.time()
+        while not self.network.is_connected() and time.time() - t0 < 10:
+            time.sleep(0.01)
+
+    def tearDown(self):
+        super().tearDown()
+        self.network.stop()
+        self.network.join(5)
+        self.fake.close()
+        for store in blockchain.segments.values():
+            store.close()
+        blockchain.segments.clear()
+        blockchain.blockchains.clear()
+        shutil.rmtree(self.electrum_path)
+
+    def test_synchronous_get(self):
+        self.assertTrue(self.network.is_connected())
+        t0 = time.time()
+        for i in range(20):
+            self.assertEqual('hello', self.network.synchronous_get(('server.banner', [])))
+        # requests are sent right away, not on the next loop iteration
+        self.assertLess(time.time() - t0, 1)
+        # the server answered the batch probe
+        self.assertTrue(self.network.interface.batch)
+        self.assertIsNotNone(self.network.server_stats.score(self.fake.server))
+
+    def test_request_coroutine(self):
+        future = asyncio.run_coroutine_threadsafe(
+            self.network.request('server.banner', []), self.network.loop)
+        self.assertEqual('hello', future.result(5))
+        self.fake.ignore = {'blockchain.relayfee': None}
+        # synchronous_get awaits it too, and gives up on the server
+        with self.assertRaises(util.TimeoutException):
+            self.network.synchronous_get(('blockchain.relayfee', []), timeout=0.5)
+
+    def test_network_stats(self):
+        for i in range(3):
+            self.network.synchronous_get(('server.banner', []))
+        stats = self.network.get_network_stats()
+        banner = stats['methods']['server.banner']
+        self.assertEqual(3, banner['queued'] - 1)
+        self.assertEqual(banner['sent'], banner['responses'])
+        self.assertEqual(banner['responses'], sum(banner['latency_histogram'].values()))
+        self.assertEqual(0, banner['errors'])
+        self.assertGreater(stats['bytes_sent'], 0)
+        self.assertGreater(stats['bytes_received'], 0)
+        self.assertEqual(0, stats['in_flight'])
+        self.assertIn(self.fake.server, stats['interfaces'])
+        self.assertIn('hit_rate', stats['caches']['tx_cache'])
+        self.assertIn('coalesced', stats['events'])
+        json.dumps(stats)
+
+    def test_scripthashes(self):
+        addr = hash160_to_p2pkh(bytes(20))
+        h = bitcoin.address_to_scripthash(addr)
+        wallet = FakeWallet()
+        self.assertEqual(h, self.network.addr_to_scripthash(addr, wallet))
+        self.assertEqual({addr: h}, wallet.scripthashes)
+        self.assertEqual(addr, self.network.get_address(h))
+        self.network.forget_addresses(wallet)
+        self.assertIsNone(self.network.get_address(h))
+        # callers other than wallets keep them under a key of their own
+        owner = object()
+        other = hash160_to_p2pkh(bytes([1] * 20))
+        h2 = self.network.addr_to_scripthash(other, owner=owner)
+        self.network.addr_to_scripthash(addr, owner=owner)
+        self.network.forget_addresses(owner, [addr])
+        self.assertIsNone(self.network.get_address(h))
+        self.assertEqual(other, self.network.get_address(h2))
+        self.network.forget_addresses(owner)
+        self.assertNotIn(owner, self.network.h2addr)
+
+    def test_stop(self):
+        self.network.stop()
+        self.network.join(5)
+        self.assertFalse(self.network.is_alive())
+        self.assertIsNone(self.network.loop)
+
+    def add_server(self, server):
+        self.network.loop.call_soon_threadsafe(self.network.start_interface, server.server)
+        t0 = time.time()
+        while server.server not in self.network.interfaces and time.time() - t0 < 10:
+            time.sleep(0.01)
+        # the fake servers have no headers: put all of them on our chain
+        def follow():
+            for interface in self.network.interfaces.values():
+                interface.blockchain = self.network.blockchains[0]
+        self.network.loop.call_soon_threadsafe(follow)
+
+    def test_run_in_stopped_network_thread(self):
+        self.network.stop()
+        self.network.join(5)
+        # a loop that stops before it gets to the call
+        loop = asyncio.new_event_loop()
+        def stop():
+            time.sleep(0.3)
+            loop.stop()
+        loop.call_soon(stop)
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        while not loop.is_running():
+            time.sleep(0.01)
+        self.network.loop = loop
+        try:
+            self.assertEqual(1, self.network.run_in_network_thread(lambda: 1))
+        finally:
+            self.network.loop = None
+            thread.join(5)
+            loop.close()
+
+    def test_route_requests(self):
+        other = FakeServer()
+        try:
+            self.add_server(other)
+            results = []
+            done = threading.Event()
+            def on_response(r):
+                results.append(r)
+                if len(results) % 40 == 0:
+                    done.set()
+            self.network.send([('blockchain.transaction.get', ['%064x' % i]) for i in range(40)], on_response)
+            self.assertTrue(done.wait(10))
+            methods = lambda server: [r['method'] for r in server.requests if isinstance(r, dict)]
+            # both servers took a share of them
+            self.assertIn('blockchain.transaction.get', methods(self.fake))
+            self.assertIn('blockchain.transaction.get', methods(other))
+            self.assertEqual({}, self.network.routed_requests)
+            # histories are checked against the status of the main server
+            for server in [self.fake, other]:
+                server.results['blockchain.scripthash.get_history'] = []
+            done.clear()
+            self.network.send([('blockchain.scripthash.get_history', ['%064x' % i]) for i in range(40)], on_response)
+            self.assertTrue(done.wait(10))
+            self.assertEqual(40, methods(self.fake).count('blockchain.scripthash.get_history'))
+            self.assertNotIn('blockchain.scripthash.get_history', methods(other))
+        finally:
+            other.close()
+
+    def test_retry_requests(self):
+        self.fake.ignore = {'blockchain.transaction.get': None}
+        other = FakeServer()
+        timeout = network.REQUEST_TIMEOUT
+        network.REQUEST_TIMEOUT = 0.2
+        try:
+            self.add_server(other)
+            results = []
+            done = threading.Event()
+            def on_response(r):
+                results.append(r)
+                if len(results) == 10:
+                    done.set()
+            self.network.send([('blockchain.transaction.get', ['%064x' % i]) for i in range(10)], on_response)
+            self.assertTrue(done.wait(10))
+            # those sent to the silent server were answered by the other one
+            self.assertIn('blockchain.transaction.get', [r['method'] for r in self.fake.requests])
+            self.assertEqual([None] * 10, [r.get('error') for r in results])
+            self.assertEqual({}, self.network.request_attempts)
+            # the silent server was kept
+            self.assertTrue(self.network.is_connected())
+        finally:
+            network.REQUEST_TIMEOUT = timeout
+            other.close()
+
+    def test_broadcast_not_retried(self):
+        self.fake.ignore = {'blockchain.transaction.broadcast': None}
+        timeout = network.REQUEST_TIMEOUT
+        network.REQUEST_TIMEOUT = 0.1
+        try:
+            results = []
+            self.network.send([('blockchain.transaction.broadcast', ['00'])], results.append)
+            time.sleep(2.5)
+            # sent once, and still waiting for its answer
+            methods = [r['method'] for r in self.fake.requests]
+            self.assertEqual(1, methods.count('blockchain.transaction.broadcast'))
+            self.assertEqual([], results)
+            self.assertEqual(['blockchain.transaction.broadcast'],
+                             [r[0] for r in self.network.unanswered_requests.values()])
+        finally:
+            network.REQUEST_TIMEOUT = timeout
+
+    def test_resend_history(self):
+        # wallet requests are sent until they are answered
+        self.fake.ignore = {'blockchain.scripthash.get_history': 2}
+        self.fake.results['blockchain.scripthash.get_history'] = []
+        timeout, retries = network.REQUEST_TIMEOUT, network.MAX_REQUEST_RETRIES
+        network.REQUEST_TIMEOUT, network.MAX_REQUEST_RETRIES = 0.2, 1
+        try:
+            results = []
+            done = threading.Event()
+            def on_response(r):
+                results.append(r)
+                done.set()
+            self.network.send([('blockchain.scripthash.get_history', ['%064x' % 0])], on_response)
+            self.assertTrue(done.wait(10))
+            self.assertEqual([[]], [r.get('result') for r in results])
+            methods = [r['method'] for r in self.fake.requests]
+            self.assertEqual(3, methods.count('blockchain.scripthash.get_history'))
+        finally:
+            network.REQUEST_TIMEOUT, network.MAX_REQUEST_RETRIES = timeout, retries
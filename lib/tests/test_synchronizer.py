@@ -0,0 +1,85 @@
+import unittest
+
+from lib import synchronizer
+from lib.synchronizer import Synchronizer, history_status
+
+
+class FakeNetwork(object):
+
+    tx_cache = None
+
+    def __init__(self):
+        self.sent = []
+        self.subscribed = []
+
+    def send(self, messages, callback):
+        self.sent.extend(params[0] for method, params in messages)
+
+    def subscribe_to_addresses(self, addresses, callback, wallet=None):
+        self.subscribed.append(addresses)
+
+    def trigger_callback(self, event, *args, wallet=None):
+        pass
+
+
+class FakeWallet(object):
+
+    def __init__(self, history):
+        self.history = history
+        self.transactions = {}
+        self.synchronizer = None
+
+    def get_addresses(self):
+        return list(self.history) + ['fresh']
+
+    def get_address_status(self, addr):
+        return history_status(self.history.get(addr))
+
+    def synchronize(self):
+        pass
+
+    def is_up_to_date(self):
+        return False
+
+    def set_up_to_date(self, up_to_date):
+        pass
+
+
+class TestSynchronizer(unittest.TestCase):
+
+    def setUp(self):
+        self.max_tx, self.max_addr = synchronizer.MAX_TX_REQUESTS, synchronizer.MAX_ADDRESS_REQUESTS
+        synchronizer.MAX_TX_REQUESTS = 2
+        synchronizer.MAX_ADDRESS_REQUESTS = 2
+
+    def tearDown(self):
+        synchronizer.MAX_TX_REQUESTS, synchronizer.MAX_ADDRESS_REQUESTS = self.max_tx, self.max_addr
+
+    def test_initial_sync(self):
+        wallet = FakeWallet({
+            'old': [('a', 100)],
+            'recent': [('b', 100), ('c', 300)],
+            'unconfirmed': [('d', 200), ('e', 0)],
+        })
+        network = FakeNetwork()
+        s = wallet.synchronizer = Synchronizer(wallet, network)
+        # unconfirmed and recent first, and only so many at once
+        self.assertEqual(['e', 'c'], network.sent)
+        self.assertEqual([{'unconfirmed', 'recent'}], network.subscribed)
+        self.assertEqual((0, 4, 5), s.get_progress())
+        for addr in ['unconfirmed', 'recent']:
+            s.on_address_status({'params': [addr], 'result': wallet.get_address_status(addr)})
+        s.run()
+        self.assertEqual([{'old', 'fresh'}], network.subscribed[1:])
+        # a failed download makes room too
+        s.tx_response({'params': ['e'], 'error': 'request timed out'})
+        s.run()
+        self.assertEqual(['e', 'c', 'd'], network.sent)
+        self.assertFalse(s.is_balance_ready())
+        for addr in ['old', 'fresh']:
+            s.on_address_status({'params': [addr], 'result': wallet.get_address_status(addr)})
+        self.assertEqual((4, 4, 5), s.get_progress())
+        # only an unconfirmed transaction is missing
+        s.requested_tx = {'e': 0}
+        self.assertTrue(s.is_balance_ready())
+        self.assertFalse(s.is_up_to_date())
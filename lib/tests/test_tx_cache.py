@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from lib.tx_cache import TxCache, txid_of
+
+
+def make_tx(i, size=100):
+    raw = i.to_bytes(4, 'little') * (size // 4)
+    return txid_of(raw), raw.hex()
+
+
+class TestTxCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_get_put(self):
+        cache = TxCache(self.path)
+        txid, raw = make_tx(1)
+        self.assertIsNone(cache.get(txid))
+        self.assertTrue(cache.put(txid, raw))
+        self.assertEqual(raw, cache.get(txid))
+        # only transactions that hash to their txid
+        other, _ = make_tx(2)
+        self.assertFalse(cache.put(other, raw))
+        self.assertFalse(cache.put('../' + other[3:], raw))
+        self.assertNotIn(other, cache)
+        # across restarts
+        self.assertEqual(raw, TxCache(self.path).get(txid))
+
+    def test_lru_eviction(self):
+        cache = TxCache(self.path, max_size=300)
+        txs = [make_tx(i) for i in range(3)]
+        for txid, raw in txs:
+            cache.put(txid, raw)
+            time.sleep(0.01)
+        # use the oldest one, so that the second goes first
+        self.assertIsNotNone(cache.get(txs[0][0]))
+        time.sleep(0.01)
+        txid, raw = make_tx(3)
+        cache.put(txid, raw)
+        self.assertEqual([txs[2][0], txs[0][0], txid], list(cache.entries))
+        self.assertEqual(300, cache.size)
+        self.assertFalse(os.path.exists(cache.file_path(txs[1][0])))
+        # the order of use is kept on disk
+        cache = TxCache(self.path, max_size=200)
+        self.assertEqual([txs[0][0], txid], list(cache.entries))
+
+    def test_corrupted_entry(self):
+        cache = TxCache(self.path)
+        txid, raw = make_tx(1)
+        cache.put(txid, raw)
+        with open(cache.file_path(txid), 'wb') as f:
+            f.write(b'garbage')
+        self.assertIsNone(cache.get(txid))
+        self.assertNotIn(txid, cache)
+        self.assertEqual(0, cache.size)
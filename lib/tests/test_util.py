@@ -1,5 +1,10 @@
+import math
+import socket
+import threading
 import unittest
-from lib.util import format_satoshis, parse_URI
+from decimal import Decimal
+from lib import util
+from lib.util import format_satoshis, parse_URI, LRUCache, SocketPipe
 
 class TestUtil(unittest.TestCase):
 
@@ -18,6 +23,68 @@ class TestUtil(unittest.TestCase):
         expected = "-0.00001234"
         self.assertEqual(expected, result)
 
+    def test_lru_cache_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(1, cache.get('a'))
+        cache['c'] = 3
+        self.assertEqual(2, len(cache))
+        self.assertNotIn('b', cache)
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertIsNone(cache.get('b'))
+
+    def test_parse_json(self):
+        message = bytearray(b'{"id": 1}\nnot json\n{"id"')
+        self.assertEqual(({'id': 1}, 10), util.parse_json(message))
+        self.assertEqual((None, 19), util.parse_json(message, 10))
+        self.assertEqual((None, 19), util.parse_json(message, 19))
+
+    def test_json_codecs(self):
+        obj = {'id': 1, 'result': [{'tx_hash': 'ab' * 32, 'height': 5}], 'big': 2 ** 70,
+               'amount': Decimal('1.5'), 'fee': util.Satoshis(10)}
+        expected = dict(obj, amount='1.5', fee='0.0000001 SMART')
+        for name in util.get_json_codecs():
+            codec = util.set_json_codec(name)
+            try:
+                data = codec.dumps(obj)
+                self.assertIsInstance(data, bytes)
+                self.assertEqual(expected, util.JSONCodec().loads(data))
+                self.assertEqual({'id': 1}, codec.loads(bytearray(b'{"id": 1}')))
+                # what only the standard library decodes is not dropped
+                message = bytearray(b'{"id": 2, "result": [NaN, Infinity]}\n')
+                response, offset = util.parse_json(message)
+                self.assertEqual(2, response['id'])
+                self.assertTrue(math.isnan(response['result'][0]))
+                self.assertEqual(float('inf'), response['result'][1])
+            finally:
+                util.set_json_codec()
+        self.assertIn('json', util.get_json_codecs())
+        with self.assertRaises(ValueError):
+            util.set_json_codec('nosuchcodec')
+
+    def test_socket_pipe(self):
+        a, b = socket.socketpair()
+        pipe = SocketPipe(a)
+        big = 'ab' * 200000
+        line = b'{"id": 1, "result": "%s"}\n' % big.encode()
+        b.sendall(line[:1000])
+        with self.assertRaises(util.timeout):
+            pipe.get()
+        # more than the socket buffers hold
+        t = threading.Thread(target=b.sendall, args=(line[1000:] + b'garbage\n{"id": 2}\n{"id": 3}\n{"id"',))
+        t.start()
+        self.assertEqual({'id': 1, 'result': big}, pipe.get())
+        self.assertEqual({'id': 2}, pipe.get())
+        self.assertEqual({'id': 3}, pipe.get())
+        t.join()
+        b.sendall(b': 4}\n')
+        self.assertEqual({'id': 4}, pipe.get())
+        b.close()
+        self.assertIsNone(pipe.get())
+        a.close()
+
     def _do_test_parse_URI(self, uri, expected):
         result = parse_URI(uri)
         self.assertEqual(expected, result)
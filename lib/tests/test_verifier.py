@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.blockchain import hash_header
+from lib.verifier import MerkleCache
+
+from .test_blockchain import make_headers
+
+
+class FakeChain(object):
+
+    def __init__(self, headers):
+        self.headers = headers
+
+    def read_header(self, height):
+        return self.headers[height] if height < len(self.headers) else None
+
+
+class TestMerkleCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'merkle_cache')
+        self.headers = make_headers(0, '00' * 32, 10)
+        self.branch = ['%064x' % i for i in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def add(self, cache, tx_hash, height):
+        header = self.headers[height]
+        cache.add(tx_hash, height, hash_header(header), 5, header['merkle_root'], self.branch)
+
+    def test_get(self):
+        cache = MerkleCache(self.path)
+        tx_hash = 'ab' * 32
+        self.add(cache, tx_hash, 3)
+        self.assertEqual((5, self.headers[3]['merkle_root']), cache.get(tx_hash, 3, self.headers[3]))
+        # another height, or another block at that height
+        self.assertIsNone(cache.get(tx_hash, 4, self.headers[4]))
+        other = make_headers(3, self.headers[2]['prev_block_hash'], 1, nonce=1)[0]
+        self.assertIsNone(cache.get(tx_hash, 3, other))
+        self.assertIsNone(cache.get('cd' * 32, 3, self.headers[3]))
+        cache.close()
+
+    def test_persisted(self):
+        cache = MerkleCache(self.path)
+        self.add(cache, 'ab' * 32, 3)
+        self.add(cache, 'cd' * 32, 4)
+        self.add(cache, 'cd' * 32, 4)
+        self.assertEqual(2, cache.records)
+        cache.close()
+        # an incomplete record at the end is dropped
+        with open(self.path, 'ab') as f:
+            f.write(b'\x01\x02')
+        cache = MerkleCache(self.path)
+        self.assertEqual(2, len(cache.entries))
+        self.assertEqual(self.branch, cache.entries.get('cd' * 32)[4])
+        self.assertEqual((5, self.headers[4]['merkle_root']), cache.get('cd' * 32, 4, self.headers[4]))
+        cache.close()
+
+    def test_invalidate(self):
+        cache = MerkleCache(self.path)
+        self.add(cache, 'ab' * 32, 3)
+        self.add(cache, 'cd' * 32, 6)
+        fork = self.headers[:5] + make_headers(5, hash_header(self.headers[4]), 5, nonce=1)
+        cache.invalidate(FakeChain(fork), 5)
+        self.assertEqual(['ab' * 32], cache.entries.keys())
+        cache.close()
+        cache = MerkleCache(self.path)
+        self.assertEqual(['ab' * 32], cache.entries.keys())
+        cache.close()
+
+    def test_bounded(self):
+        cache = MerkleCache(self.path, maxsize=3)
+        for height in range(8):
+            self.add(cache, '%064x' % height, height)
+        # the least recently used are dropped, from the file too
+        self.assertEqual(['%064x' % h for h in range(5, 8)], cache.entries.keys())
+        self.assertIsNone(cache.get('%064x' % 4, 4, self.headers[4]))
+        self.assertLessEqual(cache.records, 2 * 3)
+        cache.close()
+        cache = MerkleCache(self.path, maxsize=3)
+        self.assertEqual(['%064x' % h for h in range(5, 8)], cache.entries.keys())
+        cache.close()
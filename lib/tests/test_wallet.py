@@ -4,9 +4,14 @@ import sys
 import unittest
 import os
 import json
+import hashlib
 
 from io import StringIO
+from lib.bitcoin import address_to_scripthash, hash160_to_p2pkh
 from lib.storage import WalletStorage, FINAL_SEED_VERSION
+from lib.synchronizer import history_status
+from lib.util import bh2u
+from lib.wallet import Imported_Wallet
 
 
 class FakeSynchronizer(object):
@@ -67,3 +72,58 @@ class TestWalletStorage(WalletTestCase):
         with open(self.wallet_path, "r") as f:
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
+
+
+class TestAddressStatus(WalletTestCase):
+
+    def test_history_status(self):
+        h = [('%064x' % i, i) for i in range(3)]
+        status = ''.join('%s:%d:' % item for item in h)
+        self.assertEqual(bh2u(hashlib.sha256(status.encode('ascii')).digest()), history_status(h))
+        self.assertIsNone(history_status([]))
+
+    def test_cached_status(self):
+        storage = WalletStorage(self.wallet_path)
+        wallet = Imported_Wallet(storage)
+        addr = hash160_to_p2pkh(bytes(20))
+        wallet.import_address(addr)
+        self.assertIsNone(wallet.get_address_status(addr))
+        h = [('%064x' % 1, 10)]
+        wallet.receive_history_callback(addr, h, {})
+        self.assertEqual(history_status(h), wallet.get_address_status(addr))
+        # a new history replaces the status
+        h.append(('%064x' % 2, 0))
+        wallet.receive_history_callback(addr, h, {})
+        self.assertEqual(history_status(h), wallet.get_address_status(addr))
+        # and it is kept with the wallet
+        wallet.save_transactions(write=True)
+        wallet = Imported_Wallet(WalletStorage(self.wallet_path))
+        self.assertEqual({addr: history_status(h)}, wallet.address_status)
+
+    def test_stale_status(self):
+        storage = WalletStorage(self.wallet_path)
+        wallet = Imported_Wallet(storage)
+        addr = hash160_to_p2pkh(bytes(20))
+        wallet.import_address(addr)
+        h = [('%064x' % 1, 10)]
+        wallet.receive_history_callback(addr, h, {})
+        wallet.get_address_status(addr)
+        wallet.save_transactions(write=True)
+        # the history changed, but only the status made it to disk
+        storage = WalletStorage(self.wallet_path)
+        storage.put('addr_status', {addr: history_status(h + [('%064x' % 2, 0)])})
+        storage.write()
+        wallet = Imported_Wallet(WalletStorage(self.wallet_path))
+        self.assertEqual({}, wallet.address_status)
+        self.assertEqual(history_status(h), wallet.get_address_status(addr))
+
+    def test_scripthashes(self):
+        wallet = Imported_Wallet(WalletStorage(self.wallet_path))
+        addr = hash160_to_p2pkh(bytes(20))
+        wallet.import_address(addr)
+        h = wallet.get_scripthash(addr)
+        self.assertEqual(address_to_scripthash(addr), h)
+        wallet.start_threads(None)
+        wallet.stop_threads()
+        wallet = Imported_Wallet(WalletStorage(self.wallet_path))
+        self.assertEqual({addr: h}, wallet.scripthashes)
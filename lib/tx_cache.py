@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+#
+# Electrum - Lightweight SmartCash Client
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from .bitcoin import Hash_Sha256
+from .util import PrintError, bh2u
+
+# bytes of raw transactions kept on disk by default
+TX_CACHE_SIZE = 50 * 1000 * 1000
+
+TXID_RE = re.compile('^[0-9a-f]{64}$')
+
+
+def txid_of(raw):
+    return bh2u(Hash_Sha256(raw)[::-1])
+
+
+class TxCache(PrintError):
+    """Raw transactions by txid, on disk, shared by all the wallets of
+    a process and kept across restarts.  There is one file per
+    transaction, named after its txid; the least recently used ones
+    are removed once they take more than max_size bytes, and their
+    mtime records their use so that the order survives restarts.
+    Transactions are only stored and returned if they hash to their
+    txid."""
+
+    def __init__(self, path, max_size=TX_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # txid -> size, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def diagnostic_name(self):
+        return 'TxCache'
+
+    def file_path(self, txid):
+        return os.path.join(self.path, txid[:2], txid)
+
+    def load(self):
+        found = []
+        os.makedirs(self.path, exist_ok=True)
+        for d in os.listdir(self.path):
+            dir_path = os.path.join(self.path, d)
+            if not os.path.isdir(dir_path):
+                continue
+            for txid in os.listdir(dir_path):
+                if not TXID_RE.match(txid):
+                    continue
+                st = os.stat(os.path.join(dir_path, txid))
+                found.append((st.st_mtime, txid, st.st_size))
+        for mtime, txid, size in sorted(found):
+            self.entries[txid] = size
+            self.size += size
+        self.evict()
+
+    def __contains__(self, txid):
+        return txid in self.entries
+
+    def get(self, txid):
+        '''The raw transaction in hex, or None'''
+        with self.lock:
+            if txid not in self.entries:
+                self.misses += 1
+                return None
+            path = self.file_path(txid)
+            try:
+                with open(path, 'rb') as f:
+                    raw = f.read()
+                os.utime(path)
+            except OSError:
+                raw = None
+            if raw is None or txid_of(raw) != txid:
+                self.print_error("dropping bad entry", txid)
+                self.remove(txid)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(txid)
+            self.hits += 1
+            return bh2u(raw)
+
+    def put(self, txid, raw_hex):
+        '''Store a raw transaction given in hex.  Returns False if it
+        does not hash to txid.'''
+        if txid in self.entries:
+            return True
+        if not TXID_RE.match(txid or ''):
+            return False
+        try:
+            raw = bytes.fromhex(raw_hex)
+        except (TypeError, ValueError):
+            return False
+        if txid_of(raw) != txid:
+            return False
+        with self.lock:
+            if txid in self.entries:
+                return True
+            path = self.file_path(txid)
+            temp_path = "%s.tmp.%s" % (path, os.getpid())
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(temp_path, 'wb') as f:
+                    f.write(raw)
+                os.replace(temp_path, path)
+            except OSError as e:
+                self.print_error("cannot store", txid, e)
+                return False
+            self.entries[txid] = len(raw)
+            self.size += len(raw)
+            self.evict()
+        return True
+
+    def remove(self, txid):
+        self.size -= self.entries.pop(txid, 0)
+        try:
+            os.remove(self.file_path(txid))
+        except OSError:
+            pass
+
+    def evict(self):
+        while self.size > self.max_size and self.entries:
+            self.remove(next(iter(self.entries)))
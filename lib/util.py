@@ -22,7 +22,7 @@
 # SOFTWARE.
 import binascii
 import os, sys, re, json
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from datetime import datetime
 from decimal import Decimal
 import traceback
@@ -131,20 +131,110 @@ class Fiat(object):
         else:
             return "{:.2f}".format(self.value) + ' ' + self.ccy
 
+def json_default(obj):
+    """JSON representation of the objects json does not know about,
+    shared by every codec"""
+    from .transaction import Transaction
+    if isinstance(obj, Transaction):
+        return obj.as_dict()
+    if isinstance(obj, Satoshis):
+        return str(obj)
+    if isinstance(obj, Fiat):
+        return str(obj)
+    if isinstance(obj, Decimal):
+        return str(obj)
+    if isinstance(obj, datetime):
+        return obj.isoformat(' ')[:-3]
+    raise TypeError('%r is not JSON serializable' % obj)
+
 class MyEncoder(json.JSONEncoder):
     def default(self, obj):
-        from .transaction import Transaction
-        if isinstance(obj, Transaction):
-            return obj.as_dict()
-        if isinstance(obj, Satoshis):
-            return str(obj)
-        if isinstance(obj, Fiat):
-            return str(obj)
-        if isinstance(obj, Decimal):
-            return str(obj)
-        if isinstance(obj, datetime):
-            return obj.isoformat(' ')[:-3]
-        return super(MyEncoder, self).default(obj)
+        return json_default(obj)
+
+
+class JSONCodec(object):
+    """Compact JSON to and from bytes, for the wire"""
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj, default=json_default, separators=(',', ':')).encode('utf8')
+
+    def loads(self, data):
+        return json.loads(bytes(data).decode('utf8'))
+
+
+class OrjsonCodec(JSONCodec):
+    """orjson does not encode integers beyond 64 bits nor dicts with
+    non-str keys, and does not decode NaN nor Infinity: those fall back
+    to the standard library"""
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+
+    def dumps(self, obj):
+        try:
+            return self.orjson.dumps(obj, default=json_default)
+        except TypeError:
+            return JSONCodec.dumps(self, obj)
+
+    def loads(self, data):
+        try:
+            return self.orjson.loads(data)
+        except self.orjson.JSONDecodeError:
+            # e.g. NaN or Infinity, that the standard library accepts
+            return JSONCodec.loads(self, data)
+
+
+class UjsonCodec(JSONCodec):
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self.ujson = ujson
+
+    def dumps(self, obj):
+        try:
+            return self.ujson.dumps(obj, default=json_default, ensure_ascii=False).encode('utf8')
+        except (TypeError, OverflowError):
+            return JSONCodec.dumps(self, obj)
+
+    def loads(self, data):
+        return self.ujson.loads(bytes(data))
+
+
+# in order of preference
+JSON_CODECS = [OrjsonCodec, UjsonCodec, JSONCodec]
+
+def get_json_codecs():
+    """names of the codecs that can be used here"""
+    names = []
+    for cls in JSON_CODECS:
+        try:
+            cls()
+        except ImportError:
+            continue
+        names.append(cls.name)
+    return names
+
+def set_json_codec(name=None):
+    """Use the named codec on the wire, or the fastest one available.
+    Raises ValueError if it is unknown or cannot be imported."""
+    global json_codec
+    for cls in JSON_CODECS:
+        if name not in (None, cls.name):
+            continue
+        try:
+            json_codec = cls()
+            return json_codec
+        except ImportError:
+            if name is not None:
+                raise ValueError('JSON codec not available: %s' % name)
+    raise ValueError('unknown JSON codec: %s' % name)
+
+json_codec = None
+set_json_codec()
 
 class PrintError(object):
     '''A handy base class'''
@@ -170,6 +260,45 @@ class ThreadJob(PrintError):
         """Called periodically from the thread"""
         pass
 
+class LRUCache(object):
+    """A bounded mapping that evicts the least recently used entry.
+    Not thread safe; callers are expected to hold their own lock."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        try:
+            self.data.move_to_end(key)
+        except KeyError:
+            return default
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.data.pop(key, default)
+
+    def keys(self):
+        return list(self.data.keys())
+
+    def items(self):
+        return list(self.data.items())
+
+    def clear(self):
+        self.data.clear()
+
 class DebugMem(ThreadJob):
     '''A handy class for debugging GC memory leaks'''
     def __init__(self, classes, interval=30):
@@ -639,16 +768,21 @@ builtin_raw_input = builtins.input
 builtins.input = raw_input
 
 
-def parse_json(message):
+def parse_json(message, offset=0, scan=None):
+    """Decode the line of message starting at offset; scan is where to
+    look for its end if the part before is known to have no newline.
+    Returns the decoded object, None if the line is malformed or not
+    complete yet, and the offset of the next line, which is offset
+    itself if the line is not complete."""
     # TODO: check \r\n pattern
-    n = message.find(b'\n')
+    n = message.find(b'\n', offset if scan is None else scan)
     if n==-1:
-        return None, message
+        return None, offset
     try:
-        j = json.loads(message[0:n].decode('utf8'))
+        j = json_codec.loads(message[offset:n])
     except:
         j = None
-    return j, message[n+1:]
+    return j, n + 1
 
 
 class timeout(Exception):
@@ -659,11 +793,26 @@ import json
 import ssl
 import time
 
+# bytes asked for per recv: a header chunk response is ~320 kB
+SOCKET_READ_SIZE = 65536
+
 
 class SocketPipe:
+    """Newline-delimited JSON over a socket.  Received data is kept in
+    one buffer that is parsed in place, so that long responses and
+    bursts of short ones cost time linear in their size."""
+
     def __init__(self, socket):
         self.socket = socket
-        self.message = b''
+        self.buffer = bytearray()
+        # start of the unparsed data, and how far it is known to have
+        # no newline
+        self.offset = 0
+        self.scanned = 0
+        # data the socket did not take yet
+        self.send_buffer = bytearray()
+        self.bytes_sent = 0
+        self.bytes_received = 0
         self.set_timeout(0.1)
         self.recv_time = time.time()
 
@@ -675,13 +824,25 @@ class SocketPipe:
 
     def get(self):
         while True:
-            response, self.message = parse_json(self.message)
-            if response is not None:
+            response, offset = parse_json(self.buffer, self.offset, self.scanned)
+            if offset != self.offset:
+                self.offset = self.scanned = offset
+                if self.offset > len(self.buffer) // 2:
+                    # drop the parsed part once it is the larger one
+                    del self.buffer[:self.offset]
+                    self.offset = self.scanned = 0
+                if response is None:
+                    # malformed line
+                    continue
                 return response
+            self.scanned = len(self.buffer)
             try:
-                data = self.socket.recv(1024)
+                data = self.socket.recv(SOCKET_READ_SIZE)
             except socket.timeout:
                 raise timeout
+            except BlockingIOError:
+                # non-blocking socket drained
+                raise timeout
             except ssl.SSLError:
                 raise timeout
             except socket.error as err:
@@ -700,27 +861,35 @@ class SocketPipe:
 
             if not data:  # Connection closed remotely
                 return None
-            self.message += data
+            self.buffer += data
+            self.bytes_received += len(data)
             self.recv_time = time.time()
 
     def send(self, request):
-        out = json.dumps(request) + '\n'
-        out = out.encode('utf8')
-        self._send(out)
+        self._send(json_codec.dumps(request) + b'\n')
 
     def send_all(self, requests):
-        out = b''.join(map(lambda x: (json.dumps(x) + '\n').encode('utf8'), requests))
-        self._send(out)
+        self._send(b''.join(json_codec.dumps(x) + b'\n' for x in requests))
 
     def _send(self, out):
-        while out:
+        self.send_buffer += out
+        self.flush_send()
+
+    def flush_send(self):
+        '''Send what the socket takes.  On a non-blocking socket the
+        rest stays in send_buffer, to be sent by another call once the
+        socket is writable.'''
+        while self.send_buffer:
             try:
-                sent = self.socket.send(out)
-                out = out[sent:]
+                sent = self.socket.send(self.send_buffer)
+            except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                return
             except ssl.SSLError as e:
                 print_error("SSLError:", e)
                 time.sleep(0.1)
                 continue
+            self.bytes_sent += sent
+            del self.send_buffer[:sent]
 
 
 class QueuePipe:
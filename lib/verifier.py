@@ -20,8 +20,128 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
-from .util import ThreadJob
+import os
+import struct
+import threading
+
+from .util import ThreadJob, PrintError, LRUCache
 from .bitcoin import *
+from .blockchain import hash_header
+
+# txid, block hash, merkle root, height, position, branch length
+MERKLE_RECORD = struct.Struct('<32s32s32sIIB')
+# branches kept; the least recently used are dropped, and the file is
+# rewritten once it holds twice as many records
+MERKLE_CACHE_SIZE = 20000
+
+
+class MerkleCache(PrintError):
+    """Verified merkle branches, by txid, with the block hash and merkle
+    root they were verified against.  A transaction is verified again
+    without asking the server as long as the header at its height still
+    has that hash.  Shared by the wallets and kept in an append-only
+    file; entries dropped after a reorg are removed by rewriting it."""
+
+    def __init__(self, path, maxsize=MERKLE_CACHE_SIZE):
+        self.path = path
+        self.lock = threading.Lock()
+        # txid -> (height, block hash, pos, merkle root, branch)
+        self.entries = LRUCache(maxsize)
+        self.records = 0
+        self.hits = 0
+        self.misses = 0
+        self.load()
+        self.file = open(self.path, 'ab')
+
+    def diagnostic_name(self):
+        return 'MerkleCache'
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        offset = 0
+        while offset + MERKLE_RECORD.size <= len(data):
+            txid, block_hash, root, height, pos, n = MERKLE_RECORD.unpack_from(data, offset)
+            end = offset + MERKLE_RECORD.size + 32 * n
+            if end > len(data):
+                break
+            branch = [hash_encode(data[i:i+32]) for i in range(offset + MERKLE_RECORD.size, end, 32)]
+            self.entries[hash_encode(txid)] = (height, hash_encode(block_hash), pos, hash_encode(root), branch)
+            self.records += 1
+            offset = end
+        if offset != len(data) or self.records > 2 * len(self.entries):
+            # incomplete last record, or mostly superseded ones
+            self.rewrite()
+
+    def serialize(self, tx_hash, entry):
+        height, block_hash, pos, root, branch = entry
+        return MERKLE_RECORD.pack(hash_decode(tx_hash), hash_decode(block_hash), hash_decode(root),
+                                  height, pos, len(branch)) + b''.join(map(hash_decode, branch))
+
+    def rewrite(self):
+        temp_path = "%s.tmp.%s" % (self.path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            for tx_hash, entry in self.entries.items():
+                f.write(self.serialize(tx_hash, entry))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self.records = len(self.entries)
+
+    def get(self, tx_hash, height, header):
+        '''The verified (pos, merkle root) of tx_hash if it was verified
+        in the block of header, at height'''
+        block_hash = hash_header(header)
+        with self.lock:
+            entry = self.entries.get(tx_hash)
+            if (entry is None or entry[0] != height
+                    or entry[1] != block_hash or entry[3] != header.get('merkle_root')):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[2], entry[3]
+
+    def add(self, tx_hash, height, block_hash, pos, root, branch):
+        entry = (height, block_hash, pos, root, list(branch))
+        with self.lock:
+            if self.entries.get(tx_hash) == entry:
+                return
+            self.entries[tx_hash] = entry
+            self.file.write(self.serialize(tx_hash, entry))
+            self.file.flush()
+            self.records += 1
+            if self.records > 2 * self.entries.maxsize:
+                self.compact()
+
+    def invalidate(self, blockchain, height):
+        '''Drop the entries from height on that do not match the
+        headers of blockchain'''
+        with self.lock:
+            dropped = []
+            for tx_hash, entry in self.entries.items():
+                if entry[0] >= height:
+                    header = blockchain.read_header(entry[0])
+                    if not header or hash_header(header) != entry[1]:
+                        dropped.append(tx_hash)
+            if not dropped:
+                return
+            for tx_hash in dropped:
+                self.entries.pop(tx_hash)
+            self.compact()
+            self.print_error("dropped", len(dropped))
+
+    def compact(self):
+        '''Rewrite the file with the entries we keep; the lock is held'''
+        self.file.close()
+        self.rewrite()
+        self.file = open(self.path, 'ab')
 
 
 class SPV(ThreadJob):
@@ -54,6 +174,8 @@ class SPV(ThreadJob):
                         self.network.request_chunk(interface, index)
                 else:
                     if tx_hash not in self.merkle_roots:
+                        if self.verify_cached(tx_hash, tx_height, header):
+                            continue
                         request = ('blockchain.transaction.get_merkle',
                                    [tx_hash, tx_height])
                         self.network.send([request], self.verify_merkle)
@@ -64,6 +186,18 @@ class SPV(ThreadJob):
             self.blockchain = self.network.blockchain()
             self.undo_verifications()
 
+    def verify_cached(self, tx_hash, tx_height, header):
+        '''Verify tx_hash with a branch verified before against the
+        same block.  Returns False if there is none.'''
+        cache = self.network.merkle_cache
+        cached = cache.get(tx_hash, tx_height, header) if cache else None
+        if cached is None:
+            return False
+        pos, merkle_root = cached
+        self.merkle_roots[tx_hash] = merkle_root
+        self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos))
+        return True
+
     def verify_merkle(self, r):
         if self.wallet.verifier is None:
             return  # we have been killed, this was just an orphan callback
@@ -94,6 +228,9 @@ class SPV(ThreadJob):
             return
         # we passed all the tests
         self.merkle_roots[tx_hash] = merkle_root
+        if self.network.merkle_cache:
+            self.network.merkle_cache.add(tx_hash, tx_height, hash_header(header), pos,
+                                          merkle_root, merkle['merkle'])
         self.print_error("verified %s" % tx_hash)
         self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos))
 
@@ -108,6 +245,8 @@ class SPV(ThreadJob):
     def undo_verifications(self):
         height = self.blockchain.get_checkpoint()
         tx_hashes = self.wallet.undo_verifications(self.blockchain, height)
+        if self.network.merkle_cache:
+            self.network.merkle_cache.invalidate(self.blockchain, height)
         for tx_hash in tx_hashes:
             self.print_error("redoing", tx_hash)
             self.merkle_roots.pop(tx_hash, None)
@@ -58,7 +58,7 @@ from .transaction import Transaction
 from .plugins import run_hook
 from . import bitcoin
 from . import coinchooser
-from .synchronizer import Synchronizer
+from .synchronizer import Synchronizer, history_status
 from .verifier import SPV
 
 from . import paymentrequest
@@ -209,6 +209,8 @@ class Abstract_Wallet(PrintError):
         self.labels                = storage.get('labels', {})
         self.frozen_addresses      = set(storage.get('frozen_addresses',[]))
         self.history               = storage.get('addr_history',{})        # address -> list(txid, height)
+        self.address_status        = storage.get('addr_status', {})        # address -> status of its history
+        self.scripthashes          = storage.get('scripthashes', {})       # address -> scripthash
         self.fiat_value            = storage.get('fiat_value', {})
 
         # Delegate keys for signing Masternode Pings.
@@ -289,6 +291,7 @@ class Abstract_Wallet(PrintError):
             self.storage.put('tx_fees', self.tx_fees)
             self.storage.put('pruned_txo', self.pruned_txo)
             self.storage.put('addr_history', self.history)
+            self.storage.put('addr_status', self.address_status)
             if write:
                 self.storage.write()
 
@@ -301,6 +304,7 @@ class Abstract_Wallet(PrintError):
                 self.pruned_txo = {}
                 self.spent_outpoints = {}
                 self.history = {}
+                self.address_status = {}
                 self.verified_tx = {}
                 self.transactions = {}
                 self.save_transactions()
@@ -322,6 +326,7 @@ class Abstract_Wallet(PrintError):
 
         for addr in hist_addrs_not_mine:
             self.history.pop(addr)
+            self.address_status.pop(addr, None)
             save = True
 
         for addr in hist_addrs_mine:
@@ -334,6 +339,13 @@ class Abstract_Wallet(PrintError):
                 if tx is not None:
                     self.add_transaction(tx_hash, tx)
                     save = True
+
+        # a status saved without its history, e.g. on a crash, would
+        # hide a change of that history from the synchronizer
+        for addr, status in list(self.address_status.items()):
+            if status != history_status(self.history.get(addr, [])):
+                self.address_status.pop(addr)
+                save = True
         if save:
             self.save_transactions()
 
@@ -370,6 +382,19 @@ class Abstract_Wallet(PrintError):
     def is_up_to_date(self):
         with self.lock: return self.up_to_date
 
+    def is_balance_ready(self):
+        '''Whether get_balance has all the confirmed transactions, which
+        happens before the wallet is up to date'''
+        if self.is_up_to_date():
+            return True
+        synchronizer = self.synchronizer
+        return synchronizer is not None and synchronizer.is_balance_ready()
+
+    def get_sync_progress(self):
+        '''(addresses done, addresses, transactions remaining), or None'''
+        synchronizer = self.synchronizer
+        return synchronizer.get_progress() if synchronizer else None
+
     def set_label(self, name, text = None):
         changed = False
         old_text = self.labels.get(name)
@@ -457,7 +482,7 @@ class Abstract_Wallet(PrintError):
         with self.lock:
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
         height, conf, timestamp = self.get_tx_height(tx_hash)
-        self.network.trigger_callback('verified', tx_hash, height, conf, timestamp)
+        self.network.trigger_callback('verified', tx_hash, height, conf, timestamp, wallet=self)
 
     def get_unverified_txs(self):
         '''Returns a map from tx hash to transaction height'''
@@ -974,6 +999,7 @@ class Abstract_Wallet(PrintError):
                         # FIXME the test here should be for "not all is_mine"; cannot detect conflict in some cases
                         self.remove_transaction(tx_hash)
             self.history[addr] = hist
+            self.address_status.pop(addr, None)
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -986,6 +1012,25 @@ class Abstract_Wallet(PrintError):
         # Store fees
         self.tx_fees.update(tx_fees)
 
+    def get_scripthash(self, address):
+        '''The scripthash of address, as servers know it'''
+        h = self.scripthashes.get(address)
+        if h is None:
+            h = bitcoin.address_to_scripthash(address)
+            self.scripthashes[address] = h
+        return h
+
+    def get_address_status(self, address):
+        '''The status of the history of address, computed once per
+        change of the history'''
+        with self.lock:
+            if address in self.address_status:
+                return self.address_status[address]
+            status = history_status(self.history.get(address, []))
+            if status is not None:
+                self.address_status[address] = status
+            return status
+
     def get_history(self, domain=None):
         # get domain
         if domain is None:
@@ -1336,6 +1381,7 @@ class Abstract_Wallet(PrintError):
             # Now no references to the syncronizer or verifier
             # remain so they will be GC-ed
             self.storage.put('stored_height', self.get_local_height())
+        self.storage.put('scripthashes', self.scripthashes)
         self.save_transactions()
         self.storage.put('verified_tx3', self.verified_tx)
         self.storage.write()
@@ -1474,10 +1520,18 @@ class Abstract_Wallet(PrintError):
         # will likely be.  If co-signing a transaction it may not have
         # all the input txs, in which case we ask the network.
         tx = self.transactions.get(tx_hash, None)
+        tx_cache = self.network.tx_cache if self.network else None
+        if not tx and tx_cache:
+            raw = tx_cache.get(tx_hash)
+            if raw:
+                return Transaction(raw)
         if not tx and self.network:
             request = ('blockchain.transaction.get', [tx_hash])
             try:
-                tx = Transaction(self.network.synchronous_get(request))
+                raw = self.network.synchronous_get(request)
+                tx = Transaction(raw)
+                if tx_cache:
+                    tx_cache.put(tx_hash, raw)
             except TimeoutException as e:
                 self.print_error('getting input txn from network timed out for {}'.format(tx_hash))
                 if not ignore_timeout:
@@ -2018,6 +2072,8 @@ class Imported_Wallet(Simple_Wallet):
                         transactions_new.add(tx_hash)
             transactions_to_remove -= transactions_new
             self.history.pop(address, None)
+            self.address_status.pop(address, None)
+            self.scripthashes.pop(address, None)
 
             for tx_hash in transactions_to_remove:
                 self.remove_transaction(tx_hash)
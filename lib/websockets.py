@@ -84,7 +84,7 @@ class WsClientThread(util.DaemonThread):
             l = self.subscriptions.get(addr, [])
             l.append((ws, amount))
             self.subscriptions[addr] = l
-            h = self.network.addr_to_scripthash(addr)
+            h = self.network.addr_to_scripthash(addr, owner=self)
             self.network.send([('blockchain.scripthash.subscribe', [h])], self.response_queue.put)
 
 
@@ -105,7 +105,7 @@ class WsClientThread(util.DaemonThread):
                 self.network.send([('blockchain.scripthash.get_balance', params)], self.response_queue.put)
             elif method == 'blockchain.scripthash.get_balance':
                 h = params[0]
-                addr = self.network.h2addr.get(h, None)
+                addr = self.network.get_address(h)
                 if addr is None:
                     util.print_error("can't find address for scripthash: %s" % h)
                 l = self.subscriptions.get(addr, [])
@@ -113,6 +113,14 @@ class WsClientThread(util.DaemonThread):
                     if not ws.closed:
                         if sum(result.values()) >=amount:
                             ws.sendMessage('paid')
+                l = [(ws, amount) for ws, amount in l if not ws.closed]
+                if l:
+                    self.subscriptions[addr] = l
+                elif addr is not None:
+                    # nobody waits on it anymore
+                    self.subscriptions.pop(addr, None)
+                    self.network.forget_addresses(self, [addr])
+        self.network.forget_addresses(self)
 
 
 